@@ -1,6 +1,7 @@
-import time
-
+import sim_clock
+import sim_recorder
 import sim_vars
+from alexa_events import EventQueue
 
 
 class AlexaGadget():
@@ -8,17 +9,27 @@ class AlexaGadget():
     An Alexa-connected accessory that interacts with an Amazon Echo device over Bluetooth.
     """
 
-    def __init__(self, gadget_config_path=None):
-        print("Gadget: Init")
+    def __init__(self, gadget_config_path=None, clock=None, recorder=None, events=None):
+        """
+        :param events: the alexa_events.EventQueue for outbound events,
+            defaults to one on the gadget's clock
+        """
+        self.recorder = recorder if recorder is not None else sim_recorder.get_recorder()
+        self.recorder.log("Gadget: Init")
         self.friendly_name = "alexa device"
+        self.clock = clock if clock is not None else sim_clock.get_clock()
+        self.events = events if events is not None else EventQueue(clock=self.clock)
 
     def send_custom_event(self, namespace, name, payload):
         """
-        Sends a simulated event to alexa.
+        Queues a simulated event to alexa. The event queue's sender, started
+        by main(), delivers it.
         """
+        self.events.put(namespace, name, payload)
 
     def main(self):
+        self.events.start()
 
         while(True):
-            time.sleep(1)
-            print("Gadget: Tick")
+            self.clock.sleep(1)
+            self.recorder.log("Gadget: Tick")
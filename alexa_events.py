@@ -0,0 +1,270 @@
+"""
+Outbound custom event queue between a gadget and its Echo device.
+
+AlexaGadget.send_custom_event puts events on an EventQueue and returns at
+once. A sender, started by the gadget on its clock, takes the pending events
+in order and hands them to a transport in batches. Three things keep a
+misbehaving sensor from flooding the link:
+
+- coalescing: a pending event whose name is in coalesce (by default Power) is
+  replaced by a newer one of the same name, keeping its place in the queue
+- rate limiting: a token bucket allows rate events per second with bursts of
+  up to burst events
+- a bounded queue: beyond max_pending events the oldest is dropped
+
+A batch the transport fails to send goes back to the front of the queue, and
+the sender backs off, doubling the wait after each failure in a row.
+
+Transports have a send(events) method taking a list of
+{'namespace', 'name', 'payload'} dicts. NullTransport drops them, which is
+what the gadget did before there was a queue, CallbackTransport calls a
+function per event and SocketTransport sends them to an Echo stand-in, see
+echo_server.py.
+"""
+
+import asyncio
+import collections
+import json
+import logging
+import os
+import socket
+import threading
+
+import sim_clock
+from sim_metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+
+class NullTransport():
+    """
+    Drops every event.
+    """
+
+    def send(self, events):
+        pass
+
+
+class CallbackTransport():
+    """
+    Calls callback(namespace, name, payload) for every event.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def send(self, events):
+        for event in events:
+            self.callback(event['namespace'], event['name'], event['payload'])
+
+
+class SocketTransport():
+    """
+    Sends each batch as one line of JSON over a TCP connection, which is
+    opened on first use and again after an error.
+    """
+
+    def __init__(self, address, timeout=5.0):
+        """
+        :param address: the (host, port) of the Echo stand-in
+        :param timeout: the socket timeout in seconds
+        """
+        self.address = address
+        self.timeout = timeout
+        self._sock = None
+
+    def send(self, events):
+        data = json.dumps({'events': events}).encode('utf-8') + b'\n'
+        if self._sock is None:
+            self._sock = socket.create_connection(self.address, self.timeout)
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            self._sock.sendall(data)
+        except OSError:
+            self.close()
+            raise
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+
+def default_transport():
+    """
+    A SocketTransport to $HOUSEPET_ECHO (host:port) if set, else a NullTransport.
+    """
+    echo = os.environ.get('HOUSEPET_ECHO')
+    if not echo:
+        return NullTransport()
+    host, _, port = echo.rpartition(':')
+    return SocketTransport((host or '127.0.0.1', int(port)))
+
+
+class EventQueue():
+    """
+    Queues, coalesces, rate limits and batches outbound events.
+    """
+
+    def __init__(self, transport=None, clock=None, rate=10.0, burst=10, batch_size=16,
+                 coalesce=('Power',), max_pending=1000, retry_delay=0.5, max_retry_delay=30.0):
+        """
+        :param transport: where batches go, defaults to default_transport()
+        :param clock: the clock the sender runs on, defaults to the shared sim_clock clock
+        :param rate: events per second the sender may send on average
+        :param burst: the most events the sender may send at once after a pause
+        :param batch_size: the most events in one batch
+        :param coalesce: names of events of which only the latest pending one is sent
+        :param max_pending: the most events to hold; the oldest is dropped beyond that
+        :param retry_delay: seconds to wait after a failed send
+        :param max_retry_delay: the longest wait after failed sends in a row
+        """
+        self.transport = transport if transport is not None else default_transport()
+        self.clock = clock if clock is not None else sim_clock.get_clock()
+        self.rate = rate
+        self.burst = burst
+        self.batch_size = batch_size
+        self.coalesce = frozenset(coalesce)
+        self.max_pending = max_pending
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+        self._lock = threading.Lock()
+        self._pending = collections.OrderedDict()
+        self._ready = sim_clock.ClockEvent()
+        self._seq = 0
+        self._tokens = float(burst)
+        self._refilled_at = None
+        self._started = False
+        self._failures = 0
+
+        self.latency = Histogram()
+        self.counts = {'queued': 0, 'sent': 0, 'batches': 0, 'coalesced': 0, 'dropped': 0, 'failed': 0}
+        self._first_put = None
+
+    def put(self, namespace, name, payload):
+        """
+        Queues an event without blocking.
+        """
+        now = self.clock.now()
+        with self._lock:
+            self.counts['queued'] += 1
+            if self._first_put is None:
+                self._first_put = now
+            if name in self.coalesce:
+                key = (namespace, name)
+                entry = self._pending.get(key)
+                if entry is not None:
+                    entry[2] = payload
+                    self.counts['coalesced'] += 1
+                    return
+            else:
+                self._seq += 1
+                key = self._seq
+            self._pending[key] = [namespace, name, payload, now]
+            if len(self._pending) > self.max_pending:
+                self._pending.popitem(last=False)
+                self.counts['dropped'] += 1
+        self._ready.set()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def start(self):
+        """
+        Starts the sender as a thread of the clock, once.
+        """
+        if not self._started:
+            self._started = True
+            self.clock.spawn(self._sender_thread)
+
+    def _sender_thread(self):
+        while True:
+            delay = self._send_ready()
+            if delay is None:
+                self.clock.wait(self._ready)
+            elif delay:
+                self.clock.sleep(delay)
+
+    async def run_async(self):
+        """
+        The sender as a coroutine, for gadgets on an event loop. The
+        transport is called on the loop.
+        """
+        self._started = True
+        while True:
+            delay = self._send_ready()
+            if delay is None:
+                await self._ready.wait_async()
+            elif delay:
+                await asyncio.sleep(delay)
+
+    def _send_ready(self):
+        """
+        Sends one batch if the bucket allows it.
+        :return: None if the queue is empty, else seconds to wait before the
+            next batch may be sent
+        """
+        now = self.clock.now()
+        if self._refilled_at is not None:
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+        with self._lock:
+            if not self._pending:
+                self._ready.clear()
+                return None
+            if self._tokens < 1:
+                return (1 - self._tokens) / self.rate
+            count = min(len(self._pending), self.batch_size, int(self._tokens))
+            batch = [self._pending.popitem(last=False) for _ in range(count)]
+        self._tokens -= count
+
+        events = [{'namespace': namespace, 'name': name, 'payload': payload}
+                  for key, (namespace, name, payload, queued_at) in batch]
+        try:
+            self.transport.send(events)
+        except Exception as e:
+            logger.warning("Sending %d events failed: %s", count, e)
+            self.counts['failed'] += count
+            self._requeue(batch)
+            self._failures += 1
+            return min(self.retry_delay * 2 ** (self._failures - 1), self.max_retry_delay)
+
+        self._failures = 0
+        self.counts['sent'] += count
+        self.counts['batches'] += 1
+        for key, entry in batch:
+            self.latency.observe(now - entry[3])
+        return 0
+
+    def _requeue(self, batch):
+        """
+        Puts a batch that was not sent back at the front of the queue, in
+        order. An event queued meanwhile under the same coalescing key
+        replaces its payload.
+        """
+        with self._lock:
+            pending = self._pending
+            for key, entry in reversed(batch):
+                newer = pending.get(key)
+                if newer is not None:
+                    entry[2] = newer[2]
+                    self.counts['coalesced'] += 1
+                pending[key] = entry
+                pending.move_to_end(key, last=False)
+            while len(pending) > self.max_pending:
+                pending.popitem(last=False)
+                self.counts['dropped'] += 1
+
+    def stats(self):
+        """
+        Returns the event counts, the send throughput in events per second of
+        clock time and the queueing latency in clock seconds.
+        """
+        with self._lock:
+            stats = dict(self.counts, pending=len(self._pending))
+        elapsed = self.clock.now() - self._first_put if self._first_put is not None else 0
+        stats['events_per_sec'] = stats['sent'] / elapsed if elapsed > 0 else 0.0
+        stats['latency'] = self.latency.snapshot()
+        return stats
@@ -0,0 +1,72 @@
+"""
+Floods the outbound event queue like a stuck touch sensor and reports the
+throughput and queueing latency, sending to the local Echo stand-in.
+
+Run from the repository root with::
+
+    python -m benchmarks.bench_alexa_events
+"""
+
+import argparse
+import time
+
+import echo_server
+import sim_clock
+from alexa_events import EventQueue, SocketTransport
+
+
+def flood(queue, seconds, power_every):
+    """
+    Puts Speech events as fast as possible, with a Power event every
+    power_every events.
+    """
+    end = time.monotonic() + seconds
+    i = 0
+    while time.monotonic() < end:
+        queue.put('Custom.Mindstorms.Gadget', 'Speech', {'speechOut': "Ahh, I like that."})
+        if i % power_every == 0:
+            queue.put('Custom.Mindstorms.Gadget', 'Power', {'voltage': 3.7, 'seq': i})
+        i += 1
+        if i % 64 == 0:
+            # Let the sender run
+            time.sleep(0)
+
+
+def run(rate, burst, batch_size, seconds, power_every):
+    echo = echo_server.start()
+    clock = sim_clock.SimClock()
+    queue = EventQueue(SocketTransport(echo.server_address), clock=clock, rate=rate, burst=burst,
+                       batch_size=batch_size, max_pending=10000)
+    queue.start()
+    flood(queue, seconds, power_every)
+    # Give the sender and the stand-in a moment to catch up
+    time.sleep(0.2)
+    clock.stop()
+    stats = queue.stats()
+    stats['echo'] = echo.stats()
+    echo.shutdown()
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the outbound event queue.")
+    parser.add_argument("--seconds", type=float, default=2.0)
+    parser.add_argument("--power-every", type=int, default=100)
+    args = parser.parse_args(argv)
+
+    configs = [
+        ("unlimited, batch 64", float('inf'), 64, 64),
+        ("unlimited, batch 1", float('inf'), 1, 1),
+        ("10/s, burst 10", 10.0, 10, 16),
+    ]
+    for name, rate, burst, batch_size in configs:
+        s = run(rate, burst, batch_size, args.seconds, args.power_every)
+        latency = s['latency']
+        print("{:<20} queued {:>8} sent {:>8} ({:>8.0f}/s) batches {:>7} coalesced {:>6} dropped {:>8}  "
+              "latency p50 {:>8.2f} ms p99 {:>8.2f} ms  echo {:>8.0f}/s".format(
+                  name, s['queued'], s['sent'], s['events_per_sec'], s['batches'], s['coalesced'], s['dropped'],
+                  latency.get('p50', 0) * 1000, latency.get('p99', 0) * 1000, s['echo']['events_per_sec']))
+
+
+if __name__ == '__main__':
+    main()
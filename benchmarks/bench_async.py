@@ -0,0 +1,130 @@
+"""
+Compares hosting many gadgets with behavior threads against hosting them as
+coroutines on one event loop: memory per gadget, context switches and CPU
+time while the gadgets patrol in real time.
+
+Each mode runs in a fresh interpreter. Run from the repository root with::
+
+    python -m benchmarks.bench_async
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+
+def _rss_kb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _usage():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_nvcsw + usage.ru_nivcsw, usage.ru_utime + usage.ru_stime
+
+
+def _measure(create, run, n, seconds):
+    before = _rss_kb()
+    start = time.perf_counter()
+    gadgets = create(n)
+    startup = time.perf_counter() - start
+    rss = _rss_kb() - before
+
+    switches, cpu = _usage()
+    run(gadgets, seconds)
+    switches_after, cpu_after = _usage()
+
+    return {
+        "gadgets": n,
+        "startup_s": startup,
+        "rss_kb_per_gadget": rss / n,
+        "context_switches_per_s": (switches_after - switches) / seconds,
+        "cpu_percent": 100 * (cpu_after - cpu) / seconds,
+    }
+
+
+def run_threaded(n, seconds):
+    import sim_vars
+    from housepet_gadget import MindstormsGadget
+
+    def create(n):
+        gadgets = [MindstormsGadget(world=sim_vars.WorldState(), telemetry='sim') for _ in range(n)]
+        for gadget in gadgets:
+            gadget.send_custom_event = lambda namespace, name, payload: None
+            gadget.patrol_mode = True
+        return gadgets
+
+    def run(gadgets, seconds):
+        time.sleep(seconds)
+
+    return _measure(create, run, n, seconds)
+
+
+def run_async(n, seconds):
+    import sim_vars
+    from housepet_gadget import AsyncMindstormsGadget
+
+    loop = asyncio.new_event_loop()
+
+    def create(n):
+        async def start():
+            gadgets = [AsyncMindstormsGadget(world=sim_vars.WorldState(), telemetry='sim') for _ in range(n)]
+            for gadget in gadgets:
+                gadget.send_custom_event = lambda namespace, name, payload: None
+                gadget.patrol_mode = True
+                await gadget.start()
+            return gadgets
+        return loop.run_until_complete(start())
+
+    def run(gadgets, seconds):
+        async def wait_and_stop():
+            await asyncio.sleep(seconds)
+            for gadget in gadgets:
+                await gadget.stop()
+        loop.run_until_complete(wait_and_stop())
+
+    return _measure(create, run, n, seconds)
+
+
+MODES = {"threaded": run_threaded, "async": run_async}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare threaded and async gadget hosting.")
+    parser.add_argument("--gadgets", type=int, default=1000)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--mode", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.mode:
+        # Child process: keep the gadgets' console output out of the report
+        sys.stdout = open(os.devnull, "w")
+        sys.stderr = sys.stdout
+        result = MODES[args.mode](args.gadgets, args.seconds)
+        sys.__stdout__.write(json.dumps(result))
+        return
+
+    print("{:<9} {:>10} {:>14} {:>12} {:>7}".format("mode", "startup s", "RSS KB/gadget", "ctx sw/s", "CPU %"))
+    for mode in MODES:
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.bench_async", "--mode", mode,
+             "--gadgets", str(args.gadgets), "--seconds", str(args.seconds)],
+            check=True, capture_output=True, text=True).stdout
+        r = json.loads(output)
+        print("{:<9} {:>10.2f} {:>14.1f} {:>12.0f} {:>7.1f}".format(
+            mode, r["startup_s"], r["rss_kb_per_gadget"], r["context_switches_per_s"], r["cpu_percent"]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Compares exploring what-if branches by replaying the episode from the start
+against forking them from a checkpoint. Each branch moves the bump to a
+different time after --at and runs --horizon seconds past it.
+
+Run from the repository root with::
+
+    python -m benchmarks.bench_checkpoint
+"""
+
+import argparse
+import time
+
+import sim_recorder
+from sim_checkpoint import Simulation
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark branching from checkpoints against replaying.")
+    parser.add_argument("--house", default="maps/house.json")
+    parser.add_argument("--at", type=float, default=1800, help="simulated time of the checkpoint")
+    parser.add_argument("--horizon", type=float, default=30, help="simulated seconds each branch runs")
+    parser.add_argument("--branches", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    sim_recorder.get_recorder().level = sim_recorder.OFF
+    episode = {"seed": 1, "house": args.house, "start": [1.0, 1.0, 0.0], "duration": args.at + args.horizon,
+               "directives": [[1, {"type": "command", "command": "patrol"}]]}
+    branches = [{"sim_vars": {"touch_bump": [[args.at + i * args.horizon / args.branches, True]]}}
+                for i in range(args.branches)]
+
+    start = time.perf_counter()
+    replayed = []
+    for branch in branches:
+        simulation = Simulation(dict(episode, **branch))
+        replayed.append(simulation.run())
+        simulation.close()
+    replay = time.perf_counter() - start
+
+    start = time.perf_counter()
+    simulation = Simulation(episode)
+    simulation.run_until(args.at)
+    setup = time.perf_counter() - start
+    with simulation.checkpoint() as checkpoint:
+        forked = checkpoint.branches(branches)
+    fork = time.perf_counter() - start
+    simulation.close()
+
+    same = all(a["pose_x"] == b["pose_x"] and a["speech_events"] == b["speech_events"]
+               for a, b in zip(replayed, forked))
+    print("{} branches of {:.0f} s from t = {:.0f} s".format(args.branches, args.horizon, args.at))
+    print("replay: {:8.1f} ms per branch".format(replay / args.branches * 1e3))
+    print("fork:   {:8.1f} ms per branch, after {:.1f} ms to reach the checkpoint".format(
+        (fork - setup) / args.branches * 1e3, setup * 1e3))
+    print("speedup: {:.1f}x, results {}".format(replay / fork, "match" if same else "DIFFER"))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""
+Runs the same patrol coverage analysis on 1, 2, 4, ... worker processes up to
+the CPU count and reports the throughput and the scaling efficiency against
+one process. Episodes share nothing, so the efficiency should stay close to
+1 until the cores run out.
+
+Run from the repository root with::
+
+    python -m benchmarks.bench_coverage
+"""
+
+import argparse
+import os
+
+import patrol_coverage
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark patrol coverage scaling across processes.")
+    parser.add_argument("--house", default="maps/house.json")
+    parser.add_argument("--episodes-per-process", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=1800)
+    parser.add_argument("--processes", type=int, nargs="*",
+                        help="process counts to run, defaults to powers of two up to the CPU count")
+    args = parser.parse_args(argv)
+
+    counts = args.processes
+    if not counts:
+        cpus = os.cpu_count()
+        counts = [1 << i for i in range(cpus.bit_length()) if 1 << i <= cpus]
+        if counts[-1] != cpus:
+            counts.append(cpus)
+
+    print("{:>9} {:>9} {:>9} {:>12} {:>11} {:>9}".format(
+        "processes", "episodes", "seconds", "episodes/s", "efficiency", "coverage"))
+    base = None
+    for processes in counts:
+        # Weak scaling: the same work per process, so the wall time should stay flat
+        episodes = processes * args.episodes_per_process
+        result = patrol_coverage.run_coverage(args.house, episodes, duration=args.duration, processes=processes)
+        rate = episodes / result["wall_time"]
+        if base is None:
+            base = rate / processes
+        print("{:>9} {:>9} {:>9.2f} {:>12.2f} {:>11.2f} {:>9.1%}".format(
+            processes, episodes, result["wall_time"], rate, rate / processes / base, result["curves"][:, -1].mean()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Measures control directive dispatch: the per-directive callback path against
+the batch dispatch_directives API, on a fast-clock gadget.
+
+Run from the repository root with::
+
+    python -m benchmarks.bench_directives
+"""
+
+import argparse
+import contextlib
+import os
+import time
+import types
+
+import housepet_gadget
+import sim_clock
+from sim_vars import WorldState
+
+
+# Directives that return without blocking on the drive
+PAYLOADS = [
+    b'{"type": "move", "direction": "forward", "duration": 1, "speed": 50}',
+    b'{"type": "follow"}',
+    b'{"type": "stopfollow"}',
+    b'{"type": "command", "command": "patrol"}',
+    b'{"type": "move", "direction": "stop", "duration": 0, "speed": 0}',
+]
+
+
+def make_gadget():
+    clock = sim_clock.SimClock(fast=True, seed=1)
+    sim_clock.set_clock(clock)
+    return housepet_gadget.MindstormsGadget(clock=clock, world=WorldState(), telemetry='sim')
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def bench_callback(gadget, count):
+    directives = [types.SimpleNamespace(payload=p) for p in PAYLOADS]
+    latencies = []
+    start = time.perf_counter()
+    for i in range(count):
+        directive = directives[i % len(directives)]
+        t0 = time.perf_counter_ns()
+        gadget.on_custom_mindstorms_gadget_control(directive)
+        latencies.append(time.perf_counter_ns() - t0)
+    return count / (time.perf_counter() - start), percentile(latencies, 0.99)
+
+
+def bench_batch(gadget, count, batch):
+    stream = [PAYLOADS[i % len(PAYLOADS)] for i in range(batch)]
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(count // batch):
+        t0 = time.perf_counter_ns()
+        gadget.dispatch_directives(stream)
+        latencies.append((time.perf_counter_ns() - t0) / batch)
+    return (count // batch) * batch / (time.perf_counter() - start), percentile(latencies, 0.99)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark control directive dispatch.")
+    parser.add_argument("--count", type=int, default=50000)
+    parser.add_argument("--batch", type=int, default=500)
+    args = parser.parse_args(argv)
+
+    gadget = make_gadget()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), \
+            contextlib.redirect_stderr(devnull):
+        results = [
+            ("per-directive callback", bench_callback(gadget, args.count)),
+            ("batch x{}".format(args.batch), bench_batch(gadget, args.count, args.batch)),
+        ]
+    gadget.clock.stop()
+
+    print("json decoder: {}".format(housepet_gadget.json_loads.__module__))
+    for name, (rate, p99) in results:
+        print("{:<24} {:>10.0f} directives/s  p99 {:>7.2f} us".format(name, rate, p99 / 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""
+Compares running a sweep through sim_dist's coordinator and local workers,
+over TCP and over a Unix socket, against sim_batch's process pool, to show
+what the socket work queue costs per episode.
+
+Run from the repository root with::
+
+    python -m benchmarks.bench_dist
+"""
+
+import argparse
+import os
+import time
+
+import sim_batch
+import sim_dist
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the socket work queue against the process pool.")
+    parser.add_argument("--episodes", type=int, default=400)
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("-j", "--processes", type=int, default=None)
+    parser.add_argument("--batch", type=int, default=4)
+    args = parser.parse_args(argv)
+
+    processes = args.processes or os.cpu_count()
+    episodes = [{"seed": i, "duration": args.duration,
+                 "directives": [[1, {"type": "command", "command": "patrol"}]]} for i in range(args.episodes)]
+
+    print("{:<8} {:>9} {:>12} {:>12}".format("mode", "seconds", "episodes/s", "ms/episode"))
+    for mode in ("pool", "tcp", "unix"):
+        start = time.perf_counter()
+        if mode == "pool":
+            sim_batch.run_batch(episodes, processes)
+        else:
+            sim_dist.run_local(episodes, processes, args.batch, unix=mode == "unix")
+        elapsed = time.perf_counter() - start
+        print("{:<8} {:>9.2f} {:>12.1f} {:>12.2f}".format(
+            mode, elapsed, len(episodes) / elapsed, elapsed / len(episodes) * processes * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Measures the per-event cost of printing against the event recorder at each
+level, with and without the background file flusher.
+
+Run from the repository root with::
+
+    python -m benchmarks.bench_events
+"""
+
+import argparse
+import contextlib
+import os
+import tempfile
+import time
+
+import sim_clock
+import sim_recorder
+
+
+def bench_print(count):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        for i in range(count):
+            print("IR Heading: ", i)
+            print("LED: ", "LEFT", "is", "GREEN")
+        return (time.perf_counter() - start) / (2 * count)
+
+
+def bench_recorder(count, level, path=None):
+    """
+    The buffer holds every event, so the flusher never has to catch up with a
+    loop that does nothing but record.
+    """
+    clock = sim_clock.SimClock(fast=True)
+    with open(os.devnull, 'w') as devnull, \
+            sim_recorder.EventRecorder(path, level=level, capacity=4 * count, clock=clock, stream=devnull) as recorder:
+        start = time.perf_counter()
+        for i in range(count):
+            recorder.sensor("IR", "heading", i)
+            recorder.led("LEFT", "GREEN")
+        elapsed = time.perf_counter() - start
+    clock.stop()
+    return elapsed / (2 * count)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark event recording overhead.")
+    parser.add_argument("--count", type=int, default=200000)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "events.bin")
+        results = [
+            ("print to devnull", bench_print(args.count)),
+            ("recorder TEXT", bench_recorder(args.count, sim_recorder.TEXT)),
+            ("recorder RECORD", bench_recorder(args.count, sim_recorder.RECORD)),
+            ("recorder RECORD + file", bench_recorder(args.count, sim_recorder.RECORD, path)),
+            ("recorder OFF", bench_recorder(args.count, sim_recorder.OFF)),
+        ]
+        size = os.path.getsize(path)
+
+    for name, seconds in results:
+        print("{:<24} {:>8.0f} ns/event".format(name, seconds * 1e9))
+    print("file size: {:.1f} bytes/event".format(size / (2 * args.count)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""
+Scaling benchmark for the vectorized follow simulator.
+
+Run from the repository root with::
+
+    python -m benchmarks.bench_fleet
+"""
+
+import argparse
+import time
+
+from sim_fleet import FleetSim
+
+
+SIZES = (1, 10, 100, 1000, 10000, 100000)
+
+
+def bench(n, seconds=0.5, dt=0.1):
+    """
+    Steps a fleet of n robots for at least the given wall time.
+    :return: steps per second
+    """
+    fleet = FleetSim.random(n, seed=n)
+    fleet.step(dt)
+
+    steps = 0
+    start = time.perf_counter()
+    while True:
+        fleet.step(dt)
+        steps += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return steps / elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark FleetSim.step across fleet sizes.")
+    parser.add_argument("--seconds", type=float, default=0.5, help="wall time per fleet size")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="fleet sizes to run")
+    args = parser.parse_args(argv)
+
+    print("{:>8} {:>12} {:>16}".format("robots", "steps/s", "robot-steps/s"))
+    for n in args.sizes:
+        rate = bench(n, args.seconds)
+        print("{:>8} {:>12.1f} {:>16.0f}".format(n, rate, rate * n))
+
+
+if __name__ == '__main__':
+    main()
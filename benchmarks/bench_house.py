@@ -0,0 +1,85 @@
+"""
+Shows that house map queries stay flat as the map grows, against a brute
+force scan of every segment, and times a fleet driving around a large map.
+
+Run from the repository root with::
+
+    python -m benchmarks.bench_house
+"""
+
+import argparse
+import random
+import time
+
+import numpy as np
+
+from house_map import ROBOT_RADIUS, HouseMap, _point_segment_distance2, _segment_intersection
+from sim_fleet import FleetSim
+
+
+def brute_collides(house, x, y):
+    r2 = ROBOT_RADIUS * ROBOT_RADIUS
+    return any(_point_segment_distance2(x, y, *s) < r2 for s in house.segments)
+
+
+def brute_line_of_sight(house, x0, y0, x1, y1):
+    return not any(_segment_intersection(x0, y0, x1, y1, *s) is not None for s in house.segments)
+
+
+def time_queries(house, queries, collides, line_of_sight):
+    start = time.perf_counter()
+    for x0, y0, x1, y1 in queries:
+        collides(x0, y0)
+        line_of_sight(x0, y0, x1, y1)
+    return (time.perf_counter() - start) / len(queries)
+
+
+def bench_queries(sizes, count):
+    print("{:>8} {:>9} {:>14} {:>14}".format("rooms", "segments", "grid us/query", "scan us/query"))
+    for rooms in sizes:
+        house = HouseMap.generate(rooms, rooms, seed=1)
+        x0, y0, x1, y1 = house.bounds()
+        rng = random.Random(1)
+        queries = []
+        for _ in range(count):
+            # IR sized rays: up to 2 m
+            qx, qy = rng.uniform(x0, x1), rng.uniform(y0, y1)
+            queries.append((qx, qy, qx + rng.uniform(-1.4, 1.4), qy + rng.uniform(-1.4, 1.4)))
+
+        grid = time_queries(house, queries, house.collides, house.line_of_sight)
+        scan = time_queries(house, queries[:max(1, count // 20)],
+                            lambda x, y: brute_collides(house, x, y),
+                            lambda *ray: brute_line_of_sight(house, *ray))
+        print("{:>8} {:>9} {:>14.2f} {:>14.2f}".format(rooms * rooms, len(house.segments), grid * 1e6, scan * 1e6))
+
+
+def bench_fleet(rooms, robots, seconds):
+    house = HouseMap.generate(rooms, rooms, seed=1)
+    fleet = FleetSim.in_house(house, robots, seed=1)
+
+    # Give each robot a beacon of its own nearby so that they all move
+    rng = np.random.default_rng(2)
+    angle = rng.uniform(-np.pi, np.pi, robots)
+    fleet.beacon_x = fleet.x + 1.5 * np.cos(angle)
+    fleet.beacon_y = fleet.y + 1.5 * np.sin(angle)
+
+    steps = int(seconds / 0.1)
+    start = time.perf_counter()
+    fleet.run(seconds, 0.1)
+    elapsed = time.perf_counter() - start
+    print("fleet: {} robots in {} rooms, {:.2f} ms/step, {} collisions".format(
+        robots, rooms * rooms, elapsed / steps * 1000, fleet.collisions))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark house map queries.")
+    parser.add_argument("--queries", type=int, default=20000)
+    parser.add_argument("--robots", type=int, default=10000)
+    args = parser.parse_args(argv)
+
+    bench_queries([1, 4, 16, 64], args.queries)
+    bench_fleet(64, args.robots, 10)
+
+
+if __name__ == '__main__':
+    main()
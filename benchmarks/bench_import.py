@@ -0,0 +1,47 @@
+"""
+Cold-start benchmark for importing housepet_gadget.
+
+Each sample runs a fresh interpreter. "lazy" is the plain import, which no
+longer touches the network or the HTTP libraries. "eager" also builds the IoT
+telemetry backend, which is what every import paid before (not counting the
+token request itself, which needs the network).
+
+Run from the repository root with::
+
+    python -m benchmarks.bench_import
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+
+CASES = (
+    ("bare interpreter", "pass"),
+    ("lazy import", "import housepet_gadget"),
+    ("eager backend", "import housepet_gadget; housepet_gadget.iot_telemetry(None)"),
+)
+
+
+def bench(code, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True, stdout=subprocess.DEVNULL)
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark housepet_gadget import time.")
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    for name, code in CASES:
+        print("{:<18} {:>8.1f} ms".format(name, bench(code, args.runs) * 1000))
+
+
+if __name__ == '__main__':
+    main()
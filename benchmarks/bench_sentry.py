@@ -0,0 +1,54 @@
+"""
+Times the sentry detector on fleets of robots streaming synthetic IR
+proximity at 1 kHz, and with longer windows, to show the cost per sample
+stays flat as the fleet and the windows grow.
+
+Run from the repository root with::
+
+    python -m benchmarks.bench_sentry
+"""
+
+import argparse
+import time
+
+from sim_sentry import PROXIMITY, SENTRY, SentryDetector, synthetic
+
+
+def run(robots, seconds, rate, block, seed, **detector):
+    """
+    Feeds a fleet's traces to a detector in blocks.
+    :return: the seconds taken, the event counts by name and the detector
+    """
+    total = int(seconds * rate)
+    step = max(1, int(block * rate))
+    traces = synthetic(robots, total, rate, seed)
+    sentry = SentryDetector(robots, rate, **detector)
+    counts = {PROXIMITY: 0, SENTRY: 0}
+    start = time.perf_counter()
+    for offset in range(0, total, step):
+        for _, _, name, _ in sentry.process(traces[:, offset:offset + step]):
+            counts[name] += 1
+    return time.perf_counter() - start, counts, sentry
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the sentry detector on synthetic fleets.")
+    parser.add_argument("--robots", type=int, nargs="+", default=[1, 100, 1000])
+    parser.add_argument("--seconds", type=float, default=10, help="simulated seconds of samples")
+    parser.add_argument("--rate", type=float, default=1000, help="samples per second per robot")
+    parser.add_argument("--block", type=float, default=0.1, help="seconds of samples per block")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    print("{:>7} {:>9} {:>9} {:>12} {:>10} {:>8} {:>8}".format(
+        "robots", "baseline", "elapsed", "ns/sample", "realtime", "prox", "sentry"))
+    rows = [(robots, 1.0) for robots in args.robots] + [(args.robots[-1], 10.0)]
+    for robots, baseline in rows:
+        elapsed, counts, sentry = run(robots, args.seconds, args.rate, args.block, args.seed, baseline=baseline)
+        print("{:>7} {:>8.0f}s {:>8.2f}s {:>12.1f} {:>9.1f}x {:>8} {:>8}".format(
+            robots, baseline, elapsed, elapsed / (robots * args.seconds * args.rate) * 1e9,
+            args.seconds / elapsed, counts[PROXIMITY], counts[SENTRY]))
+
+
+if __name__ == '__main__':
+    main()
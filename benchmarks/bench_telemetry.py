@@ -0,0 +1,70 @@
+"""
+Compares the old per-property IoT fetch with the bulk, cached telemetry
+client, against the local stand-in server.
+
+Run from the repository root with::
+
+    python -m benchmarks.bench_telemetry
+"""
+
+import argparse
+import time
+
+import requests
+
+import sim_clock
+import telemetry_server
+from telemetry import IotTelemetryClient
+
+
+PROPERTIES = {'pid-voltage': 3.71, 'pid-load': 0.42, 'pid-charge': 0.13}
+NAMES = {'batt_voltage': 'pid-voltage', 'load_current': 'pid-load', 'charge_current': 'pid-charge'}
+
+
+def bench_per_property(server, rounds):
+    """
+    One token and three separate requests per poll, like the old _power_thread.
+    """
+    token = requests.post(server.url + "/oauth/token").json()["access_token"]
+    headers = {"Authorization": "Bearer " + token}
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for pid in PROPERTIES:
+            url = "{}/iot/v2/things/thing/properties/{}".format(server.url, pid)
+            requests.get(url, headers=headers).raise_for_status()
+    return (time.perf_counter() - start) / rounds
+
+
+def bench_bulk(server, rounds, ttl):
+    client = IotTelemetryClient('thing', NAMES, 'id', 'secret', ttl=ttl,
+                                clock=sim_clock.SimClock(fast=True), **server.client_kwargs())
+    client.fetch()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        client.fetch()
+        client.clock.sleep(15)
+    return (time.perf_counter() - start) / rounds
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark telemetry polling against the stand-in server.")
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args(argv)
+
+    server = telemetry_server.start(PROPERTIES)
+    try:
+        results = [
+            ("per-property", bench_per_property(server, args.rounds)),
+            ("bulk keep-alive", bench_bulk(server, args.rounds, ttl=0)),
+            ("bulk + 60s TTL cache", bench_bulk(server, args.rounds, ttl=60)),
+        ]
+    finally:
+        server.shutdown()
+
+    for name, seconds in results:
+        print("{:<22} {:>9.3f} ms/poll".format(name, seconds * 1000))
+    print("token requests: {}".format(server.token_requests))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,416 @@
+"""
+Times the key paths of the simulator and tracks them against a baseline.
+
+Each case is timed in repeats of a loop count calibrated to take about
+--min-time seconds, and the median time per operation is kept. Results are
+written as JSON; comparing against an earlier results file flags the cases
+that got slower by more than --threshold, and exits with status 1 if any did,
+if a case raised, or if a case in the baseline was not run. Cases left out
+with --filter are not counted as missing.
+
+Run from the repository root with::
+
+    python -m benchmarks.suite --save baseline.json
+    python -m benchmarks.suite --compare baseline.json
+    python -m benchmarks.suite --filter directive --list
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import types
+
+import numpy as np
+
+import sim_clock
+import sim_recorder
+from sim_vars import WorldState
+
+
+CASES = {}
+
+
+def case(name):
+    """
+    Registers a case. The decorated function does the setup and returns a
+    function of a loop count that runs the operation that many times, and
+    optionally a teardown function.
+    """
+    def register(setup):
+        CASES[name] = setup
+        return setup
+    return register
+
+
+def _quiet_recorder(clock=None):
+    return sim_recorder.EventRecorder(level=sim_recorder.OFF, clock=clock)
+
+
+def _gadget(**kwargs):
+    import housepet_gadget
+
+    clock = sim_clock.SimClock(fast=True, seed=1)
+    return housepet_gadget.MindstormsGadget(clock=clock, world=WorldState(), telemetry='sim', trace=False,
+                                            recorder=_quiet_recorder(clock), **kwargs)
+
+
+DIRECTIVES = [
+    b'{"type": "move", "direction": "forward", "duration": 1, "speed": 50}',
+    b'{"type": "follow"}',
+    b'{"type": "stopfollow"}',
+    b'{"type": "command", "command": "patrol"}',
+    b'{"type": "move", "direction": "stop", "duration": 0, "speed": 0}',
+]
+
+
+@case("directive.decode")
+def directive_decode():
+    from housepet_gadget import json_loads
+
+    payloads = DIRECTIVES
+
+    def run(loops):
+        for i in range(loops):
+            json_loads(payloads[i % 5])
+    return run
+
+
+@case("directive.dispatch")
+def directive_dispatch():
+    gadget = _gadget()
+    directives = [types.SimpleNamespace(payload=payload) for payload in DIRECTIVES]
+    handle = gadget.on_custom_mindstorms_gadget_control
+
+    def run(loops):
+        for i in range(loops):
+            handle(directives[i % 5])
+    return run, gadget.clock.stop
+
+
+@case("leds.set_color")
+def leds_set_color():
+    from ev3dev2.led import Leds
+
+    leds = Leds(world=WorldState(), recorder=_quiet_recorder())
+    colors = ("GREEN", "RED", "AMBER", "BLACK")
+
+    def run(loops):
+        for i in range(loops):
+            leds.set_color("LEFT", colors[i & 3])
+    return run
+
+
+@case("leds.set_color_unchanged")
+def leds_set_color_unchanged():
+    from ev3dev2.led import Leds
+
+    leds = Leds(world=WorldState(), recorder=_quiet_recorder())
+
+    def run(loops):
+        for _ in range(loops):
+            leds.set_color("LEFT", "GREEN")
+    return run
+
+
+@case("leds.fleet_set_colors")
+def leds_fleet_set_colors():
+    from ev3dev2.led import FleetLeds
+
+    fleet = FleetLeds(1000)
+    colors = np.arange(1000) % 4
+
+    def run(loops):
+        for i in range(loops):
+            fleet.set_colors("LEFT", (colors + i) % 4)
+    return run
+
+
+@case("speed.construct")
+def speed_construct():
+    from ev3dev2.motor import SpeedPercent
+
+    def run(loops):
+        for i in range(loops):
+            SpeedPercent(i % 100)
+    return run
+
+
+@case("speed.compare")
+def speed_compare():
+    from ev3dev2.motor import SpeedPercent
+
+    speeds = [SpeedPercent(25), SpeedPercent(50), SpeedPercent(75), SpeedPercent(100)]
+
+    def run(loops):
+        for i in range(loops):
+            speeds[i & 3] < speeds[(i + 1) & 3]
+    return run
+
+
+@case("sensor.read")
+def sensor_read():
+    from ev3dev2.sensor.lego import ColorSensor, InfraredSensor
+
+    world = WorldState()
+    ir = InfraredSensor(world=world)
+    light = ColorSensor('ev3-ports:in4', world=world)
+
+    def run(loops):
+        for _ in range(loops):
+            ir.heading()
+            light.ambient_light_intensity
+    return run
+
+
+@case("sensor.publish")
+def sensor_publish():
+    from ev3dev2.sensor import bus_for
+
+    world = WorldState()
+    bus_for(world).subscribe('ir_beacon_heading', lambda name, value: None)
+
+    def run(loops):
+        for i in range(loops):
+            world.ir_beacon_heading = i & 7
+    return run
+
+
+@case("sound.play_song")
+def sound_play_song():
+    from ev3dev2.sound import Sound
+    from housepet_gadget import STARTUP_SONG
+
+    clock = sim_clock.SimClock(fast=True)
+    sound = Sound(recorder=_quiet_recorder(clock), clock=clock, wav=False)
+
+    def run(loops):
+        for _ in range(loops):
+            sound.play_song(STARTUP_SONG)
+    return run, clock.stop
+
+
+@case("sentry.process")
+def sentry_process():
+    from sim_sentry import SentryDetector, synthetic
+
+    # 100 ms blocks from 100 robots at 1 kHz
+    traces = synthetic(100, 10000)
+    detector = SentryDetector(100)
+
+    def run(loops):
+        for i in range(loops):
+            offset = (i % 100) * 100
+            detector.process(traces[:, offset:offset + 100])
+    return run
+
+
+@case("gadget.construct")
+def gadget_construct():
+    def run(loops):
+        for _ in range(loops):
+            _gadget().clock.stop()
+    return run
+
+
+EPISODE = {
+    "seed": 1, "duration": 300,
+    "directives": [
+        [1, {"type": "command", "command": "circle"}],
+        [20, {"type": "command", "command": "square"}],
+        [40, {"type": "move", "direction": "forward", "duration": 3, "speed": 50}],
+        [60, {"type": "command", "command": "patrol"}],
+        [200, {"type": "move", "direction": "stop", "duration": 0, "speed": 0}],
+        [210, {"type": "follow"}],
+    ],
+    "sim_vars": {"ir_beacon_heading": [[0, 2], [230, -3], [260, 0]], "touch_bump": [[100, True]]},
+}
+
+
+@case("episode.run")
+def episode_run():
+    import sim_batch
+
+    level = sim_recorder.get_recorder().level
+    sim_recorder.get_recorder().level = sim_recorder.OFF
+
+    def run(loops):
+        for _ in range(loops):
+            sim_batch.run_episode(EPISODE)
+
+    def teardown():
+        sim_recorder.get_recorder().level = level
+    return run, teardown
+
+
+def time_case(setup, min_time=0.2, repeat=5):
+    """
+    Times one case.
+    :return: a dict with the median and best seconds per operation, the
+        loop count and the repeat count
+    """
+    made = setup()
+    run, teardown = made if isinstance(made, tuple) else (made, None)
+    try:
+        # Grow the loop count until one repeat takes min_time
+        loops = 1
+        while True:
+            start = time.perf_counter()
+            run(loops)
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+            loops = max(loops * 2, int(loops * min_time / elapsed * 1.2) if elapsed > 0 else loops * 10)
+
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run(loops)
+            samples.append((time.perf_counter() - start) / loops)
+    finally:
+        if teardown is not None:
+            teardown()
+    return {'seconds': statistics.median(samples), 'best': min(samples), 'loops': loops, 'repeat': repeat}
+
+
+def run_suite(names, min_time=0.2, repeat=5):
+    """
+    Times the named cases. A case that raises is recorded with its error
+    instead of a time.
+    """
+    results = {}
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for name in names:
+            try:
+                results[name] = time_case(CASES[name], min_time, repeat)
+            except Exception as e:
+                results[name] = {'error': "{}: {}".format(type(e).__name__, e)}
+    return results
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'numpy': np.__version__,
+        'commit': _commit(),
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+    }
+
+
+def compare(results, baseline, threshold, expected=None):
+    """
+    Compares results against a baseline results dict.
+    :param threshold: the fractional slowdown counted as a regression
+    :param expected: the case names that were meant to run, defaults to
+        every baseline case. Those without results are reported 'missing'.
+    :return: rows of (name, baseline seconds, seconds, ratio, status)
+    """
+    rows = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if 'error' in result:
+            status = 'error'
+        elif base is None or 'error' in base:
+            status = 'new'
+        else:
+            ratio = result['seconds'] / base['seconds']
+            if ratio > 1 + threshold:
+                status = 'REGRESSION'
+            elif ratio < 1 / (1 + threshold):
+                status = 'faster'
+            else:
+                status = 'ok'
+            rows.append((name, base['seconds'], result['seconds'], ratio, status))
+            continue
+        rows.append((name, base.get('seconds') if base else None, result.get('seconds'), None, status))
+    for name, base in baseline.items():
+        if name not in results and (expected is None or name in expected):
+            rows.append((name, base.get('seconds'), None, None, 'missing'))
+    return rows
+
+
+def _format_time(seconds):
+    if seconds is None:
+        return '-'
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return "{:.2f} {}".format(seconds / scale, unit)
+    return "{:.0f} ns".format(seconds * 1e9)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the simulator benchmark suite.")
+    parser.add_argument("--filter", action="append", help="only run cases whose name contains this, repeatable")
+    parser.add_argument("--list", action="store_true", help="list the cases and exit")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per timed repeat")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--save", metavar="PATH", help="write the results to this JSON file")
+    parser.add_argument("--compare", metavar="PATH", help="compare against a saved results file")
+    parser.add_argument("--threshold", type=float, default=0.15,
+                        help="slowdown against the baseline that counts as a regression (default 0.15)")
+    args = parser.parse_args(argv)
+
+    names = [name for name in CASES if not args.filter or any(f in name for f in args.filter)]
+    if args.list:
+        print("\n".join(names))
+        return 0
+
+    results = run_suite(names, args.min_time, args.repeat)
+    report = {'environment': environment(), 'results': results}
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if not args.compare:
+        for name, result in results.items():
+            if 'error' in result:
+                print("{:<20} {:>12}  {}".format(name, 'error', result['error']))
+            else:
+                print("{:<20} {:>12}  ({} loops x {})".format(name, _format_time(result['seconds']),
+                                                          result['loops'], result['repeat']))
+        return 0
+
+    with open(args.compare) as f:
+        baseline = json.load(f)
+    base_env = baseline.get('environment', {})
+    if base_env.get('python') != report['environment']['python'] or base_env.get('machine') != report['environment']['machine']:
+        print("warning: baseline is from Python {} on {}".format(base_env.get('python'), base_env.get('machine')))
+
+    # Baseline cases filtered out on purpose are not missing
+    base_results = baseline.get('results', {})
+    expected = [name for name in base_results if not args.filter or any(f in name for f in args.filter)]
+    rows = compare(results, base_results, args.threshold, expected)
+    print("{:<20} {:>12} {:>12} {:>7}  {}".format("case", "baseline", "current", "ratio", "status"))
+    for name, base, current, ratio, status in rows:
+        print("{:<20} {:>12} {:>12} {:>7}  {}".format(name, _format_time(base), _format_time(current),
+                                                      "{:.2f}".format(ratio) if ratio is not None else '-', status))
+    failed = False
+    for status, label in (('REGRESSION', "regression(s)"), ('error', "error(s)"), ('missing', "missing case(s)")):
+        names = [row[0] for row in rows if row[4] == status]
+        if names:
+            print("{} {}: {}".format(len(names), label, ", ".join(names)))
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
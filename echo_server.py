@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Echo device end of the gadget link.
+
+Accepts alexa_events.SocketTransport connections, reads one JSON batch of
+events per line and keeps counts and the latest events. Point a gadget at it
+with HOUSEPET_ECHO=127.0.0.1:<port>.
+"""
+
+import argparse
+import collections
+import json
+import socketserver
+import threading
+import time
+
+
+class EchoHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server
+        for line in self.rfile:
+            events = json.loads(line)['events']
+            now = time.monotonic()
+            with server.lock:
+                if server.first_at is None:
+                    server.first_at = now
+                server.last_at = now
+                server.batches += 1
+                server.events += len(events)
+                for event in events:
+                    server.names[event['name']] += 1
+                server.latest.extend(events)
+            if server.verbose:
+                for event in events:
+                    print("Echo: {} {}".format(event['name'], json.dumps(event['payload'])))
+
+
+class EchoStandIn(socketserver.ThreadingTCPServer):
+    """
+    The stand-in server.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=("127.0.0.1", 0), keep=100, verbose=False):
+        """
+        :param keep: how many of the latest events to keep
+        :param verbose: if set, print every event
+        """
+        super().__init__(address, EchoHandler)
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.events = 0
+        self.names = collections.Counter()
+        self.latest = collections.deque(maxlen=keep)
+        self.first_at = None
+        self.last_at = None
+
+    def stats(self):
+        """
+        Returns the batch and event counts and the receive rate in events per
+        second.
+        """
+        with self.lock:
+            elapsed = (self.last_at - self.first_at) if self.first_at is not None else 0
+            return {
+                'batches': self.batches,
+                'events': self.events,
+                'names': dict(self.names),
+                'events_per_sec': self.events / elapsed if elapsed > 0 else 0.0,
+            }
+
+
+def start(address=("127.0.0.1", 0), keep=100, verbose=False):
+    """
+    Starts a stand-in on a background thread and returns it.
+    """
+    server = EchoStandIn(address, keep, verbose)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the Echo device.")
+    parser.add_argument("--port", type=int, default=8090)
+    args = parser.parse_args(argv)
+
+    server = EchoStandIn(("127.0.0.1", args.port), verbose=True)
+    print("Serving on 127.0.0.1:{}".format(server.server_address[1]))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
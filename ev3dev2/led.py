@@ -1,5 +1,18 @@
+"""
+Simulated LEDs.
+
+The brightness of every LED of a Leds is kept in a framebuffer, a NumPy
+array in LEDS order. set_color only writes, records and wakes the power
+model when the brightness actually changes, so setting a color that is
+already shown costs next to nothing. FleetLeds holds the framebuffers of many
+robots as the rows of one array and sets colors for all of them at once.
+"""
+
 from collections import OrderedDict
 
+import numpy as np
+
+import sim_recorder
 import sim_vars
 
 
@@ -23,6 +36,40 @@ LED_COLORS['YELLOW'] = (0.1, 1)
 
 LED_DEFAULT_COLOR = 'GREEN'
 
+# Framebuffer index of each LED, and of each group's LEDs in color tuple order
+LED_INDEX = OrderedDict((name, index) for index, name in enumerate(LEDS))
+GROUP_INDEX = OrderedDict((group, tuple(LED_INDEX[name] for name in names)) for group, names in LED_GROUPS.items())
+
+# Colors by index, for the bulk API
+COLOR_NAMES = tuple(LED_COLORS)
+COLOR_INDEX = {name: index for index, name in enumerate(COLOR_NAMES)}
+COLOR_TABLE = np.array([LED_COLORS[name] for name in COLOR_NAMES], dtype=np.float64)
+
+# (color, pct) to brightness tuples, filled in as they are used
+_levels_cache = {}
+
+
+def color_levels(color, pct=1):
+    """
+    The brightness of each LED of a group for a color name or tuple at a
+    percentage.
+    """
+    try:
+        return _levels_cache[color, pct]
+    except KeyError:
+        pass
+    except TypeError:
+        # An unhashable color, such as a list
+        return tuple(float(value) * pct for value in color)
+
+    color_tuple = color
+    if isinstance(color, str):
+        assert color in LED_COLORS, "%s is an invalid LED color, valid choices are %s" % (
+            color, ', '.join(LED_COLORS.keys()))
+        color_tuple = LED_COLORS[color]
+    levels = _levels_cache[color, pct] = tuple(float(value) * pct for value in color_tuple)
+    return levels
+
 
 class Leds():
     """
@@ -31,10 +78,35 @@ class Leds():
     for more details.
     """
 
-    def __init__(self):
-        self.leds = OrderedDict()
-        self.led_groups = OrderedDict()
+    # A sim_power.PowerModel told before every color change
+    power = None
+
+    def __init__(self, world=None, recorder=None, framebuffer=None):
+        """
+        :param world: the WorldState counting set_color calls, defaults to the sim_vars globals
+        :param recorder: the EventRecorder for color changes, defaults to the shared one
+        :param framebuffer: the array to keep the brightness in, one entry per
+            LEDS entry, such as a row of FleetLeds.framebuffer. Defaults to a
+            new one with every LED off.
+        """
+        self.world = world if world is not None else sim_vars.GLOBAL_WORLD
+        self.recorder = recorder if recorder is not None else sim_recorder.get_recorder()
+        self.framebuffer = framebuffer if framebuffer is not None else np.zeros(len(LEDS))
+        self.leds = LEDS
+        self.led_groups = LED_GROUPS
         self.led_colors = LED_COLORS
+        # Color changes, as opposed to set_color calls
+        self.changes = 0
+
+    @property
+    def framebuffer(self):
+        return self._framebuffer
+
+    @framebuffer.setter
+    def framebuffer(self, framebuffer):
+        # Single elements are much quicker to get and set through a memoryview
+        self._framebuffer = framebuffer
+        self._pixels = memoryview(framebuffer)
 
     def set_color(self, group, color, pct=1):
         """
@@ -44,7 +116,128 @@ class Leds():
         Example::
             my_leds = Leds()
             my_leds.set_color('LEFT', 'AMBER')
+        :return: whether any LED changed
+        """
+        self.world.led_count = self.world.led_count + 1
+        red, green = color_levels(color, pct)
+        red_index, green_index = GROUP_INDEX[group]
+        pixels = self._pixels
+        if pixels[red_index] == red and pixels[green_index] == green:
+            return False
+
+        if self.power is not None:
+            self.power.update()
+        pixels[red_index] = red
+        pixels[green_index] = green
+        self.changes += 1
+        self.recorder.led(group, color)
+        return True
+
+    def all_off(self):
+        for group in LED_GROUPS:
+            self.set_color(group, 'BLACK')
+
+    def brightness(self, name):
+        """
+        The brightness of one LED, from 0 to 1.
+        """
+        return self._pixels[LED_INDEX[name]]
+
+    def group_brightness(self, group):
+        """
+        The brightness of a group's LEDs, in color tuple order.
         """
+        pixels = self._pixels
+        return tuple(pixels[index] for index in GROUP_INDEX[group])
 
-        print("LED: ", group, "is", color)
-        sim_vars.led_count = sim_vars.led_count + 1
+    def get_color(self, group):
+        """
+        The name of the color a group shows at full brightness, or its
+        brightness tuple if it shows no named color.
+        """
+        levels = self.group_brightness(group)
+        for name, color in LED_COLORS.items():
+            if levels == color:
+                return name
+        return levels
+
+
+class FleetLeds():
+    """
+    The LED framebuffers of many robots, as the rows of one array.
+    """
+
+    def __init__(self, robots):
+        self.framebuffer = np.zeros((robots, len(LEDS)))
+        # Robot LED changes made through set_colors
+        self.changes = 0
+        self._seen = self.framebuffer.copy()
+
+    def __len__(self):
+        return len(self.framebuffer)
+
+    def leds(self, robot, world=None, recorder=None):
+        """
+        A Leds for one robot, backed by its row.
+        """
+        return Leds(world, recorder, framebuffer=self.framebuffer[robot])
+
+    def adopt(self, robot, leds):
+        """
+        Moves an existing Leds onto a robot's row, keeping its colors.
+        """
+        row = self.framebuffer[robot]
+        row[:] = leds.framebuffer
+        leds.framebuffer = row
+
+    def set_colors(self, group, colors, robots=None, pct=1):
+        """
+        Sets a group's color on many robots with one NumPy operation. Robots
+        already showing their color are not written. Unlike Leds.set_color
+        this does not record or notify power models.
+        :param group: the LED group, such as 'LEFT'
+        :param colors: one color name for all the robots, or an array of
+            color names or COLOR_NAMES indices, one per robot
+        :param robots: the robot indices or a bool mask, defaults to all
+        :param pct: the brightness, one for all or one per robot
+        :return: the number of robots whose LEDs changed
+        """
+        if robots is None:
+            rows = np.arange(len(self.framebuffer))
+        else:
+            rows = np.asarray(robots)
+            if rows.dtype == bool:
+                rows = np.flatnonzero(rows)
+
+        if isinstance(colors, str):
+            colors = COLOR_INDEX[colors]
+        else:
+            colors = np.asarray(colors)
+            if colors.dtype.kind in 'UO':
+                colors = np.array([COLOR_INDEX[name] for name in colors.tolist()])
+        levels = COLOR_TABLE[colors] * np.asarray(pct, dtype=np.float64)[..., None]
+
+        columns = np.array(GROUP_INDEX[group])
+        current = self.framebuffer[rows[:, None], columns]
+        levels = np.broadcast_to(levels, current.shape)
+        changed = np.any(current != levels, axis=1)
+        count = int(np.count_nonzero(changed))
+        if count:
+            self.framebuffer[rows[changed][:, None], columns] = levels[changed]
+            self.changes += count
+        return count
+
+    def group_brightness(self, group):
+        """
+        A (robots, LEDs in the group) array of a group's brightness.
+        """
+        return self.framebuffer[:, GROUP_INDEX[group]]
+
+    def take_changed(self):
+        """
+        The indices of the robots whose LEDs changed, by any means, since the
+        last call.
+        """
+        changed = np.flatnonzero(np.any(self.framebuffer != self._seen, axis=1))
+        self._seen[changed] = self.framebuffer[changed]
+        return changed
@@ -1,3 +1,10 @@
+import abc
+import math
+
+import numpy as np
+
+import sim_clock
+import sim_recorder
 import sim_vars
 
 OUTPUT_A = 'ev3-ports:outA'
@@ -5,41 +12,140 @@ OUTPUT_B = 'ev3-ports:outB'
 OUTPUT_C = 'ev3-ports:outC'
 OUTPUT_D = 'ev3-ports:outD'
 
+# Drive geometry of the pet, in metres
+WHEEL_DIAMETER = 0.056
+AXLE_TRACK = 0.12
+
 
-class SpeedValue(object):
+class SpeedValue(abc.ABC):
     """
     A base class for other unit types. Don't use this directly; instead, see
     :class:`SpeedPercent`, :class:`SpeedRPS`, :class:`SpeedRPM`,
     :class:`SpeedDPS`, and :class:`SpeedDPM`.
+
+    Speeds compare without a motor. Absolute speeds compare with each other in
+    degrees per second; a SpeedPercent only compares with other percentages,
+    and a SpeedNativeUnits with other native speeds, since how they relate to
+    the rest depends on the motor.
     """
 
+    __slots__ = ()
+
+    # The attribute holding the value, and what one unit is in degrees per
+    # second, or None if that depends on the motor
+    _field = None
+    _dps = None
+
+    @property
+    def value(self):
+        return getattr(self, self._field)
+
+    def _key(self):
+        if self._dps is None:
+            return type(self), self.value
+        return SpeedValue, self.value * self._dps
+
+    def _compare_key(self, other):
+        field = self._field
+        if type(other) is type(self):
+            return getattr(self, field), getattr(other, field)
+        if not isinstance(other, SpeedValue):
+            return NotImplemented
+        key = self._key()
+        other_key = other._key()
+        if key[0] is not other_key[0]:
+            raise TypeError("cannot compare {} with {} without a motor, compare their to_native_units(motor)".format(
+                type(self).__name__, type(other).__name__))
+        return key[1], other_key[1]
+
     def __eq__(self, other):
-        return self.to_native_units() == other.to_native_units()
+        if not isinstance(other, SpeedValue):
+            return NotImplemented
+        key = self._key()
+        return key == other._key()
 
     def __ne__(self, other):
-        return not self.__eq__(other)
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        return hash(self._key())
 
     def __lt__(self, other):
-        return self.to_native_units() < other.to_native_units()
+        keys = self._compare_key(other)
+        if keys is NotImplemented:
+            return keys
+        return keys[0] < keys[1]
 
     def __le__(self, other):
-        return self.to_native_units() <= other.to_native_units()
+        keys = self._compare_key(other)
+        if keys is NotImplemented:
+            return keys
+        return keys[0] <= keys[1]
 
     def __gt__(self, other):
-        return self.to_native_units() > other.to_native_units()
+        keys = self._compare_key(other)
+        if keys is NotImplemented:
+            return keys
+        return keys[0] > keys[1]
 
     def __ge__(self, other):
-        return self.to_native_units() >= other.to_native_units()
+        keys = self._compare_key(other)
+        if keys is NotImplemented:
+            return keys
+        return keys[0] >= keys[1]
 
     def __rmul__(self, other):
         return self.__mul__(other)
 
+    def __mul__(self, other):
+        assert isinstance(other, (float, int)), "{} can only be multiplied by an int or float".format(self)
+        return type(self)(self.value * other)
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.value)
+
+    @staticmethod
+    @abc.abstractmethod
+    def _native(value, motor):
+        """
+        Converts a value or an array of values in this unit to tacho counts
+        per second on the given motor.
+        """
+
+    def to_native_units(self, motor):
+        """
+        Return this speed in native motor units
+        """
+        native = self._native(self.value, motor)
+        assert -motor.max_speed <= native <= motor.max_speed,\
+            "{} is an invalid speed, the most is {} counts/sec".format(self, motor.max_speed)
+        return native
+
+    @classmethod
+    def to_native_array(cls, values, motor):
+        """
+        Converts an array of speeds in this unit to native motor units at
+        once, without making a SpeedValue for each.
+        :param values: the speeds, as anything numpy.asarray takes
+        :param motor: the motor, or motor class, they are for
+        :return: a float64 array of tacho counts per second
+        """
+        native = cls._native(np.asarray(values, dtype=np.float64), motor)
+        assert native.size == 0 or np.abs(native).max() <= motor.max_speed,\
+            "{} speeds beyond {} counts/sec".format(int(np.count_nonzero(np.abs(native) > motor.max_speed)),
+                                                   motor.max_speed)
+        return native
+
 
 class SpeedPercent(SpeedValue):
     """
     Speed as a percentage of the motor's maximum rated speed.
     """
 
+    __slots__ = ('percent',)
+    _field = 'percent'
+
     def __init__(self, percent):
         assert -100 <= percent <= 100,\
             "{} is an invalid percentage, must be between -100 and 100 (inclusive)".format(percent)
@@ -49,9 +155,9 @@ class SpeedPercent(SpeedValue):
     def __str__(self):
         return str(self.percent) + "%"
 
-    def __mul__(self, other):
-        assert isinstance(other, (float, int)), "{} can only be multiplied by an int or float".format(self)
-        return SpeedPercent(self.percent * other)
+    @staticmethod
+    def _native(value, motor):
+        return value / 100 * motor.max_speed
 
     def to_native_units(self, motor):
         """
@@ -60,27 +166,460 @@ class SpeedPercent(SpeedValue):
         return self.percent / 100 * motor.max_speed
 
 
+class SpeedNativeUnits(SpeedValue):
+    """
+    Speed in tacho counts per second.
+    """
+
+    __slots__ = ('native_counts',)
+    _field = 'native_counts'
+
+    def __init__(self, native_counts):
+        self.native_counts = native_counts
+
+    def __str__(self):
+        return "{} counts/sec".format(self.native_counts)
+
+    @staticmethod
+    def _native(value, motor):
+        return value
+
+    def to_native_units(self, motor=None):
+        """
+        Return this SpeedNativeUnits as a number
+        """
+        return self.native_counts
+
+
+class SpeedRPS(SpeedValue):
+    """
+    Speed in rotations-per-second.
+    """
+
+    __slots__ = ('rotations_per_second',)
+    _field = 'rotations_per_second'
+    _dps = 360.0
+
+    def __init__(self, rotations_per_second):
+        self.rotations_per_second = rotations_per_second
+
+    def __str__(self):
+        return str(self.rotations_per_second) + " rot/sec"
+
+    @staticmethod
+    def _native(value, motor):
+        return value * motor.count_per_rot
+
+
+class SpeedRPM(SpeedValue):
+    """
+    Speed in rotations-per-minute.
+    """
+
+    __slots__ = ('rotations_per_minute',)
+    _field = 'rotations_per_minute'
+    _dps = 6.0
+
+    def __init__(self, rotations_per_minute):
+        self.rotations_per_minute = rotations_per_minute
+
+    def __str__(self):
+        return str(self.rotations_per_minute) + " rot/min"
+
+    @staticmethod
+    def _native(value, motor):
+        return value / 60 * motor.count_per_rot
+
+
+class SpeedDPS(SpeedValue):
+    """
+    Speed in degrees-per-second.
+    """
+
+    __slots__ = ('degrees_per_second',)
+    _field = 'degrees_per_second'
+    _dps = 1.0
+
+    def __init__(self, degrees_per_second):
+        self.degrees_per_second = degrees_per_second
+
+    def __str__(self):
+        return str(self.degrees_per_second) + " deg/sec"
+
+    @staticmethod
+    def _native(value, motor):
+        return value / 360 * motor.count_per_rot
+
+
+class SpeedDPM(SpeedValue):
+    """
+    Speed in degrees-per-minute.
+    """
+
+    __slots__ = ('degrees_per_minute',)
+    _field = 'degrees_per_minute'
+    _dps = 1 / 60
+
+    def __init__(self, degrees_per_minute):
+        self.degrees_per_minute = degrees_per_minute
+
+    def __str__(self):
+        return str(self.degrees_per_minute) + " deg/min"
+
+    @staticmethod
+    def _native(value, motor):
+        return value / 21600 * motor.count_per_rot
+
+
+def speeds_to_native(values, motor, unit=SpeedPercent):
+    """
+    Converts an array of speeds to native motor units for a motor, see
+    SpeedValue.to_native_array.
+    :param unit: the SpeedValue class the values are in, by default percentages
+    """
+    return unit.to_native_array(values, motor)
+
+
+class Motor(object):
+    """
+    A simulated tacho motor. The motor runs at a constant speed between
+    commands and its tacho count is worked out from the simulation clock when
+    read, so nothing has to tick while it runs.
+    """
+
+    max_speed = 1050
+    count_per_rot = 360
+
+    # A sim_power.PowerModel told before every speed change
+    power = None
+    # The _Odometry of the drives using the motor
+    odometry = None
+
+    def __init__(self, address=None, clock=None, recorder=None):
+        self.address = address
+        self.clock = clock if clock is not None else sim_clock.get_clock()
+        self.recorder = recorder if recorder is not None else sim_recorder.get_recorder()
+        self._position = 0.0
+        self._speed = 0.0
+        self._t0 = self.clock.now()
+        self._t1 = None
+
+    @property
+    def position(self):
+        """
+        The tacho count in degrees.
+        """
+        return int(round(self._position_at(self.clock.now())))
+
+    @property
+    def speed(self):
+        """
+        The current speed in tacho counts per second.
+        """
+        return self.speed_at(self.clock.now())
+
+    @property
+    def is_running(self):
+        return self.speed != 0
+
+    def speed_at(self, when):
+        if self._t1 is not None and when >= self._t1:
+            return 0.0
+        return self._speed
+
+    def stop_time(self):
+        """
+        The time at which the current command ends, or None if it runs forever.
+        """
+        return self._t1 if self._speed else None
+
+    def _position_at(self, when):
+        end = when if self._t1 is None else min(when, self._t1)
+        return self._position + self._speed * max(end - self._t0, 0)
+
+    def _run(self, speed, seconds=None):
+        if self.power is not None:
+            self.power.update()
+        now = self.clock.now()
+        self._position = self._position_at(now)
+        self._speed = speed
+        self._t0 = now
+        self._t1 = None if seconds is None else now + seconds
+        self.recorder.motor(self.address, 'speed', speed)
+        if seconds is not None:
+            self.recorder.motor(self.address, 'seconds', seconds)
+
+    def run_forever(self, speed):
+        """
+        Runs at the given speed in tacho counts per second until stopped.
+        """
+        self._run(speed)
+
+    def run_timed(self, speed, seconds):
+        """
+        Runs at the given speed in tacho counts per second for a duration.
+        """
+        self._run(speed, seconds)
+
+    def stop(self):
+        self._run(0.0)
+
+    def on(self, speed, brake=True, block=False):
+        self.run_forever(_speed_native_units(speed, self))
+
+    def on_for_seconds(self, speed, seconds, brake=True, block=True):
+        self.run_timed(_speed_native_units(speed, self), seconds)
+        if block:
+            self.clock.sleep(seconds)
+
+    def on_for_rotations(self, speed, rotations, brake=True, block=True):
+        native = _speed_native_units(speed, self)
+        seconds = abs(rotations * self.count_per_rot / native) if native else 0
+        self.run_timed(-native if rotations < 0 else native, seconds)
+        if block:
+            self.clock.sleep(seconds)
+
+    def off(self, brake=True):
+        self.stop()
+
+
+class LargeMotor(Motor):
+    """
+    EV3 large servo motor.
+    """
+
+    max_speed = 1050
+
+
+class MediumMotor(Motor):
+    """
+    EV3 medium servo motor.
+    """
+
+    max_speed = 1560
+
+
+def _speed_native_units(speed, motor):
+    """
+    Converts a SpeedValue, or a plain number taken as a percentage, to tacho
+    counts per second for the given motor.
+    """
+    if isinstance(speed, SpeedValue):
+        return speed.to_native_units(motor)
+    assert -100 <= speed <= 100,\
+        "{} is an invalid percentage, must be between -100 and 100 (inclusive)".format(speed)
+    return speed / 100 * motor.max_speed
+
+
+class _Odometry():
+    """
+    The pose of the robot a pair of motors drives, in its WorldState.
+
+    The pose is integrated in fixed steps of TICK seconds. Motor speeds only
+    change at command boundaries, so a run of constant speed spanning many
+    ticks is advanced with one exact arc update instead of tick by tick, and
+    before a command changes the speeds the pose is brought exactly up to
+    the current time at the old ones.
+    """
+
+    TICK = 0.01
+
+    def __init__(self, left_motor, right_motor, world, clock):
+        self.left_motor = left_motor
+        self.right_motor = right_motor
+        self.world = world
+        self.clock = clock
+        self.time = clock.now()
+
+    def update(self, exact=False):
+        """
+        Advances the pose in whole ticks up to the current time, stopping
+        exactly where a motor stops.
+        :param exact: if set, also advance the part of a tick left over, as
+            must be done before the motor speeds change
+        """
+        now = self.clock.now()
+        while True:
+            end = None
+            for motor in (self.left_motor, self.right_motor):
+                stop = motor.stop_time()
+                if stop is not None and self.time < stop <= now and (end is None or stop < end):
+                    end = stop
+
+            if end is not None:
+                self._advance(end - self.time)
+                continue
+
+            ticks = int((now - self.time) / self.TICK + 1e-9)
+            if ticks <= 0:
+                if exact and now > self.time:
+                    self._advance(now - self.time)
+                return
+            self._advance(ticks * self.TICK)
+
+    def _advance(self, seconds):
+        left = self.left_motor.speed_at(self.time)
+        right = self.right_motor.speed_at(self.time)
+        self.time += seconds
+        if not left and not right:
+            return
+
+        metres_per_count = math.pi * WHEEL_DIAMETER / self.left_motor.count_per_rot
+        v = (left + right) / 2 * metres_per_count
+        w = (right - left) * metres_per_count / AXLE_TRACK
+        world = self.world
+        theta = world.pose_theta
+        theta1 = theta + w * seconds
+        if abs(w) > 1e-9:
+            world.pose_x += v / w * (math.sin(theta1) - math.sin(theta))
+            world.pose_y -= v / w * (math.cos(theta1) - math.cos(theta))
+        else:
+            world.pose_x += v * seconds * math.cos(theta)
+            world.pose_y += v * seconds * math.sin(theta)
+        world.pose_theta = theta1
+
+
 class MoveTank():
     """
-    MoveTank Class
+    Controls a pair of motors as a differential drive and tracks the pose of
+    the robot in its WorldState. Drives built on the same motors share the
+    motors' state and the pose, so stopping one stops the others.
     """
 
-    def __init__(self):
+    def __init__(self, left_motor_port, right_motor_port, desc=None, motor_class=LargeMotor, world=None, clock=None,
+                 recorder=None):
+        """
+        :param left_motor_port: the port of the left motor, or the Motor itself
+        :param right_motor_port: the port of the right motor, or the Motor itself
+        :param motor_class: the class of motors made for ports
+        :param world: the WorldState holding the pose, defaults to the sim_vars globals
+        :param clock: the simulation clock, defaults to the shared sim_clock clock
+        :param recorder: the EventRecorder for motor commands, defaults to the shared one
+        """
+        self.clock = clock if clock is not None else sim_clock.get_clock()
+        self.world = world if world is not None else sim_vars.GLOBAL_WORLD
+        self.left_motor = self._motor(left_motor_port, motor_class, recorder)
+        self.right_motor = self._motor(right_motor_port, motor_class, recorder)
+        self.max_speed = self.left_motor.max_speed
+
+        odometry = self.left_motor.odometry
+        if odometry is None or odometry.right_motor is not self.right_motor or odometry.world is not self.world:
+            odometry = _Odometry(self.left_motor, self.right_motor, self.world, self.clock)
+            self.left_motor.odometry = self.right_motor.odometry = odometry
+        self._odometry = odometry
+
+    def _motor(self, motor, motor_class, recorder):
+        if isinstance(motor, Motor):
+            return motor
+        return motor_class(motor, clock=self.clock, recorder=recorder)
+
+    def on(self, left_speed, right_speed):
         """
-        A temp class.
+        Starts both motors at the given speeds until stopped.
         """
+        self._update_pose(exact=True)
+        self.left_motor.run_forever(_speed_native_units(left_speed, self.left_motor))
+        self.right_motor.run_forever(_speed_native_units(right_speed, self.right_motor))
 
-class MoveSteering():
+    def on_for_seconds(self, left_speed, right_speed, seconds, brake=True, block=True):
+        """
+        Runs both motors at the given speeds for a duration.
+        :param block: if set, return once the motors have stopped
+        """
+        self._update_pose(exact=True)
+        self.left_motor.run_timed(_speed_native_units(left_speed, self.left_motor), seconds)
+        self.right_motor.run_timed(_speed_native_units(right_speed, self.right_motor), seconds)
+        if block:
+            self.clock.sleep(seconds)
+
+    def on_for_rotations(self, left_speed, right_speed, rotations, brake=True, block=True):
+        """
+        Runs both motors until the faster one has turned the given number of
+        rotations. The slower motor turns proportionally less.
+        :param block: if set, return once the motors have stopped
+        """
+        left = _speed_native_units(left_speed, self.left_motor)
+        right = _speed_native_units(right_speed, self.right_motor)
+        fastest = max(abs(left), abs(right))
+        seconds = abs(rotations) * self.left_motor.count_per_rot / fastest if fastest else 0
+        if rotations < 0:
+            left, right = -left, -right
+
+        self._update_pose(exact=True)
+        self.left_motor.run_timed(left, seconds)
+        self.right_motor.run_timed(right, seconds)
+        if block:
+            self.clock.sleep(seconds)
+
+    def on_for_degrees(self, left_speed, right_speed, degrees, brake=True, block=True):
+        self.on_for_rotations(left_speed, right_speed, degrees / 360, brake, block)
+
+    def off(self, brake=True):
+        self._update_pose(exact=True)
+        self.left_motor.stop()
+        self.right_motor.stop()
+
+    @property
+    def is_running(self):
+        return self.left_motor.is_running or self.right_motor.is_running
+
+    def time_left(self):
+        """
+        Seconds until both motors have finished their timed commands.
+        """
+        now = self.clock.now()
+        stops = [motor.stop_time() for motor in (self.left_motor, self.right_motor)]
+        return max([stop - now for stop in stops if stop is not None] + [0])
+
+    @property
+    def pose(self):
+        """
+        The robot pose (x, y, theta) in metres and radians.
+        """
+        self._update_pose()
+        return self.world.pose_x, self.world.pose_y, self.world.pose_theta
+
+    def _update_pose(self, exact=False):
+        self._odometry.update(exact)
+
+
+class MoveSteering(MoveTank):
     """
-    MoveSteering Class
+    Controls a pair of motors with a single steering value, -100 (spin left)
+    to 100 (spin right).
     """
 
-    def __init__(self, left_motor_port, right_motor_port,):
+    def get_speed_steering(self, steering, speed):
         """
-        Move steering class.
+        Returns the left and right motor speeds, in native units, for a
+        steering value and speed.
         """
+        assert -100 <= steering <= 100,\
+            "{} is an invalid steering, must be between -100 and 100 (inclusive)".format(steering)
+
+        speed = _speed_native_units(speed, self.left_motor)
+        left_speed = speed
+        right_speed = speed
+        speed_factor = (50 - abs(float(steering))) / 50
+
+        if steering >= 0:
+            right_speed *= speed_factor
+        else:
+            left_speed *= speed_factor
+
+        return left_speed, right_speed
 
     def on_for_rotations(self, steering, speed, rotations, brake=True, block=True):
         """
         Turns the tank treads on for a few rotations.
-        """
\ No newline at end of file
+        """
+        left_speed, right_speed = self.get_speed_steering(steering, speed)
+        MoveTank.on_for_rotations(self, SpeedNativeUnits(left_speed), SpeedNativeUnits(right_speed), rotations, brake, block)
+
+    def on_for_seconds(self, steering, speed, seconds, brake=True, block=True):
+        left_speed, right_speed = self.get_speed_steering(steering, speed)
+        MoveTank.on_for_seconds(self, SpeedNativeUnits(left_speed), SpeedNativeUnits(right_speed), seconds, brake, block)
+
+    def on(self, steering, speed):
+        left_speed, right_speed = self.get_speed_steering(steering, speed)
+        MoveTank.on(self, SpeedNativeUnits(left_speed), SpeedNativeUnits(right_speed))
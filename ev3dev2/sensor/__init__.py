@@ -0,0 +1,132 @@
+"""
+Publish/subscribe bus for simulated sensor values.
+
+WorldState publishes every change of a sensor field on its bus. Sensors wait
+for a value with SensorBus.wait_for, which blocks on a sim_clock.ClockEvent
+instead of polling, so a waiting thread wakes as soon as the value changes and
+uses no CPU in between. Coroutines use SensorBus.wait_for_async, which waits
+on an asyncio future.
+
+Writes the gadget makes to its own world, such as the touch sensor consuming
+a bump, go through SensorBus.set_own. Subscribers are told about them as
+usual, and can check SensorBus.own to tell them from inputs from outside.
+"""
+
+import threading
+
+import sim_clock
+
+
+class SensorBus():
+    """
+    Delivers sensor value changes of one WorldState to subscribers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._local = threading.local()
+
+    def subscribe(self, name, callback):
+        """
+        Calls callback(name, value) whenever the named value changes. The
+        callback runs on the publishing thread and must not block.
+        """
+        with self._lock:
+            callbacks = list(self._subscribers.get(name, ()))
+            callbacks.append(callback)
+            self._subscribers[name] = callbacks
+
+    def unsubscribe(self, name, callback):
+        with self._lock:
+            callbacks = list(self._subscribers.get(name, ()))
+            if callback in callbacks:
+                callbacks.remove(callback)
+            self._subscribers[name] = callbacks
+
+    def publish(self, name, value):
+        # Subscriber lists are replaced rather than mutated, so no lock is
+        # needed to walk them
+        for callback in self._subscribers.get(name, ()):
+            callback(name, value)
+
+    @property
+    def own(self):
+        """
+        Whether the change being published was made by the gadget itself.
+        """
+        return getattr(self._local, 'own', False)
+
+    def set_own(self, world, name, value):
+        """
+        Sets a value of the world on behalf of the gadget itself.
+        """
+        self._local.own = True
+        try:
+            setattr(world, name, value)
+        finally:
+            self._local.own = False
+
+    def wait_for(self, world, name, predicate, timeout=None, clock=None):
+        """
+        Waits until predicate holds for the named value of the world.
+        :param world: the WorldState holding the value
+        :param name: the value name
+        :param predicate: called with the value
+        :param timeout: the longest simulated time to wait, or None
+        :param clock: the clock to wait on, defaults to the shared one
+        :return: the value, or None on timeout
+        """
+        value = getattr(world, name)
+        if predicate(value):
+            return value
+
+        clock = clock if clock is not None else sim_clock.get_clock()
+        event = sim_clock.ClockEvent()
+        callback = lambda changed, new_value: predicate(new_value) and event.set()
+        self.subscribe(name, callback)
+        try:
+            # Re-check in case the value changed before we subscribed
+            value = getattr(world, name)
+            if predicate(value):
+                return value
+            if not clock.wait(event, timeout):
+                return None
+            return getattr(world, name)
+        finally:
+            self.unsubscribe(name, callback)
+
+    async def wait_for_async(self, world, name, predicate, timeout=None):
+        """
+        Like wait_for, but waits on the running event loop.
+        """
+        value = getattr(world, name)
+        if predicate(value):
+            return value
+
+        event = sim_clock.ClockEvent()
+        callback = lambda changed, new_value: predicate(new_value) and event.set()
+        self.subscribe(name, callback)
+        try:
+            value = getattr(world, name)
+            if predicate(value):
+                return value
+            if not await event.wait_async(timeout):
+                return None
+            return getattr(world, name)
+        finally:
+            self.unsubscribe(name, callback)
+
+
+_bus_lock = threading.Lock()
+
+
+def bus_for(world):
+    """
+    Returns the sensor bus of a WorldState, creating it on first use.
+    """
+    if world.bus is None:
+        with _bus_lock:
+            if world.bus is None:
+                world.bus = SensorBus()
+    return world.bus
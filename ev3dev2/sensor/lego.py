@@ -1,5 +1,11 @@
-import time
+import collections
+import math
+
+import numpy as np
+
+import sim_clock
 import sim_vars
+from ev3dev2.sensor import bus_for
 
 
 class InfraredSensor():
@@ -7,14 +13,132 @@ class InfraredSensor():
     Infrared sensor simulator
     """
 
-    def __init__(self):
+    def __init__(self, world=None, clock=None):
         self.mode = 'IR-Seek'
+        self.world = world if world is not None else sim_vars.GLOBAL_WORLD
+        self.clock = clock
 
     def heading(self):
         """
         Gets the simulated heading to the beacon
         """
-        return sim_vars.ir_beacon_heading
+        return self.world.ir_beacon_heading
+
+    @property
+    def proximity(self):
+        """
+        Gets the simulated proximity of the nearest object, from 0 (touching)
+        to 100 (about 70 cm or further).
+        """
+        return self.world.ir_proximity
+
+    def proximity_stream(self, rate=1000.0, noise=0.0, seed=None):
+        """
+        Returns a ProximityStream sampling this sensor's proximity.
+        """
+        return ProximityStream(self.world, self.clock, rate, noise, seed)
+
+    def wait_for_heading_change(self, timeout=None):
+        """
+        Waits until the heading differs from its current value.
+        :param timeout: the longest simulated time to wait, or None
+        :return: the new heading, or None on timeout
+        """
+        current = self.world.ir_beacon_heading
+        return bus_for(self.world).wait_for(self.world, 'ir_beacon_heading', lambda heading: heading != current,
+                                              timeout, self.clock)
+
+    async def wait_for_heading_change_async(self, timeout=None):
+        current = self.world.ir_beacon_heading
+        return await bus_for(self.world).wait_for_async(self.world, 'ir_beacon_heading',
+                                                          lambda heading: heading != current, timeout)
+
+
+class ProximityStream():
+    """
+    Samples the IR proximity at a fixed rate, as the sensor's driver would,
+    for a reader that takes the samples in blocks. A read returns at most
+    max_block samples, the latest ones, so only the proximity changes that
+    can still show in those are kept, and memory stays bounded however late
+    a read is.
+    """
+
+    def __init__(self, world=None, clock=None, rate=1000.0, noise=0.0, seed=None, max_block=10000):
+        """
+        :param world: the WorldState to sample, defaults to the sim_vars globals
+        :param clock: the clock to sample on, defaults to the shared sim_clock clock
+        :param rate: samples per second
+        :param noise: the standard deviation of Gaussian noise added to the samples
+        :param seed: seed for the noise, defaults to the clock's seed
+        :param max_block: the most samples one read returns
+        """
+        self.world = world if world is not None else sim_vars.GLOBAL_WORLD
+        self.clock = clock if clock is not None else sim_clock.get_clock()
+        self.rate = rate
+        self.noise = noise
+        self.max_block = max_block
+        self.dropped = 0
+        self._rng = np.random.default_rng(seed if seed is not None else self.clock.seed) if noise else None
+        self._changes = collections.deque()
+        self._value = self.world.ir_proximity
+        self._next = self.clock.now()
+        bus_for(self.world).subscribe('ir_proximity', self._changed)
+
+    def _changed(self, name, value):
+        now = self.clock.now()
+        changes = self._changes
+        if changes and changes[-1][0] == now:
+            changes[-1] = (now, value)
+        else:
+            changes.append((now, value))
+        # No later read goes back further than max_block samples, so older
+        # changes only set the value those start from
+        horizon = now - (self.max_block + 1) / self.rate
+        while changes[0][0] <= horizon:
+            self._value = changes.popleft()[1]
+
+    def reset(self):
+        """
+        Skips the samples up to now.
+        """
+        self.read()
+        self.dropped = 0
+
+    def read(self):
+        """
+        Returns the samples due since the last read as a float array.
+        """
+        count = math.floor((self.clock.now() - self._next) * self.rate) + 1
+        if count <= 0:
+            return np.empty(0)
+        if count > self.max_block:
+            self.dropped += count - self.max_block
+            self._next += (count - self.max_block) / self.rate
+            count = self.max_block
+        times = self._next + np.arange(count) / self.rate
+        self._next += count / self.rate
+
+        # The value in force at each sample time, from the changes seen
+        changes = self._changes
+        taken = 0
+        while taken < len(changes) and changes[taken][0] <= times[-1]:
+            taken += 1
+        if taken:
+            change_times = np.array([changes[i][0] for i in range(taken)])
+            values = np.array([self._value] + [changes[i][1] for i in range(taken)], dtype=np.float64)
+            samples = values[np.searchsorted(change_times, times, side='right')]
+            self._value = changes[taken - 1][1]
+            for _ in range(taken):
+                changes.popleft()
+        else:
+            samples = np.full(count, float(self._value))
+
+        if self._rng is not None:
+            samples += self._rng.normal(0.0, self.noise, count)
+        return samples
+
+    def close(self):
+        bus_for(self.world).unsubscribe('ir_proximity', self._changed)
 
 
 class TouchSensor():
@@ -22,16 +146,29 @@ class TouchSensor():
     Touch sensor simulator
     """
 
-    def __init__(self):
+    def __init__(self, world=None, clock=None):
         self.mode = 'IR-Seek'
+        self.world = world if world is not None else sim_vars.GLOBAL_WORLD
+        self.clock = clock
 
-    def wait_for_bump(self):
+    def wait_for_bump(self, timeout=None):
         """
-        Waits for a simulated bump.
+        Waits for a simulated bump. The bump is consumed so that each one is
+        reported once.
+        :param timeout: the longest simulated time to wait, or None
+        :return: whether there was a bump
         """
-        while not(sim_vars.touch_bump):
-            time.sleep(0.1)
-        
+        if not bus_for(self.world).wait_for(self.world, 'touch_bump', bool, timeout, self.clock):
+            return False
+
+        bus_for(self.world).set_own(self.world, 'touch_bump', False)
+        return True
+
+    async def wait_for_bump_async(self, timeout=None):
+        if not await bus_for(self.world).wait_for_async(self.world, 'touch_bump', bool, timeout):
+            return False
+
+        bus_for(self.world).set_own(self.world, 'touch_bump', False)
         return True
 
 
@@ -40,7 +177,36 @@ class ColorSensor():
     Color sensor simulator
     """
 
-    def __init__(self, address):
+    def __init__(self, address, world=None, clock=None):
         self.mode = 'COL-AMBIENT'
-        self.ambient_light_intensity = 0
+        self.world = world if world is not None else sim_vars.GLOBAL_WORLD
+        self.clock = clock
+
+    @property
+    def ambient_light_intensity(self):
+        """
+        Gets the simulated ambient light intensity
+        """
+        return self.world.ambient_light_intensity
+
+    @ambient_light_intensity.setter
+    def ambient_light_intensity(self, value):
+        # Callers used to assign the reading directly, so it writes through
+        # to the world, where waiters and subscribers see it
+        self.world.ambient_light_intensity = value
+
+    def wait_for_ambient_change(self, timeout=None):
+        """
+        Waits until the ambient light intensity differs from its current value.
+        :param timeout: the longest simulated time to wait, or None
+        :return: the new intensity, or None on timeout
+        """
+        current = self.world.ambient_light_intensity
+        return bus_for(self.world).wait_for(self.world, 'ambient_light_intensity', lambda value: value != current,
+                                              timeout, self.clock)
+
+    async def wait_for_ambient_change_async(self, timeout=None):
+        current = self.world.ambient_light_intensity
+        return await bus_for(self.world).wait_for_async(self.world, 'ambient_light_intensity',
+                                                          lambda value: value != current, timeout)
 
@@ -1,11 +1,252 @@
+"""
+Simulated sound driver.
+
+Songs are rendered to 16-bit mono PCM with NumPy. The waveform of each note is
+cached by its frequency and length, and each whole song by its notes and
+timing, so a jingle played again, in this episode or a later one in the same
+process, is not rendered again. Playing a song takes its duration on the
+sound's clock. Given a WAV path, everything played is also written to that
+file, so headless runs can be listened to.
+"""
+
+import functools
+import os
+import re
+import threading
+import wave
+
+import numpy as np
+
+import sim_clock
+import sim_recorder
+
+
+SAMPLE_RATE = 22050
+
+# Fraction of a whole note for each note value letter
+NOTE_VALUES = {
+    'w': 1.0,
+    'h': 1 / 2,
+    'q': 1 / 4,
+    'e': 1 / 8,
+    's': 1 / 16,
+}
+
+# Semitones from A in the same octave
+_SEMITONES = {'C': -9, 'D': -7, 'E': -5, 'F': -4, 'G': -2, 'A': 0, 'B': 2}
+_ACCIDENTALS = {'': 0, '#': 1, 'b': -1}
+_NOTE = re.compile(r'([A-G])([#b]?)(-?\d)$')
+
+# Fade at each end of a note so notes join without clicks
+_FADE = 0.005
+
+
+@functools.lru_cache(maxsize=None)
+def note_frequency(note):
+    """
+    The frequency in Hz of a note such as 'A4', 'C#5' or 'Bb3'. 'R' is a rest
+    and has frequency 0.
+    """
+    if note in ('R', 'r'):
+        return 0.0
+    match = _NOTE.match(note[:1].upper() + note[1:])
+    if match is None:
+        raise ValueError("%r is not a note, expected a name like 'C4', 'D#5', 'Eb3' or 'R'" % (note,))
+    letter, accidental, octave = match.groups()
+    semitones = _SEMITONES[letter] + _ACCIDENTALS[accidental] + (int(octave) - 4) * 12
+    return 440.0 * 2 ** (semitones / 12)
+
+
+def note_duration(value, tempo=120):
+    """
+    The length in seconds of a note value at a tempo in quarter notes per
+    minute. A value is a NOTE_VALUES letter, optionally dotted ('q.'), a
+    triplet ('e3'), divided ('q/3') or multiplied ('h*2').
+    """
+    whole = 240.0 / tempo
+    if '/' in value:
+        base, factor = value.split('/')
+        return whole * NOTE_VALUES[base] / float(factor)
+    if '*' in value:
+        base, factor = value.split('*')
+        return whole * NOTE_VALUES[base] * float(factor)
+    if value.endswith('.'):
+        return whole * NOTE_VALUES[value[:-1]] * 1.5
+    if value.endswith('3'):
+        return whole * NOTE_VALUES[value[:-1]] * 2 / 3
+    return whole * NOTE_VALUES[value]
+
+
+def _samples(seconds, sample_rate):
+    return int(round(seconds * sample_rate))
+
+
+@functools.lru_cache(maxsize=256)
+def render_note(frequency, samples, sample_rate=SAMPLE_RATE, volume=100):
+    """
+    The PCM of one tone, as a read-only int16 array. A frequency of 0 is
+    silence.
+    """
+    if frequency <= 0 or samples <= 0 or volume <= 0:
+        pcm = np.zeros(samples, dtype=np.int16)
+    else:
+        t = np.arange(samples) / sample_rate
+        tone = np.sin(2 * np.pi * frequency * t)
+        fade = min(_samples(_FADE, sample_rate), samples // 2)
+        if fade:
+            ramp = np.linspace(0.0, 1.0, fade, endpoint=False)
+            tone[:fade] *= ramp
+            tone[samples - fade:] *= ramp[::-1]
+        pcm = (tone * (32767 * min(volume, 100) / 100)).astype(np.int16)
+    pcm.flags.writeable = False
+    return pcm
+
+
+@functools.lru_cache(maxsize=64)
+def render_song(song, tempo=120, delay=0.05, sample_rate=SAMPLE_RATE, volume=100):
+    """
+    The PCM of a song, as a read-only int16 array.
+    :param song: a tuple of (note, value) tuples, see note_frequency and
+        note_duration
+    :param tempo: quarter notes per minute
+    :param delay: seconds of silence between notes
+    """
+    gap = np.zeros(_samples(delay, sample_rate), dtype=np.int16)
+    parts = []
+    for note, value in song:
+        if parts and len(gap):
+            parts.append(gap)
+        parts.append(render_note(note_frequency(note), _samples(note_duration(value, tempo), sample_rate),
+                                 sample_rate, volume))
+    pcm = np.concatenate(parts) if parts else np.zeros(0, dtype=np.int16)
+    pcm.flags.writeable = False
+    return pcm
+
+
+def write_wav(path, pcm, sample_rate=SAMPLE_RATE):
+    """
+    Writes int16 mono PCM to a WAV file.
+    """
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(np.asarray(pcm, dtype='<i2').tobytes())
+
+
+def render_wav(song, path, tempo=120, delay=0.05, sample_rate=SAMPLE_RATE, volume=100):
+    """
+    Renders a song straight to a WAV file.
+    :return: the song's duration in seconds
+    """
+    pcm = render_song(_as_song(song), tempo, delay, sample_rate, volume)
+    write_wav(path, pcm, sample_rate)
+    return len(pcm) / sample_rate
+
+
+def _as_song(song):
+    return tuple((note, value) for note, value in song)
+
+
+class Playback():
+    """
+    A song started by Sound.play_song, playing until its end time on the
+    sound's clock.
+    """
+
+    def __init__(self, clock, start, duration):
+        self.clock = clock
+        self.start = start
+        self.duration = duration
+        self.end = start + duration
+
+    def is_playing(self):
+        return self.clock.now() < self.end
+
+    def wait(self):
+        """
+        Sleeps on the clock until the song ends.
+        """
+        remaining = self.end - self.clock.now()
+        if remaining > 0:
+            self.clock.sleep(remaining)
+
+
 class Sound():
     """
     Simulates the sound driver.
     """
 
-    def play_song(self, song):
+    PLAY_WAIT_FOR_COMPLETE = 0
+    PLAY_NO_WAIT_FOR_COMPLETE = 1
+
+    def __init__(self, recorder=None, clock=None, wav=None, sample_rate=SAMPLE_RATE, volume=100):
+        """
+        :param recorder: the EventRecorder for played songs, defaults to the shared one
+        :param clock: the clock songs play on, defaults to the shared sim_clock clock
+        :param wav: a path to write everything played to as a WAV file,
+            defaults to $HOUSEPET_SOUND_WAV. False or an empty path writes none.
+        :param sample_rate: samples per second of the rendered PCM
+        :param volume: the volume in percent
+        """
+        self.recorder = recorder if recorder is not None else sim_recorder.get_recorder()
+        self.clock = clock if clock is not None else sim_clock.get_clock()
+        self.sample_rate = sample_rate
+        self.volume = volume
+        # The last song started, and the seconds of sound played so far
+        self.playback = None
+        self.played = 0.0
+
+        if wav is None:
+            wav = os.environ.get('HOUSEPET_SOUND_WAV')
+        self._wav = None
+        self._wav_lock = threading.Lock()
+        if wav:
+            self._wav = wave.open(wav, 'wb')
+            self._wav.setnchannels(1)
+            self._wav.setsampwidth(2)
+            self._wav.setframerate(sample_rate)
+
+    def play_song(self, song, tempo=120, delay=0.05, play_type=PLAY_WAIT_FOR_COMPLETE):
         """
-        Plays a simulated song
+        Plays a song given as a sequence of (note, value) tuples, such as
+        (('C4', 'e'), ('D4', 'e'), ('E5', 'q')). See note_frequency and
+        note_duration for the notation.
+        :param tempo: quarter notes per minute
+        :param delay: seconds of silence between notes
+        :param play_type: PLAY_WAIT_FOR_COMPLETE sleeps on the clock until the
+            song ends, PLAY_NO_WAIT_FOR_COMPLETE returns straight away
+        :return: the Playback
         """
-        print("Sound: Playing a song")
+        pcm = self.render(song, tempo, delay)
+        duration = len(pcm) / self.sample_rate
+        self.recorder.log("Sound: Playing a song of %d notes, %.2f s", len(song), duration)
+
+        if self._wav is not None:
+            with self._wav_lock:
+                self._wav.writeframes(pcm.astype('<i2', copy=False).tobytes())
 
+        self.playback = Playback(self.clock, self.clock.now(), duration)
+        self.played += duration
+        if play_type == self.PLAY_WAIT_FOR_COMPLETE:
+            self.playback.wait()
+        return self.playback
+
+    def render(self, song, tempo=120, delay=0.05):
+        """
+        The PCM of a song at this sound's sample rate and volume, as a
+        read-only int16 array.
+        """
+        return render_song(_as_song(song), tempo, delay, self.sample_rate, self.volume)
+
+    def is_playing(self):
+        return self.playback is not None and self.playback.is_playing()
+
+    def close(self):
+        """
+        Finishes the WAV file, if one is written.
+        """
+        with self._wav_lock:
+            if self._wav is not None:
+                self._wav.close()
+                self._wav = None
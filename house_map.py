@@ -0,0 +1,433 @@
+"""
+2D house environment for the simulated pet.
+
+A HouseMap holds walls and furniture as line segments, rooms with their
+ambient light level and the IR beacon position. The segments are bucketed in
+a uniform grid, so collision, line of sight, IR heading and ambient light
+queries only look at the cells near the query instead of the whole map, and
+their cost stays flat as the map grows.
+
+Maps are JSON files, see maps/house.json::
+
+    {"cell_size": 0.5, "beacon": [1.0, 2.0],
+     "walls": [[x0, y0, x1, y1], ...],
+     "furniture": [{"name": "sofa", "rect": [x0, y0, x1, y1]}, ...],
+     "rooms": [{"name": "kitchen", "rect": [x0, y0, x1, y1], "light": 60}, ...]}
+
+Coordinates are in metres. HouseMap.generate builds large maps of rooms for
+benchmarks. A HouseEnvironment puts a gadget in a map: it moves the pet with
+its drives, stops it and presses the touch sensor when it runs into
+something, and keeps its IR heading and ambient light in step with where it is.
+"""
+
+import json
+import math
+import random
+
+import numpy as np
+
+from sim_fleet import IR_DEGREES_PER_HEADING, IR_MAX_HEADING, IR_RANGE
+
+
+# The pet's footprint, as a circle
+ROBOT_RADIUS = 0.1
+
+# Metres ahead of the pet at which the IR proximity reads 100
+IR_PROXIMITY_RANGE = 0.7
+
+
+class HouseMap():
+    """
+    Walls, furniture, rooms and the beacon, with a grid index over them.
+    """
+
+    def __init__(self, walls, furniture=(), rooms=(), beacon=None, cell_size=0.5, default_light=10):
+        """
+        :param walls: wall segments as (x0, y0, x1, y1)
+        :param furniture: dicts with a name and a rect (x0, y0, x1, y1)
+        :param rooms: dicts with a name, a rect and a light level
+        :param beacon: the beacon position (x, y), or None
+        :param cell_size: the grid cell size in metres
+        :param default_light: the ambient light outside every room
+        """
+        self.walls = [tuple(map(float, wall)) for wall in walls]
+        self.furniture = [dict(item, rect=tuple(map(float, item['rect']))) for item in furniture]
+        self.rooms = [dict(room, rect=tuple(map(float, room['rect']))) for room in rooms]
+        self.beacon = tuple(beacon) if beacon is not None else None
+        self.cell_size = float(cell_size)
+        self.default_light = default_light
+
+        self.segments = list(self.walls)
+        for item in self.furniture:
+            x0, y0, x1, y1 = item['rect']
+            self.segments += [(x0, y0, x1, y0), (x1, y0, x1, y1), (x1, y1, x0, y1), (x0, y1, x0, y0)]
+        self._build_index()
+
+    @classmethod
+    def from_dict(cls, spec):
+        return cls(spec.get('walls', ()), spec.get('furniture', ()), spec.get('rooms', ()), spec.get('beacon'),
+                   spec.get('cell_size', 0.5), spec.get('default_light', 10))
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+    def to_dict(self):
+        return {
+            'cell_size': self.cell_size,
+            'default_light': self.default_light,
+            'beacon': list(self.beacon) if self.beacon is not None else None,
+            'walls': [list(wall) for wall in self.walls],
+            'furniture': [dict(item, rect=list(item['rect'])) for item in self.furniture],
+            'rooms': [dict(room, rect=list(room['rect'])) for room in self.rooms],
+        }
+
+    @classmethod
+    def generate(cls, rooms_x, rooms_y, room_size=4.0, door=0.9, furniture=2, seed=None, cell_size=0.5):
+        """
+        Builds a grid of square rooms with a door in the middle of every inner
+        wall and some furniture in each room. The beacon is in the middle of
+        the first room.
+        """
+        rng = random.Random(seed)
+        width = rooms_x * room_size
+        height = rooms_y * room_size
+        walls = [(0, 0, width, 0), (width, 0, width, height), (width, height, 0, height), (0, height, 0, 0)]
+        half = door / 2
+        for i in range(1, rooms_x):
+            x = i * room_size
+            for j in range(rooms_y):
+                mid = (j + 0.5) * room_size
+                walls += [(x, j * room_size, x, mid - half), (x, mid + half, x, (j + 1) * room_size)]
+        for j in range(1, rooms_y):
+            y = j * room_size
+            for i in range(rooms_x):
+                mid = (i + 0.5) * room_size
+                walls += [(i * room_size, y, mid - half, y), (mid + half, y, (i + 1) * room_size, y)]
+
+        rooms = []
+        items = []
+        for i in range(rooms_x):
+            for j in range(rooms_y):
+                x0, y0 = i * room_size, j * room_size
+                rooms.append({'name': 'room-{}-{}'.format(i, j), 'rect': (x0, y0, x0 + room_size, y0 + room_size),
+                              'light': rng.randint(5, 80)})
+                for k in range(furniture):
+                    # Keep to the corners so doors and the middle stay clear
+                    w = rng.uniform(0.3, 0.8)
+                    h = rng.uniform(0.3, 0.8)
+                    fx = x0 + (0.2 if k % 2 == 0 else room_size - 0.2 - w)
+                    fy = y0 + (0.2 if k % 4 < 2 else room_size - 0.2 - h)
+                    items.append({'name': 'furniture', 'rect': (fx, fy, fx + w, fy + h)})
+
+        return cls(walls, items, rooms, beacon=(room_size / 2, room_size / 2), cell_size=cell_size)
+
+    def _build_index(self):
+        xs = [c for s in self.segments for c in (s[0], s[2])] + [c for r in self.rooms for c in (r['rect'][0], r['rect'][2])]
+        ys = [c for s in self.segments for c in (s[1], s[3])] + [c for r in self.rooms for c in (r['rect'][1], r['rect'][3])]
+        cs = self.cell_size
+        self.x_min = min(xs, default=0.0) - cs
+        self.y_min = min(ys, default=0.0) - cs
+        self.nx = int(math.ceil((max(xs, default=0.0) + cs - self.x_min) / cs)) + 1
+        self.ny = int(math.ceil((max(ys, default=0.0) + cs - self.y_min) / cs)) + 1
+
+        cells = [[] for _ in range(self.nx * self.ny)]
+        for index, (x0, y0, x1, y1) in enumerate(self.segments):
+            for cx, cy in self._cells_in_box(min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)):
+                bx = self.x_min + cx * cs
+                by = self.y_min + cy * cs
+                if _segment_meets_box(x0, y0, x1, y1, bx, by, bx + cs, by + cs):
+                    cells[cy * self.nx + cx].append(index)
+        self._cells = [tuple(cell) for cell in cells]
+
+        room_cells = [[] for _ in range(self.nx * self.ny)]
+        for index, room in enumerate(self.rooms):
+            for cx, cy in self._cells_in_box(*room['rect']):
+                room_cells[cy * self.nx + cx].append(index)
+        self._room_cells = [tuple(cell) for cell in room_cells]
+
+    def bounds(self):
+        """
+        The (x0, y0, x1, y1) box around the rooms, or the segments if there
+        are no rooms.
+        """
+        rects = [room['rect'] for room in self.rooms] or self.segments
+        return (min(min(r[0], r[2]) for r in rects), min(min(r[1], r[3]) for r in rects),
+                max(max(r[0], r[2]) for r in rects), max(max(r[1], r[3]) for r in rects))
+
+    def _cell(self, x, y):
+        return int((x - self.x_min) // self.cell_size), int((y - self.y_min) // self.cell_size)
+
+    def _cells_in_box(self, x0, y0, x1, y1):
+        cx0, cy0 = self._cell(x0, y0)
+        cx1, cy1 = self._cell(x1, y1)
+        for cx in range(max(cx0, 0), min(cx1, self.nx - 1) + 1):
+            for cy in range(max(cy0, 0), min(cy1, self.ny - 1) + 1):
+                yield cx, cy
+
+    def _segments_near(self, x0, y0, x1, y1):
+        """
+        Indices of the segments in the cells overlapping a box.
+        """
+        found = set()
+        cells = self._cells
+        nx = self.nx
+        for cx, cy in self._cells_in_box(x0, y0, x1, y1):
+            found.update(cells[cy * nx + cx])
+        return found
+
+    def collides(self, x, y, radius=ROBOT_RADIUS):
+        """
+        Whether a circle at (x, y) touches a wall or a piece of furniture.
+        """
+        segments = self.segments
+        r2 = radius * radius
+        for index in self._segments_near(x - radius, y - radius, x + radius, y + radius):
+            if _point_segment_distance2(x, y, *segments[index]) < r2:
+                return True
+        return False
+
+    def cast_ray(self, x0, y0, x1, y1):
+        """
+        Walks the grid cells along the segment from (x0, y0) to (x1, y1) and
+        returns the fraction of the way to the first wall or furniture edge it
+        crosses, or None if it crosses none.
+        """
+        cs = self.cell_size
+        gx0 = (x0 - self.x_min) / cs
+        gy0 = (y0 - self.y_min) / cs
+        dx = (x1 - x0) / cs
+        dy = (y1 - y0) / cs
+        cx = int(math.floor(gx0))
+        cy = int(math.floor(gy0))
+        end_x = int(math.floor(gx0 + dx))
+        end_y = int(math.floor(gy0 + dy))
+
+        step_x = 1 if dx > 0 else -1
+        step_y = 1 if dy > 0 else -1
+        delta_x = abs(1 / dx) if dx else math.inf
+        delta_y = abs(1 / dy) if dy else math.inf
+        next_x = ((cx + 1 - gx0) if dx > 0 else (gx0 - cx)) * delta_x if dx else math.inf
+        next_y = ((cy + 1 - gy0) if dy > 0 else (gy0 - cy)) * delta_y if dy else math.inf
+
+        segments = self.segments
+        cells = self._cells
+        seen = set()
+        best = None
+        for _ in range(abs(end_x - cx) + abs(end_y - cy) + 1):
+            if 0 <= cx < self.nx and 0 <= cy < self.ny:
+                for index in cells[cy * self.nx + cx]:
+                    if index in seen:
+                        continue
+                    seen.add(index)
+                    t = _segment_intersection(x0, y0, x1, y1, *segments[index])
+                    if t is not None and (best is None or t < best):
+                        best = t
+            # A hit before the end of this cell can't be beaten by a later cell
+            if best is not None and best <= min(next_x, next_y):
+                return best
+            if next_x < next_y:
+                cx += step_x
+                next_x += delta_x
+            else:
+                cy += step_y
+                next_y += delta_y
+        return best
+
+    def line_of_sight(self, x0, y0, x1, y1):
+        return self.cast_ray(x0, y0, x1, y1) is None
+
+    def ir_heading(self, x, y, theta, beacon=None):
+        """
+        The IR seeker heading to the beacon, as sim_fleet.FleetSim reads it,
+        and 0 when the beacon is out of range, out of view or behind a wall.
+        :param theta: the robot heading in radians, counter-clockwise from +x
+        :param beacon: the beacon position, defaults to the map's
+        """
+        beacon = beacon if beacon is not None else self.beacon
+        if beacon is None:
+            return 0
+        dx = beacon[0] - x
+        dy = beacon[1] - y
+        if math.hypot(dx, dy) > IR_RANGE:
+            return 0
+        bearing = (math.atan2(dy, dx) - theta + math.pi) % (2 * math.pi) - math.pi
+        heading = int(round(math.degrees(bearing) / IR_DEGREES_PER_HEADING))
+        if heading == 0 or abs(heading) > IR_MAX_HEADING:
+            return 0
+        return heading if self.line_of_sight(x, y, beacon[0], beacon[1]) else 0
+
+    def ir_proximity(self, x, y, theta, radius=ROBOT_RADIUS):
+        """
+        The IR proximity straight ahead, from 0 at the pet's front to 100 at
+        IR_PROXIMITY_RANGE or further.
+        """
+        reach = radius + IR_PROXIMITY_RANGE
+        hit = self.cast_ray(x, y, x + reach * math.cos(theta), y + reach * math.sin(theta))
+        if hit is None:
+            return 100
+        return int(round(max(hit * reach - radius, 0.0) / IR_PROXIMITY_RANGE * 100))
+
+    def room_at(self, x, y):
+        """
+        The room containing (x, y), or None.
+        """
+        cx, cy = self._cell(x, y)
+        if not (0 <= cx < self.nx and 0 <= cy < self.ny):
+            return None
+        for index in self._room_cells[cy * self.nx + cx]:
+            room = self.rooms[index]
+            x0, y0, x1, y1 = room['rect']
+            if x0 <= x < x1 and y0 <= y < y1:
+                return room
+        return None
+
+    def ambient_light(self, x, y):
+        room = self.room_at(x, y)
+        return room.get('light', self.default_light) if room is not None else self.default_light
+
+    def collides_many(self, x, y, radius=ROBOT_RADIUS):
+        """
+        collides for arrays of positions. Returns a bool array.
+        """
+        return np.fromiter((self.collides(px, py, radius) for px, py in zip(x.tolist(), y.tolist())),
+                           dtype=bool, count=len(x))
+
+    def ir_headings(self, x, y, theta, beacon_x, beacon_y):
+        """
+        ir_heading for arrays of robots, each with its own beacon. Range and
+        field of view are checked for all robots at once; only the robots
+        that could see their beacon are ray cast.
+        """
+        dx = beacon_x - x
+        dy = beacon_y - y
+        bearing = (np.arctan2(dy, dx) - theta + np.pi) % (2 * np.pi) - np.pi
+        heading = np.rint(np.degrees(bearing) / IR_DEGREES_PER_HEADING)
+        visible = (np.abs(heading) <= IR_MAX_HEADING) & (np.hypot(dx, dy) <= IR_RANGE) & (heading != 0)
+        for i in np.flatnonzero(visible).tolist():
+            if not self.line_of_sight(x[i], y[i], beacon_x[i], beacon_y[i]):
+                visible[i] = False
+        return np.where(visible, heading, 0).astype(np.int8)
+
+
+def _point_segment_distance2(px, py, x0, y0, x1, y1):
+    dx = x1 - x0
+    dy = y1 - y0
+    length2 = dx * dx + dy * dy
+    t = ((px - x0) * dx + (py - y0) * dy) / length2 if length2 else 0.0
+    t = min(max(t, 0.0), 1.0)
+    ex = x0 + t * dx - px
+    ey = y0 + t * dy - py
+    return ex * ex + ey * ey
+
+
+def _segment_intersection(ax, ay, bx, by, cx, cy, dx, dy):
+    """
+    The fraction along a-b where it crosses c-d, or None.
+    """
+    rx, ry = bx - ax, by - ay
+    sx, sy = dx - cx, dy - cy
+    denom = rx * sy - ry * sx
+    if denom == 0:
+        return None
+    qx, qy = cx - ax, cy - ay
+    t = (qx * sy - qy * sx) / denom
+    u = (qx * ry - qy * rx) / denom
+    if 0 <= t <= 1 and 0 <= u <= 1:
+        return t
+    return None
+
+
+def _segment_meets_box(x0, y0, x1, y1, bx0, by0, bx1, by1):
+    """
+    Whether a segment passes through a box, by Liang-Barsky clipping.
+    """
+    t0, t1 = 0.0, 1.0
+    dx = x1 - x0
+    dy = y1 - y0
+    for p, q in ((-dx, x0 - bx0), (dx, bx1 - x0), (-dy, y0 - by0), (dy, by1 - y0)):
+        if p == 0:
+            if q < 0:
+                return False
+            continue
+        t = q / p
+        if p < 0:
+            t0 = max(t0, t)
+        else:
+            t1 = min(t1, t)
+        if t0 > t1:
+            return False
+    return True
+
+
+class HouseEnvironment():
+    """
+    Places a MindstormsGadget in a HouseMap and drives its sensors from its
+    pose: the touch sensor is pressed when the pet runs into something, the
+    IR heading follows the beacon, the IR proximity follows the walls and
+    furniture ahead and the ambient light follows the room.
+    """
+
+    def __init__(self, house, gadget, start=(0.0, 0.0, 0.0), dt=0.1, radius=ROBOT_RADIUS):
+        """
+        :param house: the HouseMap
+        :param gadget: the MindstormsGadget
+        :param start: the starting pose (x, y, theta)
+        :param dt: seconds of simulated time between sensor updates. At the
+            pet's top speed of about 0.5 m/s the default moves it less than
+            its radius between updates.
+        :param radius: the pet's radius in metres
+        """
+        self.house = house
+        self.gadget = gadget
+        self.world = gadget.world
+        self.clock = gadget.clock
+        self.dt = dt
+        self.radius = radius
+        self.collisions = 0
+
+        self.world.pose_x, self.world.pose_y, self.world.pose_theta = start
+        self._free = (self.world.pose_x, self.world.pose_y)
+
+    def start(self):
+        """
+        Starts updating the sensors on a thread of the gadget's clock.
+        """
+        self.update()
+        self.clock.spawn(self._sense_thread)
+
+    def _sense_thread(self):
+        while True:
+            self.clock.sleep(self.dt)
+            self.update()
+
+    async def run_async(self):
+        import asyncio
+
+        self.update()
+        while True:
+            await asyncio.sleep(self.dt)
+            self.update()
+
+    def update(self):
+        """
+        Brings the pose up to date, handles a collision and updates the sensors.
+        """
+        gadget = self.gadget
+        world = self.world
+        x, y, theta = gadget.drive.pose
+
+        house = self.house
+        free_x, free_y = self._free
+        if house.collides(x, y, self.radius) or not house.line_of_sight(free_x, free_y, x, y):
+            gadget.drive.off()
+            world.pose_x, world.pose_y = x, y = free_x, free_y
+            self.collisions += 1
+            world.touch_bump = True
+        else:
+            self._free = (x, y)
+
+        world.ir_beacon_heading = house.ir_heading(x, y, theta)
+        world.ir_proximity = house.ir_proximity(x, y, theta, self.radius)
+        world.ambient_light_intensity = house.ambient_light(x, y)
@@ -8,54 +8,66 @@
 # RESPECT TO THESE MATERIALS, ALL WARRANTIES, EXPRESS, IMPLIED, OR STATUTORY, INCLUDING 
 # THE IMPLIED WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, AND NON-INFRINGEMENT.
 
+import argparse
 import os
 import sys
-import time
+import asyncio
 import logging
 import json
-import random
-import threading
 from enum import Enum
 
+import sim_clock
+import sim_metrics
+import sim_profile
+import sim_sentry
+import sim_vars
 from agt import AlexaGadget
 
 from ev3dev2.led import Leds
 from ev3dev2.motor import OUTPUT_C, OUTPUT_D, MoveTank, SpeedPercent, MoveSteering
+from ev3dev2.sensor import bus_for
 from ev3dev2.sensor.lego import InfraredSensor
 from ev3dev2.sensor.lego import TouchSensor
 from ev3dev2.sensor.lego import ColorSensor
 from ev3dev2.sound import Sound
 
-from oauthlib.oauth2 import BackendApplicationClient
-from requests_oauthlib import OAuth2Session
+from sim_trace import TraceWriter
+from telemetry import IotTelemetryClient, SimTelemetryBackend, TelemetryError
 
-import iot_api_client as iot
-from iot_api_client.rest import ApiException
-from iot_api_client.configuration import Configuration
+try:
+    # Faster directive decoding when available
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
 # Set the logging level to INFO to see messages from AlexaGadget
 logging.basicConfig(level=logging.INFO, stream=sys.stdout, format='%(message)s')
 logging.getLogger().addHandler(logging.StreamHandler(sys.stderr))
 logger = logging.getLogger(__name__)
 
-oauth_client = BackendApplicationClient(client_id='FIXME')
-token_url = "https://login.arduino.cc/oauth/token"
 
-oauth = OAuth2Session(client=oauth_client)
-token = oauth.fetch_token(
-    token_url=token_url,
-    client_id='FIXME',
-    client_secret='FIXME',
-    audience="https://api2.arduino.cc/iot"
-)
+def iot_telemetry(world):
+    """
+    Creates the Arduino IoT Cloud telemetry backend for the power board.
+    """
+    return IotTelemetryClient(
+        thing_id='FIXME',
+        property_ids={
+            'batt_voltage': 'FIXME',
+            'load_current': 'FIXME',
+            'charge_current': 'FIXME',
+        },
+        client_id='FIXME',
+        client_secret='FIXME'
+    )
 
-client_config = Configuration(host="http://api2.arduino.cc/iot")
-client_config.access_token = token.get("access_token")
-client = iot.ApiClient(client_config)
 
-id = 'FIXME'
+# Telemetry backend factories, selected by name or with HOUSEPET_TELEMETRY
+TELEMETRY_BACKENDS = {
+    'iot': iot_telemetry,
+    'sim': SimTelemetryBackend,
+}
 
-api_instance = iot.PropertiesV2Api(client)
 
 class Direction(Enum):
     """
@@ -92,41 +104,148 @@ class EventName(Enum):
     POWER = "Power"
 
 
+# Slot value to enum member, so directives are matched with one lookup
+DIRECTION_SLOTS = {slot: direction for direction in Direction for slot in direction.value}
+COMMAND_SLOTS = {slot: command for command in Command for slot in command.value}
+
+# Jingles played when the gadget starts and stops
+STARTUP_SONG = (('C4', 'e'), ('D4', 'e'), ('E5', 'q'))
+SHUTDOWN_SONG = (('E5', 'e'), ('C4', 'e'))
+
+# Below this battery voltage the light sensor's LED is set red
+LOW_VOLTAGE = 3.6
+
+
 class MindstormsGadget(AlexaGadget):
     """
     A Mindstorms gadget that can perform bi-directional interaction with an Alexa skill.
     """
 
-    def __init__(self):
+    def __init__(self, clock=None, world=None, telemetry=None, recorder=None, trace=None, events=None,
+                 battery=None):
         """
         Performs Alexa Gadget initialization routines and ev3dev resource allocation.
+        :param clock: the simulation clock, defaults to the shared sim_clock clock
+        :param world: the simulated WorldState, defaults to the sim_vars globals
+        :param telemetry: a TELEMETRY_BACKENDS name or a factory taking the world,
+            defaults to $HOUSEPET_TELEMETRY or 'iot'. Created on first use.
+        :param recorder: the sim_recorder.EventRecorder for device and gadget
+            records, defaults to the shared one
+        :param trace: a sim_trace.TraceWriter, or a path to write a trace of
+            the sensor values, directives and power readings to, defaults to
+            $HOUSEPET_TRACE. False or an empty path writes no trace.
+        :param events: the alexa_events.EventQueue for outbound events,
+            defaults to one on the gadget's clock
+        :param battery: a sim_power.BatteryModel, or True for the default
+            one, to model the battery from the motor, LED and light activity
+            and keep the world's power readings up to date. None keeps them
+            as they are set.
         """
-        super().__init__()
+        super().__init__(clock=clock, recorder=recorder, events=events)
 
         # Robot state
+        self._patrol_event = sim_clock.ClockEvent()
+        self._follow_event = sim_clock.ClockEvent()
+        self._sentry_event = sim_clock.ClockEvent()
+        self._light_event = sim_clock.ClockEvent()
         self.patrol_mode = False
         self.follow_mode = False
+        self.sentry_mode = False
 
         # Internal Variables
+        self.world = world if world is not None else sim_vars.GLOBAL_WORLD
         self.light_intensity = 0
         self.batt_voltage = 0
+        self.telemetry_backend = telemetry or os.environ.get('HOUSEPET_TELEMETRY', 'iot')
+        self.telemetry = None
+        if trace is None:
+            trace = os.environ.get('HOUSEPET_TRACE')
+        if trace and not isinstance(trace, TraceWriter):
+            trace = TraceWriter(trace, clock=self.clock)
+        self.trace = trace or None
+        if self.trace is not None:
+            self.trace.attach(self.world)
 
         # Connect two large motors on output ports B and C
-        #self.drive = MoveTank(OUTPUT_D, OUTPUT_C)
-        self.steerdrive = MoveSteering(OUTPUT_C, OUTPUT_D)
-        self.leds = Leds()
-        self.ir = InfraredSensor()
+        self.drive = MoveTank(OUTPUT_D, OUTPUT_C, world=self.world, clock=self.clock, recorder=self.recorder)
+        self.steerdrive = MoveSteering(self.drive.left_motor, self.drive.right_motor, world=self.world, clock=self.clock,
+                                       recorder=self.recorder)
+        self.leds = Leds(world=self.world, recorder=self.recorder)
+        self.ir = InfraredSensor(world=self.world, clock=self.clock)
         self.ir.mode = 'IR-SEEK'
-        self.touch = TouchSensor()
-        self.light = ColorSensor(address='ev3-ports:in4')
-        self.sound = Sound()
-
-        # Start threads
-        threading.Thread(target=self._patrol_thread, daemon=True).start()
-        threading.Thread(target=self._follow_thread, daemon=True).start()
-        threading.Thread(target=self._pat_thread, daemon=True).start()
-        threading.Thread(target=self._power_thread, daemon=True).start()
-        threading.Thread(target=self._light_sensor_thread, daemon=True).start()
+        self.touch = TouchSensor(world=self.world, clock=self.clock)
+        self.light = ColorSensor(address='ev3-ports:in4', world=self.world, clock=self.clock)
+        self.sound = Sound(recorder=self.recorder, clock=self.clock)
+        self.sentry = sim_sentry.SentryMonitor(self)
+        # The light is read again when the ambient light changes
+        bus_for(self.world).subscribe('ambient_light_intensity', lambda name, value: self._light_event.set())
+
+        self.power = None
+        if battery:
+            import sim_power
+
+            self.power = sim_power.PowerModel(self, battery if battery is not True else None)
+
+        # Control directive type to handler
+        self._control_handlers = {
+            "move": self._control_move,
+            "command": self._control_command,
+            "follow": self._control_follow,
+            "stopfollow": self._control_stopfollow,
+        }
+
+        sim_metrics.get_metrics().instrument_gadget(self)
+        self._start_behaviors()
+
+    def _start_behaviors(self):
+        """
+        Starts the behavior threads.
+        """
+        self.clock.spawn(self._patrol_thread)
+        self.clock.spawn(self._follow_thread)
+        self.clock.spawn(self._pat_thread)
+        self.clock.spawn(self._power_thread)
+        self.clock.spawn(self._light_sensor_thread)
+        self.clock.spawn(self._sentry_thread)
+        self.events.start()
+        if self.power is not None:
+            self.power.start()
+
+    @property
+    def patrol_mode(self):
+        return self._patrol_event.is_set()
+
+    @patrol_mode.setter
+    def patrol_mode(self, value):
+        # The patrol thread waits on the event while patrol mode is off
+        if value:
+            self._patrol_event.set()
+        else:
+            self._patrol_event.clear()
+
+    @property
+    def follow_mode(self):
+        return self._follow_event.is_set()
+
+    @follow_mode.setter
+    def follow_mode(self, value):
+        # The follow thread waits on the event while follow mode is off
+        if value:
+            self._follow_event.set()
+        else:
+            self._follow_event.clear()
+
+    @property
+    def sentry_mode(self):
+        return self._sentry_event.is_set()
+
+    @sentry_mode.setter
+    def sentry_mode(self, value):
+        # The sentry thread waits on the event while sentry mode is off
+        if value:
+            self._sentry_event.set()
+        else:
+            self._sentry_event.clear()
 
     def on_connected(self, device_addr):
         """
@@ -151,27 +270,59 @@ class MindstormsGadget(AlexaGadget):
         Handles the Custom.Mindstorms.Gadget control directive.
         :param directive: the custom directive with the matching namespace and name
         """
+        if self.trace is not None:
+            self.trace.directive(directive.payload)
         try:
-            payload = json.loads(directive.payload.decode("utf-8"))
-            print("Control payload: {}".format(payload), file=sys.stderr)
-            control_type = payload["type"]
-            if control_type == "move":
-
-                # Expected params: [direction, duration, speed]
-                self._move(payload["direction"], int(payload["duration"]), int(payload["speed"]))
-
-            if control_type == "command":
-                # Expected params: [command]
-                self._activate(payload["command"])
-
-            if control_type == "follow":
-                self.follow_mode = True
-            
-            if control_type == "stopfollow":
-                self.follow_mode = False
+            payload = json_loads(directive.payload)
+            self.recorder.directive(payload.get("type"), payload)
+            handler = self._control_handlers.get(payload["type"])
+            if handler is not None:
+                handler(payload)
 
         except KeyError:
-            print("Missing expected parameters: {}".format(directive), file=sys.stderr)
+            self.recorder.log("Missing expected parameters: %s", directive)
+
+    def dispatch_directives(self, payloads):
+        """
+        Handles a batch of raw control directive payloads, e.g. when replaying
+        recorded traffic. Payloads are not echoed to stderr.
+        :param payloads: an iterable of JSON payloads as bytes or str, such as
+            a list or a file of one payload per line
+        :return: the number of payloads handled and the number that failed
+        """
+        handlers = self._control_handlers
+        trace = self.trace
+        handled = 0
+        failed = 0
+        for raw in payloads:
+            if not raw.strip():
+                continue
+            if trace is not None:
+                trace.directive(raw)
+            try:
+                payload = json_loads(raw)
+                handler = handlers.get(payload["type"])
+                if handler is not None:
+                    handler(payload)
+                handled += 1
+            except (KeyError, ValueError, TypeError):
+                self.recorder.log("Missing expected parameters: %s", raw)
+                failed += 1
+        return handled, failed
+
+    def _control_move(self, payload):
+        # Expected params: [direction, duration, speed]
+        self._move(payload["direction"], int(payload["duration"]), int(payload["speed"]))
+
+    def _control_command(self, payload):
+        # Expected params: [command]
+        self._activate(payload["command"])
+
+    def _control_follow(self, payload):
+        self.follow_mode = True
+
+    def _control_stopfollow(self, payload):
+        self.follow_mode = False
 
     def _move(self, direction, duration: int, speed: int, is_blocking=False):
         """
@@ -182,18 +333,19 @@ class MindstormsGadget(AlexaGadget):
         :param speed: the speed percentage as an integer
         :param is_blocking: if set, motor run until duration expired before accepting another command
         """
-        print("Move command: ({}, {}, {}, {})".format(direction, speed, duration, is_blocking), file=sys.stderr)
-        if direction in Direction.FORWARD.value:
+        self.recorder.log("Move command: (%s, %s, %s, %s)", direction, speed, duration, is_blocking)
+        move = DIRECTION_SLOTS.get(direction)
+        if move is Direction.FORWARD:
             self.drive.on_for_seconds(SpeedPercent(speed), SpeedPercent(speed), duration, block=is_blocking)
 
-        if direction in Direction.BACKWARD.value:
+        elif move is Direction.BACKWARD:
             self.drive.on_for_seconds(SpeedPercent(-speed), SpeedPercent(-speed), duration, block=is_blocking)
 
-        if direction in (Direction.RIGHT.value + Direction.LEFT.value):
+        elif move is Direction.RIGHT or move is Direction.LEFT:
             self._turn(direction, speed)
             self.drive.on_for_seconds(SpeedPercent(speed), SpeedPercent(speed), duration, block=is_blocking)
 
-        if direction in Direction.STOP.value:
+        elif move is Direction.STOP:
             self.drive.off()
             self.patrol_mode = False
 
@@ -203,42 +355,45 @@ class MindstormsGadget(AlexaGadget):
         :param command: the preset command
         :param speed: the speed if applicable
         """
-        print("Activate command: ({}, {})".format(command, speed), file=sys.stderr)
-        if command in Command.MOVE_CIRCLE.value:
+        self.recorder.log("Activate command: (%s, %s)", command, speed)
+        preset = COMMAND_SLOTS.get(command)
+        if preset is Command.MOVE_CIRCLE:
             self.drive.on_for_seconds(SpeedPercent(int(speed)), SpeedPercent(5), 12)
 
-        if command in Command.MOVE_SQUARE.value:
+        elif preset is Command.MOVE_SQUARE:
             for i in range(4):
                 self._move("right", 2, speed, is_blocking=True)
 
-        if command in Command.PATROL.value:
+        elif preset is Command.PATROL:
             # Set patrol mode to resume patrol thread processing
             self.patrol_mode = True
 
-        if command in Command.SENTRY.value:
+        elif preset is Command.SENTRY:
             self.sentry_mode = True
             self._send_event(EventName.SPEECH, {'speechOut': "Sentry mode activated"})
 
             # Perform Shuffle posture
             self.drive.on_for_seconds(SpeedPercent(80), SpeedPercent(-80), 0.2)
-            time.sleep(0.3)
+            self.clock.sleep(0.3)
             self.drive.on_for_seconds(SpeedPercent(-40), SpeedPercent(40), 0.2)
 
             self.leds.set_color("LEFT", "YELLOW", 1)
             self.leds.set_color("RIGHT", "YELLOW", 1)
 
-    def _turn(self, direction, speed):
+    def _turn(self, direction, speed, block=True):
         """
         Turns based on the specified direction and speed.
         Calibrated for hard smooth surface.
         :param direction: the turn direction
         :param speed: the turn speed
+        :param block: if set, wait until the turn is done
         """
-        if direction in Direction.LEFT.value:
-            self.drive.on_for_seconds(SpeedPercent(0), SpeedPercent(speed), 2)
+        turn = DIRECTION_SLOTS.get(direction)
+        if turn is Direction.LEFT:
+            self.drive.on_for_seconds(SpeedPercent(0), SpeedPercent(speed), 2, block=block)
 
-        if direction in Direction.RIGHT.value:
-            self.drive.on_for_seconds(SpeedPercent(speed), SpeedPercent(0), 2)
+        elif turn is Direction.RIGHT:
+            self.drive.on_for_seconds(SpeedPercent(speed), SpeedPercent(0), 2, block=block)
 
     def _send_event(self, name: EventName, payload):
         """
@@ -246,6 +401,7 @@ class MindstormsGadget(AlexaGadget):
         :param name: the name of the custom event
         :param payload: the sentry JSON payload
         """
+        self.recorder.event('Custom.Mindstorms.Gadget', name.value, payload)
         self.send_custom_event('Custom.Mindstorms.Gadget', name.value, payload)
 
     def _patrol_thread(self):
@@ -254,18 +410,31 @@ class MindstormsGadget(AlexaGadget):
         """
         while True:
             while self.patrol_mode:
-                print("Patrol mode activated randomly picks a path", file=sys.stderr)
-                direction = random.choice(list(Direction))
-                duration = random.randint(1, 5)
-                speed = random.randint(1, 4) * 25
+                self.clock.sleep(self._patrol_step())
+            self.clock.wait(self._patrol_event)
+
+    def _patrol_step(self):
+        """
+        Starts one random patrol move and returns its duration.
+        """
+        direction, duration, speed = self._patrol_choice()
+        self._move(direction.value[0], duration, speed)
+        return duration
+
+    def _patrol_choice(self):
+        """
+        Picks a random patrol move and returns its direction, duration and speed.
+        """
+        self.recorder.log("Patrol mode activated randomly picks a path")
+        direction = self.clock.random.choice(list(Direction))
+        duration = self.clock.random.randint(1, 5)
+        speed = self.clock.random.randint(1, 4) * 25
 
-                while direction == Direction.STOP:
-                    direction = random.choice(list(Direction))
+        while direction == Direction.STOP:
+            direction = self.clock.random.choice(list(Direction))
 
-                # direction: all except stop, duration: 1-5s, speed: 25, 50, 75, 100
-                self._move(direction.value[0], duration, speed)
-                time.sleep(duration)
-            time.sleep(1)
+        # direction: all except stop, duration: 1-5s, speed: 25, 50, 75, 100
+        return direction, duration, speed
 
     def _pat_thread(self):
         """
@@ -281,86 +450,339 @@ class MindstormsGadget(AlexaGadget):
         """
         while True:
             self.light.mode='COL-AMBIENT'
-            time.sleep(0.5)
-            self.light_intensity = self.light.ambient_light_intensity
-            if self.batt_voltage < 3.6:
-                # Set the LED to be red.
-                self.light.mode='REF-RAW'
-            else:
-                self.light.mode='COL-COLOR'
-                # Set the LED to be white.
-
-            print("Light Intensity: ", self.light_intensity)
-
-            time.sleep(5)
+            self.clock.sleep(0.5)
+            self._light_event.clear()
+            self._read_light()
+            self.clock.wait(self._light_event)
+
+    def _read_light(self):
+        self.light_intensity = self.light.ambient_light_intensity
+        if self.batt_voltage < LOW_VOLTAGE:
+            # Set the LED to be red.
+            self.light.mode='REF-RAW'
+        else:
+            self.light.mode='COL-COLOR'
+            # Set the LED to be white.
+
+        self.recorder.sensor("Light", "intensity", self.light_intensity)
 
     def _follow_thread(self):
         """
         The thread to manage following the lease.
         """
         while True:
-            if self.follow_mode:
-                # Get heading to beacon
-                heading = self.ir.heading()
-                print("IR Heading: ", heading)
+            self.clock.wait(self._follow_event)
 
-                # Can't see the beacon
-                if heading == 0:
-                    time.sleep(1)
-                    continue
+            # Get heading to beacon
+            heading = self.ir.heading()
+            self.recorder.sensor("IR", "heading", heading)
 
-                drive_dir = -heading
+            # Can't see the beacon, check again when it moves or after a
+            # second in case follow mode was stopped
+            if heading == 0:
+                self.ir.wait_for_heading_change(timeout=1)
+                continue
 
-                # Drive
-                self.steerdrive.on_for_rotations(drive_dir, SpeedPercent(30), 2, block=True)
+            drive_dir = -heading
 
-            time.sleep(1)
+            # Drive
+            self.steerdrive.on_for_rotations(drive_dir, SpeedPercent(30), 2, block=True)
 
+            self.clock.sleep(1)
+
+    def _sentry_thread(self):
+        """
+        Watches the IR proximity for intruders while sentry mode is on.
+        """
+        while True:
+            self.clock.wait(self._sentry_event)
+            self.sentry.start()
+            try:
+                while self.sentry_mode:
+                    self.clock.sleep(self.sentry.interval)
+                    self._send_sentry_events()
+            finally:
+                self.sentry.stop()
+
+    def _send_sentry_events(self):
+        for name, payload in self.sentry.poll():
+            self._send_event(EventName(name), payload)
+
+    def _get_telemetry(self):
+        """
+        Returns the telemetry backend, creating it on first use.
+        """
+        if self.telemetry is None:
+            factory = self.telemetry_backend
+            if not callable(factory):
+                factory = TELEMETRY_BACKENDS[factory]
+            self.telemetry = sim_metrics.get_metrics().instrument(factory(self.world), ('fetch',), 'telemetry')
+        return self.telemetry
+
+    def close_telemetry(self):
+        """
+        Closes the telemetry backend, if it holds anything open, such as a
+        trace. A new one is created if telemetry is fetched again.
+        """
+        telemetry, self.telemetry = self.telemetry, None
+        close = getattr(telemetry, 'close', None)
+        if close is not None:
+            close()
 
     def _power_thread(self):
         """
         Sends power output to Alexa skill.
         """
 
-        charge_current_pid = 'FIXME'
-        load_current_pid = 'FIXME'
-        batt_voltage_pid = 'FIXME'
-        
-        time.sleep(2)
+        self.clock.sleep(2)
 
         while True:
             try:
-                # list properties_v2
-                api_response = api_instance.properties_v2_show(id, batt_voltage_pid)
-                print('Battery Voltage: ', round(api_response.last_value, 3))
-                voltage = round(api_response.last_value, 3)
-                voltage = 3.54
-                self.batt_voltage = voltage
-            except ApiException as e:
-                print("Exception when calling PropertiesV2Api->propertiesV2List: %s\n" % e)
+                values = self._get_telemetry().fetch()
+            except TelemetryError as e:
+                self.recorder.log("Exception when fetching telemetry: %s", e)
+                values = {}
+
+            payload = self._read_power(values)
+            self.clock.sleep(15)
+            self._send_event(EventName.POWER, payload)
+
+    def _read_power(self, values):
+        """
+        Prints the telemetry values and returns the POWER event payload.
+        """
+        if self.trace is not None:
+            self.trace.power(values)
+
+        voltage = values.get('batt_voltage')
+        load_current = values.get('load_current')
+        charge_current = values.get('charge_current')
+
+        if voltage is not None:
+            self.recorder.sensor("Battery", "voltage", round(voltage, 3))
+            voltage = round(voltage, 3)
+            if (voltage < LOW_VOLTAGE) != (self.batt_voltage < LOW_VOLTAGE):
+                self._light_event.set()
+            self.batt_voltage = voltage
+
+        if load_current is not None:
+            self.recorder.sensor("Load", "current", round(load_current, 2))
+            load_current = round(load_current, 1)
+
+        if charge_current is not None:
+            self.recorder.sensor("Charge", "current", round(charge_current, 2))
+            charge_current = round(charge_current, 1)
+
+        return {'voltage': voltage, 'load_current': load_current, 'charge_current': charge_current, 'light':self.light_intensity }
+
+
+class AsyncMindstormsGadget(MindstormsGadget):
+    """
+    A MindstormsGadget whose behaviors run as coroutines on one asyncio event
+    loop instead of five threads. Create it inside a running loop, or pass the
+    loop, then await start() and stop(). Move and command directives run as
+    tasks, one after another, so handling them never blocks the loop.
+    """
 
+    def __init__(self, loop=None, world=None, telemetry=None, seed=None, recorder=None, trace=None, events=None,
+                 battery=None):
+        """
+        :param loop: the event loop, defaults to the running loop
+        :param world: the simulated WorldState, defaults to the sim_vars globals
+        :param telemetry: see MindstormsGadget
+        :param seed: seed for the patrol random number generator
+        :param recorder: see MindstormsGadget
+        :param trace: see MindstormsGadget
+        :param events: see MindstormsGadget
+        :param battery: see MindstormsGadget
+        """
+        loop = loop if loop is not None else asyncio.get_running_loop()
+        self.tasks = []
+        self._directives = set()
+        self._last_directive = None
+        super().__init__(clock=sim_clock.LoopClock(loop, seed=seed), world=world, telemetry=telemetry,
+                         recorder=recorder, trace=trace, events=events, battery=battery)
+
+    def _start_behaviors(self):
+        pass
+
+    async def start(self):
+        """
+        Starts the behavior coroutines on the running loop.
+        """
+        loop = asyncio.get_running_loop()
+        self.tasks = [loop.create_task(behavior()) for behavior in (
+            self._patrol_task, self._follow_task, self._pat_task, self._power_task, self._light_sensor_task,
+            self._sentry_task, self.events.run_async)]
+        if self.power is not None:
+            self.tasks.append(loop.create_task(self.power.run_async()))
+
+    async def stop(self):
+        """
+        Cancels the behaviors, waits for them to finish, stops the motors and
+        closes the telemetry backend.
+        """
+        tasks, self.tasks = self.tasks + list(self._directives), []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.drive.off()
+        self.steerdrive.off()
+        self.close_telemetry()
+
+    def _control_move(self, payload):
+        # Expected params: [direction, duration, speed]
+        self._queue_directive(self._move_async(payload["direction"], int(payload["duration"]), int(payload["speed"])))
+
+    def _control_command(self, payload):
+        # Expected params: [command]
+        self._queue_directive(self._activate_async(payload["command"]))
+
+    def _queue_directive(self, coroutine):
+        """
+        Runs a directive's moves as a task once those of the directives before
+        it are done, as the threaded gadget handles them in turn.
+        """
+        previous = self._last_directive
+
+        async def run():
             try:
-                api_response = api_instance.properties_v2_show(id, load_current_pid)
-                print('Load Current: ', round(api_response.last_value, 2))
-                load_current = round(api_response.last_value, 1)
-            except ApiException as e:
-                print("Exception when calling PropertiesV2Api->propertiesV2List: %s\n" % e)
+                if previous is not None and not previous.done():
+                    await asyncio.wait((previous,))
+                await coroutine
+            finally:
+                coroutine.close()
+
+        task = self.clock.loop.create_task(run())
+        self._directives.add(task)
+        task.add_done_callback(self._directives.discard)
+        self._last_directive = task
+
+    async def _move_async(self, direction, duration: int, speed: int, is_blocking=False):
+        """
+        Like _move, but awaits the turn and, if is_blocking, the move.
+        """
+        move = DIRECTION_SLOTS.get(direction)
+        if move is Direction.RIGHT or move is Direction.LEFT:
+            self.recorder.log("Move command: (%s, %s, %s, %s)", direction, speed, duration, is_blocking)
+            self._turn(direction, speed, block=False)
+            await asyncio.sleep(self.drive.time_left())
+            self.drive.on_for_seconds(SpeedPercent(speed), SpeedPercent(speed), duration, block=False)
+        else:
+            self._move(direction, duration, speed)
+        if is_blocking:
+            await asyncio.sleep(self.drive.time_left())
+
+    async def _activate_async(self, command, speed=50):
+        """
+        Like _activate, but awaits the preset moves.
+        """
+        self.recorder.log("Activate command: (%s, %s)", command, speed)
+        preset = COMMAND_SLOTS.get(command)
+        if preset is Command.MOVE_CIRCLE:
+            self.drive.on_for_seconds(SpeedPercent(int(speed)), SpeedPercent(5), 12, block=False)
+            await asyncio.sleep(self.drive.time_left())
+
+        elif preset is Command.MOVE_SQUARE:
+            for i in range(4):
+                await self._move_async("right", 2, speed, is_blocking=True)
+
+        elif preset is Command.PATROL:
+            self.patrol_mode = True
+
+        elif preset is Command.SENTRY:
+            self.sentry_mode = True
+            self._send_event(EventName.SPEECH, {'speechOut': "Sentry mode activated"})
+
+            self.drive.on_for_seconds(SpeedPercent(80), SpeedPercent(-80), 0.2, block=False)
+            await asyncio.sleep(self.drive.time_left() + 0.3)
+            self.drive.on_for_seconds(SpeedPercent(-40), SpeedPercent(40), 0.2, block=False)
+            await asyncio.sleep(self.drive.time_left())
+
+            self.leds.set_color("LEFT", "YELLOW", 1)
+            self.leds.set_color("RIGHT", "YELLOW", 1)
+
+    async def _patrol_task(self):
+        while True:
+            while self.patrol_mode:
+                direction, duration, speed = self._patrol_choice()
+                await self._move_async(direction.value[0], duration, speed)
+                await asyncio.sleep(duration)
+            await self._patrol_event.wait_async()
+
+    async def _pat_task(self):
+        while True:
+            await self.touch.wait_for_bump_async()
+            sound = "Ahh, I like that."
+            self._send_event(EventName.SPEECH, {'speechOut': sound})
+
+    async def _light_sensor_task(self):
+        while True:
+            self.light.mode='COL-AMBIENT'
+            await asyncio.sleep(0.5)
+            self._light_event.clear()
+            self._read_light()
+            await self._light_event.wait_async()
 
+    async def _follow_task(self):
+        while True:
+            await self._follow_event.wait_async()
+
+            heading = self.ir.heading()
+            self.recorder.sensor("IR", "heading", heading)
+
+            if heading == 0:
+                await self.ir.wait_for_heading_change_async(timeout=1)
+                continue
+
+            self.steerdrive.on_for_rotations(-heading, SpeedPercent(30), 2, block=False)
+            await asyncio.sleep(self.steerdrive.time_left())
+
+            await asyncio.sleep(1)
+
+    async def _sentry_task(self):
+        while True:
+            await self._sentry_event.wait_async()
+            self.sentry.start()
             try:
-                api_response = api_instance.properties_v2_show(id, charge_current_pid)
-                print('Charge Current: ', round(api_response.last_value, 2))
-                charge_current = round(api_response.last_value, 1)
-            except ApiException as e:
-                print("Exception when calling PropertiesV2Api->propertiesV2List: %s\n" % e)
+                while self.sentry_mode:
+                    await asyncio.sleep(self.sentry.interval)
+                    self._send_sentry_events()
+            finally:
+                self.sentry.stop()
+
+    async def _power_task(self):
+        await asyncio.sleep(2)
 
-            time.sleep(15)
+        while True:
+            backend = self._get_telemetry()
+            try:
+                if isinstance(backend, SimTelemetryBackend):
+                    values = backend.fetch()
+                else:
+                    # The IoT client blocks on HTTP
+                    values = await asyncio.get_running_loop().run_in_executor(None, backend.fetch)
+            except TelemetryError as e:
+                self.recorder.log("Exception when fetching telemetry: %s", e)
+                values = {}
 
-            self._send_event(EventName.POWER, {'voltage': voltage, 'load_current': load_current, 'charge_current': charge_current, 'light':self.light_intensity })
-            
+            payload = self._read_power(values)
+            await asyncio.sleep(15)
+            self._send_event(EventName.POWER, payload)
 
 
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser(description="Run the Mindstorms gadget.")
+    parser.add_argument("--profile", metavar="PATH", help="write sampled stacks to PATH (folded format) on exit")
+    parser.add_argument("--metrics-port", type=int, default=None, help="serve metrics on this local port")
+    args = parser.parse_args()
+
+    if args.metrics_port is not None:
+        sim_metrics.enable()
+        sim_metrics.serve(args.metrics_port)
+    sampler = sim_profile.Sampler().start() if args.profile else None
+
     gadget = MindstormsGadget()
 
     # Set LCD font and turn off blinking LEDs
@@ -369,14 +791,20 @@ if __name__ == '__main__':
     gadget.leds.set_color("RIGHT", "BLACK")
 
     # Startup sequence
-    gadget.sound.play_song((('C4', 'e'), ('D4', 'e'), ('E5', 'q')))
+    gadget.sound.play_song(STARTUP_SONG)
     gadget.leds.set_color("LEFT", "GREEN")
     gadget.leds.set_color("RIGHT", "GREEN")
 
     # Gadget main entry point
-    gadget.main()
+    try:
+        gadget.main()
+    finally:
+        if sampler is not None:
+            sampler.stop().write(args.profile)
 
     # Shutdown sequence
-    gadget.sound.play_song((('E5', 'e'), ('C4', 'e')))
+    gadget.sound.play_song(SHUTDOWN_SONG)
     gadget.leds.set_color("LEFT", "BLACK")
     gadget.leds.set_color("RIGHT", "BLACK")
+    gadget.sound.close()
+    gadget.close_telemetry()
@@ -0,0 +1,10 @@
+"""
+The control directive object the Alexa Gadgets Toolkit hands to
+MindstormsGadget.on_custom_mindstorms_gadget_control, for code that drives a
+gadget without an Echo device.
+"""
+
+
+class LegoDirective():
+    def __init__(self, jsn):
+        self.payload = jsn
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Coverage analysis for patrol mode.
+
+Runs many seeded patrol episodes of a gadget in a house map across a process
+pool and measures how much of the house the patrol covers. Each episode runs
+on its own fast SimClock, whose seeded random.Random picks the patrol moves,
+so episodes are reproducible and independent of each other and of the pool
+layout.
+
+The floor is divided into square cells. An episode samples the pet's position
+at a fixed interval of simulated time and returns, per cell, how many samples
+fell in it and when it was first visited. The aggregate is the sum of the
+visit counts, which makes the heatmap, and the mean and spread of the
+fraction of reachable cells covered over time::
+
+    python patrol_coverage.py maps/house.json -n 200 --duration 3600 -o coverage
+
+writes coverage.png (the heatmap), coverage.csv (the coverage curves) and
+coverage.npz (the arrays).
+"""
+
+import argparse
+import csv
+import multiprocessing
+import os
+import struct
+import time
+import zlib
+
+import numpy as np
+
+import sim_batch
+import sim_clock
+import sim_recorder
+import sim_vars
+
+
+DEFAULT_DURATION = 3600
+DEFAULT_RESOLUTION = 0.25
+DEFAULT_SAMPLE = 1.0
+
+
+class CoverageGrid():
+    """
+    The cells of a house map that coverage is counted in.
+    """
+
+    def __init__(self, house, resolution=DEFAULT_RESOLUTION):
+        """
+        :param house: the HouseMap
+        :param resolution: the cell size in metres
+        """
+        self.house = house
+        self.resolution = float(resolution)
+        self.x0, self.y0, x1, y1 = house.bounds()
+        self.nx = max(1, int(np.ceil((x1 - self.x0) / self.resolution)))
+        self.ny = max(1, int(np.ceil((y1 - self.y0) / self.resolution)))
+
+        # A cell can be reached if the pet fits at its centre, which is in a
+        # room and not inside a piece of furniture
+        cx, cy = self.centres()
+        reachable = np.fromiter((house.room_at(x, y) is not None for x, y in zip(cx.ravel().tolist(), cy.ravel().tolist())),
+                                dtype=bool, count=cx.size).reshape(cx.shape)
+        for item in house.furniture:
+            x0, y0, x1, y1 = item['rect']
+            reachable &= ~((cx > min(x0, x1)) & (cx < max(x0, x1)) & (cy > min(y0, y1)) & (cy < max(y0, y1)))
+        self.reachable = reachable & ~house.collides_many(cx.ravel(), cy.ravel()).reshape(cx.shape)
+
+    @property
+    def shape(self):
+        return self.ny, self.nx
+
+    def centres(self):
+        """
+        The x and y coordinates of the cell centres, as (ny, nx) arrays.
+        """
+        xs = self.x0 + (np.arange(self.nx) + 0.5) * self.resolution
+        ys = self.y0 + (np.arange(self.ny) + 0.5) * self.resolution
+        return np.meshgrid(xs, ys)
+
+    def cells(self, x, y):
+        """
+        The flat cell indices of arrays of positions, clipped to the grid.
+        """
+        cx = np.clip(((np.asarray(x) - self.x0) // self.resolution).astype(np.intp), 0, self.nx - 1)
+        cy = np.clip(((np.asarray(y) - self.y0) // self.resolution).astype(np.intp), 0, self.ny - 1)
+        return cy * self.nx + cx
+
+    def random_start(self, rng):
+        """
+        A random pose at the centre of a reachable cell.
+        :param rng: a random.Random
+        """
+        cy, cx = np.nonzero(self.reachable)
+        i = rng.randrange(len(cx))
+        return (self.x0 + (cx[i] + 0.5) * self.resolution, self.y0 + (cy[i] + 0.5) * self.resolution,
+                rng.uniform(-np.pi, np.pi))
+
+
+def run_episode(episode):
+    """
+    Runs one patrol episode in this process.
+    :param episode: a dict with the house map path, and optionally the seed,
+        duration, start pose, sample interval and grid resolution
+    :return: a dict with the seed, the start pose, the collisions, the visit
+        counts per cell and the time each cell was first visited (inf if never)
+    """
+    from house_map import HouseEnvironment
+    from housepet_gadget import MindstormsGadget
+
+    seed = episode.get("seed", 0)
+    duration = episode.get("duration", DEFAULT_DURATION)
+    interval = episode.get("sample", DEFAULT_SAMPLE)
+    house = sim_batch.load_house(episode["house"])
+    grid = _grid(episode["house"], episode.get("resolution", DEFAULT_RESOLUTION))
+
+    clock = sim_clock.set_clock(sim_clock.SimClock(fast=True, seed=seed))
+    world = sim_vars.WorldState()
+    start = episode.get("start") or grid.random_start(clock.random)
+
+    recorder = sim_recorder.EventRecorder(level=sim_recorder.get_recorder().level, clock=clock)
+    gadget = MindstormsGadget(clock=clock, world=world, telemetry='sim', recorder=recorder, trace=False)
+    gadget.send_custom_event = lambda namespace, name, payload: None
+    env = HouseEnvironment(house, gadget, start)
+    env.start()
+
+    samples = int(duration / interval) + 1
+    xs = np.empty(samples)
+    ys = np.empty(samples)
+    try:
+        gadget.patrol_mode = True
+        for i in range(samples):
+            clock.run_until(i * interval)
+            xs[i] = world.pose_x
+            ys[i] = world.pose_y
+    finally:
+        clock.stop()
+
+    cells = grid.cells(xs, ys)
+    visits = np.bincount(cells, minlength=grid.nx * grid.ny).astype(np.uint32)
+    # np.unique gives the index of the first sample in each visited cell
+    visited, first = np.unique(cells, return_index=True)
+    first_visit = np.full(grid.nx * grid.ny, np.inf, dtype=np.float32)
+    first_visit[visited] = first * interval
+
+    return {
+        "seed": seed,
+        "start": tuple(start),
+        "collisions": env.collisions,
+        "visits": visits.reshape(grid.shape),
+        "first_visit": first_visit.reshape(grid.shape),
+    }
+
+
+_grids = {}
+
+
+def _grid(path, resolution):
+    key = (path, resolution)
+    grid = _grids.get(key)
+    if grid is None:
+        grid = _grids[key] = CoverageGrid(sim_batch.load_house(path), resolution)
+    return grid
+
+
+def coverage_curves(first_visits, reachable, times):
+    """
+    The fraction of reachable cells covered by each time, per episode.
+    :param first_visits: (episodes, ny, nx) first visit times
+    :param reachable: (ny, nx) bool mask of reachable cells
+    :param times: the times to evaluate at
+    :return: an (episodes, len(times)) array
+    """
+    firsts = np.sort(first_visits[:, reachable], axis=1)
+    total = max(1, int(reachable.sum()))
+    return np.stack([np.searchsorted(row, times, side='right') for row in firsts]) / total
+
+
+def run_coverage(house, episodes, seed=0, duration=DEFAULT_DURATION, sample=DEFAULT_SAMPLE,
+                 resolution=DEFAULT_RESOLUTION, start=None, processes=None, points=200):
+    """
+    Runs seeded patrol episodes across a process pool and aggregates them.
+    :param house: the house map file path
+    :param episodes: the number of episodes; episode i uses seed + i
+    :param duration: seconds of simulated time per episode
+    :param sample: seconds of simulated time between position samples
+    :param resolution: the grid cell size in metres
+    :param start: a fixed start pose (x, y, theta), or None for a random
+        reachable one per episode
+    :param processes: worker processes, defaults to the CPU count
+    :param points: the number of points on the coverage curves
+    :return: a dict with the grid, the summed visit counts, the curve times,
+        the per episode curves and collisions, and the wall time
+    """
+    specs = [{"house": house, "seed": seed + i, "duration": duration, "sample": sample,
+              "resolution": resolution, "start": start} for i in range(episodes)]
+    processes = processes or os.cpu_count()
+    chunksize = max(1, episodes // (processes * 4))
+
+    began = time.perf_counter()
+    with multiprocessing.Pool(processes, initializer=sim_batch.init_worker, initargs=(False, None)) as pool:
+        rows = pool.map(run_episode, specs, chunksize)
+    elapsed = time.perf_counter() - began
+
+    grid = _grid(house, resolution)
+    visits = np.sum([row["visits"] for row in rows], axis=0, dtype=np.uint64)
+    times = np.linspace(0, duration, points)
+    curves = coverage_curves(np.stack([row["first_visit"] for row in rows]), grid.reachable, times)
+    return {
+        "grid": grid,
+        "visits": visits,
+        "times": times,
+        "curves": curves,
+        "seeds": np.array([row["seed"] for row in rows]),
+        "collisions": np.array([row["collisions"] for row in rows]),
+        "wall_time": elapsed,
+    }
+
+
+def heatmap(visits, reachable, scale=8):
+    """
+    Renders visit counts as an RGB image, black through red and yellow to
+    white on a log scale, with unreachable cells grey. Row 0 is the top
+    (largest y) of the house.
+    :return: a (ny * scale, nx * scale, 3) uint8 array
+    """
+    level = np.log1p(visits.astype(np.float64))
+    if level.max() > 0:
+        level /= level.max()
+    stops = [0.0, 0.35, 0.7, 1.0]
+    rgb = np.stack([np.interp(level, stops, [0, 200, 255, 255]),
+                    np.interp(level, stops, [0, 30, 200, 255]),
+                    np.interp(level, stops, [0, 0, 0, 255])], axis=-1)
+    rgb[~reachable & (visits == 0)] = 64
+    rgb = rgb[::-1].astype(np.uint8)
+    return rgb.repeat(scale, axis=0).repeat(scale, axis=1)
+
+
+def write_png(path, rgb):
+    """
+    Writes an RGB uint8 array as a PNG file.
+    """
+    height, width, _ = rgb.shape
+    raw = b''.join(b'\x00' + row.tobytes() for row in np.ascontiguousarray(rgb))
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(raw, 6)))
+        f.write(chunk(b'IEND', b''))
+
+
+def write_results(result, prefix):
+    """
+    Writes prefix.png, prefix.csv and prefix.npz.
+    """
+    grid = result["grid"]
+    write_png(prefix + ".png", heatmap(result["visits"], grid.reachable))
+
+    curves = result["curves"]
+    mean = curves.mean(axis=0)
+    p10, p50, p90 = np.percentile(curves, [10, 50, 90], axis=0)
+    with open(prefix + ".csv", "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["time", "mean", "p10", "p50", "p90"])
+        writer.writerows(zip(result["times"].tolist(), mean.tolist(), p10.tolist(), p50.tolist(), p90.tolist()))
+
+    np.savez_compressed(prefix + ".npz", visits=result["visits"], reachable=grid.reachable, times=result["times"],
+                        curves=curves, seeds=result["seeds"], collisions=result["collisions"],
+                        origin=np.array([grid.x0, grid.y0]), resolution=grid.resolution)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure how much of a house patrol mode covers.")
+    parser.add_argument("house", help="house map JSON file")
+    parser.add_argument("-n", "--episodes", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first episode")
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION, help="simulated seconds per episode")
+    parser.add_argument("--sample", type=float, default=DEFAULT_SAMPLE, help="simulated seconds between samples")
+    parser.add_argument("--resolution", type=float, default=DEFAULT_RESOLUTION, help="grid cell size in metres")
+    parser.add_argument("--start", type=float, nargs=3, metavar=("X", "Y", "THETA"),
+                        help="start pose, random per episode if not given")
+    parser.add_argument("-j", "--processes", type=int, default=None, help="worker processes")
+    parser.add_argument("-o", "--output", default="coverage", help="output file prefix")
+    args = parser.parse_args(argv)
+
+    result = run_coverage(args.house, args.episodes, args.seed, args.duration, args.sample, args.resolution,
+                          args.start, args.processes)
+    write_results(result, args.output)
+
+    final = result["curves"][:, -1]
+    print("Episodes: {} in {:.2f}s".format(args.episodes, result["wall_time"]))
+    print("Coverage after {:.0f}s: mean {:.1%}, p10 {:.1%}, p90 {:.1%}".format(
+        args.duration, final.mean(), np.percentile(final, 10), np.percentile(final, 90)))
+    print("Collisions per episode: {:.1f}".format(result["collisions"].mean()))
+
+
+if __name__ == '__main__':
+    main()
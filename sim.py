@@ -1,61 +1,391 @@
-import time
-import tkinter as tk
-
-from random import randint
+#!/usr/bin/env python3
+"""
+Tk visualizer for simulated pets.
 
-import sim_vars
+The pets are AsyncMindstormsGadgets in a house map, all running as coroutines
+on one event loop on a simulation thread. That thread copies every pet's pose
+and LED colors into a snapshot at a fixed rate. The UI takes the latest
+snapshot at its own frame rate and draws it on a Canvas; a frame with no new
+snapshot draws nothing. Snapshots are double buffered with a spare, so
+neither side waits for the other beyond swapping two references, and the UI
+never sees a half written snapshot.
 
-from housepet_gadget import MindstormsGadget
+Each pet is one triangle pointing the way it faces, filled with its left LED
+color and outlined with its right one. Only the pets that moved or changed
+color since the last frame are redrawn::
 
-counter = None
+    python sim.py --pets 500
+    python sim.py --pets 20 --follow --house maps/house.json
+"""
 
-# This function is called whenever the button is pressed
-def count():
-    global counter
-    # Increment counter by 1
-    counter.set(counter.get() + 1)
+import argparse
+import asyncio
+import math
+import random
+import threading
+import time
 
+import numpy as np
 
-class LegoDirective():
-    def __init__(self, jsn):
-        self.payload = jsn
+import sim_recorder
+import sim_vars
+from ev3dev2.led import GROUP_INDEX, LEDS, FleetLeds
+from lego_directive import LegoDirective
 
 
 def follow_directive():
     return LegoDirective(b'{"type":"follow"}')
 
+
 def stopfollow_directive():
     return LegoDirective(b'{"type":"stopfollow"}')
 
-# Read values from the sensors at regular intervals
-def poll():
 
-    counter.set(5)
+class Snapshot():
+    """
+    The poses and LED brightness of every pet at one simulated time.
+    """
 
-    # Schedule the poll() f
+    __slots__ = ('time', 'seq', 'x', 'y', 'theta', 'leds', 'beacon')
 
-if __name__ == '__main__':
-    # Create the main window
-    root = tk.Tk()
-    root.title("Counter")
+    def __init__(self, n):
+        self.time = 0.0
+        self.seq = 0
+        self.x = np.zeros(n)
+        self.y = np.zeros(n)
+        self.theta = np.zeros(n)
+        # LED brightness per pet, in ev3dev2.led.LEDS order
+        self.leds = np.zeros((n, len(LEDS)))
+        self.beacon = None
+
+
+class SnapshotBuffer():
+    """
+    Passes snapshots from one writer thread to one reader thread. The writer
+    fills back() and publishes it; the reader takes the latest published
+    snapshot, which stays untouched until the reader takes the next one.
+    """
+
+    def __init__(self, n):
+        self._lock = threading.Lock()
+        self._back = Snapshot(n)
+        self._latest = Snapshot(n)
+        self._front = Snapshot(n)
+        self._fresh = False
+        self._seq = 0
+
+    def back(self):
+        """
+        The snapshot to fill next. Writer only.
+        """
+        return self._back
+
+    def publish(self):
+        with self._lock:
+            self._seq += 1
+            self._back.seq = self._seq
+            self._back, self._latest = self._latest, self._back
+            self._fresh = True
+
+    def take(self):
+        """
+        The latest snapshot, or None if none was published since the last take.
+        """
+        with self._lock:
+            if not self._fresh:
+                return None
+            self._front, self._latest = self._latest, self._front
+            self._fresh = False
+            return self._front
+
+
+class PetSimulation():
+    """
+    Runs pets in a house on a thread of their own and publishes snapshots.
+    """
+
+    def __init__(self, house, pets, behavior='patrol', rate=60.0, seed=None):
+        """
+        :param house: the house_map.HouseMap
+        :param pets: the number of pets
+        :param behavior: 'patrol' or 'follow'
+        :param rate: snapshots per second
+        :param seed: seed for the start poses and the pets' random choices
+        """
+        self.house = house
+        self.pets = pets
+        self.behavior = behavior
+        self.rate = rate
+        self.seed = seed
+        self.buffer = SnapshotBuffer(pets)
+        self.gadgets = []
+        # Every pet's LEDs live in one array, so a snapshot copies them at once
+        self.leds = FleetLeds(pets)
+        self.snapshot_time = 0.0
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='simulation', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping = True
+        self._thread.join()
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self._main())
+        finally:
+            loop.close()
+
+    def _start_poses(self, rng):
+        x0, y0, x1, y1 = self.house.bounds()
+        poses = []
+        while len(poses) < self.pets:
+            x, y = rng.uniform(x0, x1), rng.uniform(y0, y1)
+            if self.house.room_at(x, y) is not None and not self.house.collides(x, y):
+                poses.append((x, y, rng.uniform(-math.pi, math.pi)))
+        return poses
+
+    async def _main(self):
+        from house_map import HouseEnvironment
+        from housepet_gadget import AsyncMindstormsGadget
+
+        rng = random.Random(self.seed)
+        recorder = sim_recorder.EventRecorder(level=sim_recorder.OFF)
+        envs = []
+        for start in self._start_poses(rng):
+            gadget = AsyncMindstormsGadget(world=sim_vars.WorldState(), telemetry='sim', recorder=recorder,
+                                           trace=False, seed=rng.randrange(1 << 30))
+            gadget.send_custom_event = lambda namespace, name, payload: None
+            self.leds.adopt(len(self.gadgets), gadget.leds)
+            envs.append(HouseEnvironment(self.house, gadget, start))
+            self.gadgets.append(gadget)
+
+        tasks = [asyncio.ensure_future(env.run_async()) for env in envs]
+        for gadget in self.gadgets:
+            await gadget.start()
+            # The LEDs show the behavior, as the startup sequence does
+            gadget.leds.set_color("LEFT", "GREEN")
+            gadget.leds.set_color("RIGHT", "GREEN")
+            if self.behavior == 'follow':
+                gadget.on_custom_mindstorms_gadget_control(follow_directive())
+            else:
+                gadget.patrol_mode = True
+
+        loop = asyncio.get_running_loop()
+        period = 1.0 / self.rate
+        next_at = loop.time()
+        try:
+            while not self._stopping:
+                started = time.perf_counter()
+                self._snapshot(loop.time())
+                self.snapshot_time = time.perf_counter() - started
+                next_at += period
+                await asyncio.sleep(max(0.0, next_at - loop.time()))
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*(gadget.stop() for gadget in self.gadgets), *tasks, return_exceptions=True)
+
+    def _snapshot(self, now):
+        snap = self.buffer.back()
+        x, y, theta = snap.x, snap.y, snap.theta
+        for i, gadget in enumerate(self.gadgets):
+            x[i], y[i], theta[i] = gadget.drive.pose
+        snap.leds[:] = self.leds.framebuffer
+        snap.time = now
+        snap.beacon = self.house.beacon
+        self.buffer.publish()
+
+
+# Pet triangle corners in body coordinates, metres: nose, back left, back right
+PET_SHAPE = np.array([[0.18, 0.0], [-0.1, 0.09], [-0.1, -0.09]])
 
-    # Tkinter variable for holding a counter
-    counter = tk.IntVar()
-    counter.set(0)
+LED_LEVELS = 16
 
-    # Create widgets (note that command is set to count and not count() )
-    label_counter = tk.Label(root, width=7, textvariable=counter)
-    button_counter = tk.Button(root, text="Count", command=count)
 
-    # Lay out widgets
-    label_counter.pack()
-    button_counter.pack()
+def led_color(red, green):
+    return "#{:02x}{:02x}00".format(int(min(red, 1) * 255), int(min(green, 1) * 255))
 
-    gadget = MindstormsGadget()
-    gadget.on_connected(8)
-    time.sleep(1)
-    gadget.on_custom_mindstorms_gadget_control(follow_directive())
 
-    # Schedule the poll() function to be called periodically
-    root.after(500, poll)
+class Visualizer():
+    """
+    Draws the snapshots of a PetSimulation on a Tk Canvas at a fixed frame
+    rate.
+    """
+
+    def __init__(self, root, simulation, fps=60, width=1000, height=750, frames=None):
+        """
+        :param root: the Tk root window
+        :param simulation: the PetSimulation
+        :param fps: frames per second
+        :param width: the canvas width in pixels
+        :param height: the canvas height in pixels
+        :param frames: if set, quit after this many frames and print the
+            achieved frame rate
+        """
+        import tkinter as tk
+
+        self.root = root
+        self.simulation = simulation
+        self.buffer = simulation.buffer
+        self.period = 1.0 / fps
+        self.frames = frames
+        self.canvas = tk.Canvas(root, width=width, height=height, background='#202020', highlightthickness=0)
+        self.canvas.pack(fill=tk.BOTH, expand=True)
+
+        house = simulation.house
+        x0, y0, x1, y1 = house.bounds()
+        margin = 20
+        self.scale = min((width - 2 * margin) / (x1 - x0), (height - 2 * margin) / (y1 - y0))
+        # Screen y grows downwards
+        self.origin = (margin - x0 * self.scale, height - margin + y0 * self.scale)
+        self._draw_house(house)
+
+        n = simulation.pets
+        self.items = [self.canvas.create_polygon(0, 0, 0, 0, 0, 0, fill='', outline='', width=2) for _ in range(n)]
+        self._drawn = np.full((n, 6), np.nan)
+        self._drawn_colors = np.full((n, 2), -1, dtype=np.int32)
+        self._beacon = None
+        self._status = self.canvas.create_text(8, 8, anchor='nw', fill='white', font=('TkFixedFont', 9))
+
+        self._frame_count = 0
+        self._drawn_count = 0
+        self._draw_time = 0.0
+        self._stats_at = time.perf_counter()
+        self._started_at = self._stats_at
+        self._next_at = self._stats_at
+        root.protocol("WM_DELETE_WINDOW", self.close)
+
+    def to_screen(self, x, y):
+        return self.origin[0] + x * self.scale, self.origin[1] - y * self.scale
+
+    def _draw_house(self, house):
+        canvas = self.canvas
+        for room in house.rooms:
+            x0, y0 = self.to_screen(room['rect'][0], room['rect'][1])
+            x1, y1 = self.to_screen(room['rect'][2], room['rect'][3])
+            shade = 0x30 + int(min(room.get('light', house.default_light), 100) / 100 * 0x40)
+            canvas.create_rectangle(x0, y0, x1, y1, fill="#{0:02x}{0:02x}{0:02x}".format(shade), outline='')
+        for item in house.furniture:
+            x0, y0 = self.to_screen(item['rect'][0], item['rect'][1])
+            x1, y1 = self.to_screen(item['rect'][2], item['rect'][3])
+            canvas.create_rectangle(x0, y0, x1, y1, fill='#6b5030', outline='')
+        for wx0, wy0, wx1, wy1 in house.walls:
+            canvas.create_line(*self.to_screen(wx0, wy0), *self.to_screen(wx1, wy1), fill='#d0d0d0', width=3)
+
+    def _draw_beacon(self, beacon):
+        if self._beacon is None:
+            self._beacon = self.canvas.create_oval(0, 0, 0, 0, fill='#ff3030', outline='white')
+        bx, by = self.to_screen(*beacon)
+        self.canvas.coords(self._beacon, bx - 6, by - 6, bx + 6, by + 6)
+
+    def start(self):
+        self.root.after(0, self._frame)
+
+    def close(self):
+        self.simulation.stop()
+        self.root.destroy()
+
+    def _frame(self):
+        now = time.perf_counter()
+        snap = self.buffer.take()
+        if snap is not None:
+            self.draw(snap)
+            self._drawn_count += 1
+        self._draw_time += time.perf_counter() - now
+        self._frame_count += 1
+
+        if now - self._stats_at >= 1.0:
+            self._show_stats(now)
+        if self.frames is not None and self._frame_count >= self.frames:
+            elapsed = time.perf_counter() - self._started_at
+            print("{} frames in {:.2f}s: {:.1f} fps".format(self._frame_count, elapsed, self._frame_count / elapsed))
+            self.close()
+            return
+
+        # Keep to the frame rate without drifting, skipping frames if behind
+        self._next_at += self.period
+        if self._next_at < now:
+            self._next_at = now + self.period
+        self.root.after(max(1, int((self._next_at - time.perf_counter()) * 1000)), self._frame)
+
+    def _show_stats(self, now):
+        elapsed = now - self._stats_at
+        self.canvas.itemconfigure(self._status, text="{} pets  {:.1f} fps  {:.1f} new/s  draw {:.2f} ms  "
+                                  "snapshot {:.2f} ms".format(
+                                      len(self.items), self._frame_count / elapsed, self._drawn_count / elapsed,
+                                      self._draw_time / max(self._frame_count, 1) * 1000,
+                                      self.simulation.snapshot_time * 1000))
+        self.canvas.tag_raise(self._status)
+        self._frame_count = self._drawn_count = 0
+        self._draw_time = 0.0
+        self._stats_at = now
+
+    def draw(self, snap):
+        """
+        Moves and recolors the pets that changed since the last drawn snapshot.
+        """
+        cos = np.cos(snap.theta)[:, None]
+        sin = np.sin(snap.theta)[:, None]
+        px = snap.x[:, None] + PET_SHAPE[:, 0] * cos - PET_SHAPE[:, 1] * sin
+        py = snap.y[:, None] + PET_SHAPE[:, 0] * sin + PET_SHAPE[:, 1] * cos
+        points = np.empty((len(snap.x), 6))
+        # Rounded to whole pixels, so pets that moved less than a pixel are skipped
+        points[:, 0::2] = np.rint(self.origin[0] + px * self.scale)
+        points[:, 1::2] = np.rint(self.origin[1] - py * self.scale)
+
+        canvas = self.canvas
+        items = self.items
+        moved = np.flatnonzero(np.any(points != self._drawn, axis=1))
+        if len(moved):
+            rows = points[moved].tolist()
+            for i, row in zip(moved.tolist(), rows):
+                canvas.coords(items[i], row)
+            self._drawn[moved] = points[moved]
+
+        # Colors as (red, green) levels packed into one int per group
+        left = snap.leds[:, GROUP_INDEX['LEFT']]
+        right = snap.leds[:, GROUP_INDEX['RIGHT']]
+        levels = np.rint(np.stack([left, right], axis=1) * LED_LEVELS).astype(np.int32)
+        colors = levels[:, :, 0] * (LED_LEVELS + 1) + levels[:, :, 1]
+        changed = np.flatnonzero(np.any(colors != self._drawn_colors, axis=1))
+        for i in changed.tolist():
+            canvas.itemconfigure(items[i], fill=led_color(*left[i]), outline=led_color(*right[i]))
+        self._drawn_colors[changed] = colors[changed]
+
+        if snap.beacon is not None:
+            self._draw_beacon(snap.beacon)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Watch simulated pets in a house.")
+    parser.add_argument("--pets", type=int, default=50)
+    parser.add_argument("--house", default="maps/house.json", help="house map JSON file")
+    parser.add_argument("--rooms", type=int, default=None, help="generate a house of ROOMS x ROOMS rooms instead")
+    parser.add_argument("--follow", action="store_true", help="follow the beacon instead of patrolling")
+    parser.add_argument("--fps", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--frames", type=int, default=None, help="quit after this many frames and print the fps")
+    args = parser.parse_args(argv)
+
+    import tkinter as tk
+
+    from house_map import HouseMap
+
+    house = HouseMap.generate(args.rooms, args.rooms, seed=args.seed) if args.rooms else HouseMap.load(args.house)
+    simulation = PetSimulation(house, args.pets, 'follow' if args.follow else 'patrol', args.fps, args.seed)
+
+    root = tk.Tk()
+    root.title("House pets")
+    visualizer = Visualizer(root, simulation, args.fps, frames=args.frames)
+    simulation.start()
+    visualizer.start()
     root.mainloop()
+
+
+if __name__ == '__main__':
+    main()
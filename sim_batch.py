@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""
+Headless batch runner for simulated gadget episodes.
+
+Each episode builds one MindstormsGadget on a fast, seeded clock with the
+simulated telemetry backend, replays the scheduled world state changes and
+directives, and records what the gadget did.
+Episodes are spread over a multiprocessing pool and the results are gathered
+into a single columnar file.
+
+Scenario files are JSON. Either list the episodes explicitly::
+
+    {"episodes": [{"seed": 1, "duration": 60,
+                   "sim_vars": {"ir_beacon_heading": [[0, 2], [10, -3]],
+                                "touch_bump": [[5, true]]},
+                   "directives": [[1, {"type": "follow"}]]}]}
+
+or give a base episode and a sweep. Every combination of the swept values is
+run, with dotted keys addressing fields of the base episode::
+
+    {"base": {"duration": 60, "directives": [[1, {"type": "follow"}]]},
+     "sweep": {"seed": [1, 2, 3], "sim_vars.ir_beacon_heading": [-5, 0, 5]}}
+
+A sim_vars entry names a sim_vars.WorldState field and is either a constant or
+a list of [time, value] pairs. Each episode gets its own WorldState. An
+episode's optional "trace" is a path to write a sim_trace trace of it to.
+
+An episode with a "house" map file (see house_map) runs the pet in that
+house from its "start" pose [x, y, theta]: the map then drives the touch, IR
+and light sensors, and the results include the number of collisions.
+
+An episode with "battery": true, or a dict of sim_power.BatteryModel
+settings, models the battery from what the pet does; the power readings then
+follow it and the results include the final state of charge.
+
+An episode with "jingles": true plays the startup jingle at the start and the
+shutdown jingle at the end, taking their duration in simulated time.
+"""
+
+import argparse
+import copy
+import csv
+import functools
+import glob
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import sim_clock
+import sim_profile
+import sim_recorder
+import sim_vars
+from lego_directive import LegoDirective
+
+
+DEFAULT_DURATION = 60
+
+
+def load_scenario(path):
+    """
+    Loads a scenario file and expands it into a list of episode specs.
+    :param path: the scenario file path
+    """
+    with open(path) as f:
+        scenario = json.load(f)
+
+    episodes = list(scenario.get("episodes", []))
+
+    if "base" in scenario or "sweep" in scenario:
+        base = scenario.get("base", {})
+        sweep = scenario.get("sweep", {})
+        keys = list(sweep)
+        for values in itertools.product(*(sweep[key] for key in keys)):
+            episode = copy.deepcopy(base)
+            for key, value in zip(keys, values):
+                _set_path(episode, key, value)
+            episodes.append(episode)
+
+    return episodes
+
+
+def _set_path(spec, path, value):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        spec = spec.setdefault(part, {})
+    spec[parts[-1]] = value
+
+
+def timeline(episode):
+    """
+    Merges the sim_vars trajectories and directives of an episode into one
+    time ordered list of (time, kind, key, value).
+    """
+    timeline = []
+    for name, trajectory in episode.get("sim_vars", {}).items():
+        if not isinstance(trajectory, list):
+            trajectory = [[0, trajectory]]
+        for when, value in trajectory:
+            timeline.append((when, 0, name, value))
+
+    for when, payload in episode.get("directives", []):
+        timeline.append((when, 1, None, payload))
+
+    # Stable sort keeps file order for simultaneous entries.
+    timeline.sort(key=lambda entry: (entry[0], entry[1]))
+    return timeline
+
+
+@functools.lru_cache(maxsize=8)
+def load_house(path):
+    """
+    Loads a house map file, cached so the episodes of a sweep share it.
+    """
+    from house_map import HouseMap
+
+    return HouseMap.load(path)
+
+
+def episode_battery(episode):
+    """
+    The gadget battery argument for an episode's "battery".
+    """
+    battery = episode.get("battery")
+    if isinstance(battery, dict):
+        import sim_power
+
+        battery = sim_power.BatteryModel.from_dict(battery)
+    return battery
+
+
+def run_episode(episode):
+    """
+    Runs one episode in this process and returns a dict of results.
+    :param episode: the episode spec
+    """
+    from housepet_gadget import SHUTDOWN_SONG, STARTUP_SONG, MindstormsGadget
+
+    seed = episode.get("seed", 0)
+    duration = episode.get("duration", DEFAULT_DURATION)
+    clock = sim_clock.set_clock(sim_clock.SimClock(fast=True, seed=seed))
+    world = sim_vars.WorldState()
+
+    events = []
+    errors = 0
+    start = time.perf_counter()
+
+    recorder = sim_recorder.EventRecorder(level=sim_recorder.get_recorder().level, clock=clock)
+    gadget = MindstormsGadget(clock=clock, world=world, telemetry='sim', recorder=recorder,
+                              trace=episode.get("trace", False), battery=episode_battery(episode))
+    gadget.send_custom_event = lambda namespace, name, payload: events.append(name)
+
+    house = None
+    if "house" in episode:
+        from house_map import HouseEnvironment
+
+        house = HouseEnvironment(load_house(episode["house"]), gadget, episode.get("start", (0.0, 0.0, 0.0)))
+        house.start()
+
+    jingles = episode.get("jingles", False)
+    try:
+        if jingles:
+            gadget.sound.play_song(STARTUP_SONG)
+        for when, kind, name, value in timeline(episode):
+            if when > duration:
+                break
+            clock.run_until(when)
+            if kind == 0:
+                setattr(world, name, value)
+                continue
+            try:
+                gadget.on_custom_mindstorms_gadget_control(LegoDirective(json.dumps(value).encode("utf-8")))
+            except Exception:
+                errors += 1
+        clock.run_until(duration)
+        if jingles:
+            gadget.sound.play_song(SHUTDOWN_SONG)
+    finally:
+        clock.stop()
+        if gadget.trace is not None:
+            gadget.trace.close()
+
+    return episode_results(gadget, events, errors, house, seed, duration, time.perf_counter() - start)
+
+
+def episode_results(gadget, events, errors, house, seed, duration, wall_time):
+    """
+    The results of an episode that has been run.
+    :param events: the names of the events the gadget sent
+    :param house: the HouseEnvironment, or None
+    """
+    world = gadget.world
+    x, y, theta = gadget.drive.pose
+    if gadget.power is not None:
+        gadget.power.update()
+
+    return {
+        "seed": seed,
+        "duration": duration,
+        "sim_time": gadget.clock.now(),
+        "wall_time": wall_time,
+        "led_count": world.led_count,
+        "pose_x": x,
+        "pose_y": y,
+        "pose_theta": theta,
+        "patrol_mode": gadget.patrol_mode,
+        "follow_mode": gadget.follow_mode,
+        "events": len(events),
+        "speech_events": events.count("Speech"),
+        "power_events": events.count("Power"),
+        "sentry_events": events.count("Sentry"),
+        "proximity_events": events.count("Proximity"),
+        "errors": errors,
+        "collisions": house.collisions if house is not None else 0,
+        "soc": gadget.power.soc if gadget.power is not None else None,
+        "sound_time": gadget.sound.played,
+    }
+
+
+def _run_indexed(item):
+    index, episode = item
+    result = run_episode(episode)
+    result["episode"] = index
+    return result
+
+
+def init_worker(verbose, profile):
+    """
+    Sets up a worker process of a sweep: silences its output unless verbose,
+    and samples it to profile + '.<pid>' if a profile path is given.
+    """
+    if not verbose:
+        sim_recorder.get_recorder().level = sim_recorder.OFF
+        devnull = open(os.devnull, "w")
+        sys.stdout = devnull
+        sys.stderr = devnull
+    if profile:
+        # Written when the worker exits after the pool is closed
+        sampler = sim_profile.Sampler().start()
+        multiprocessing.util.Finalize(None, _write_profile, args=(sampler, "{}.{}".format(profile, os.getpid())),
+                                      exitpriority=10)
+
+
+def _write_profile(sampler, path):
+    sampler.stop().write(path)
+
+
+def run_batch(episodes, processes=None, verbose=False, profile=None):
+    """
+    Runs the episodes across a process pool.
+    :param episodes: the episode specs
+    :param processes: the number of worker processes, defaults to the CPU count
+    :param verbose: if set, keep the gadget console output of the workers
+    :param profile: if set, sample the workers and write their combined
+        stacks to this file in the folded format
+    :return: the results as a dict of columns, ordered by episode
+    """
+    processes = processes or os.cpu_count()
+    chunksize = max(1, len(episodes) // (processes * 4))
+
+    with multiprocessing.Pool(processes, initializer=init_worker, initargs=(verbose, profile)) as pool:
+        rows = list(pool.imap_unordered(_run_indexed, enumerate(episodes), chunksize))
+        pool.close()
+        pool.join()
+
+    if profile:
+        parts = glob.glob(glob.escape(profile) + ".*")
+        sim_profile.merge_folded(parts, profile)
+        for part in parts:
+            os.remove(part)
+
+    rows.sort(key=lambda row: row["episode"])
+    return columns(rows)
+
+
+def columns(rows):
+    """
+    Turns a list of result dicts into a dict of columns.
+    """
+    columns = {}
+    for row in rows:
+        for key, value in row.items():
+            columns.setdefault(key, []).append(value)
+    return columns
+
+
+def write_columns(columns, path):
+    """
+    Writes columnar results as CSV if the path ends in .csv, otherwise JSON.
+    """
+    if path.endswith(".csv"):
+        keys = list(columns)
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(keys)
+            writer.writerows(zip(*(columns[key] for key in keys)))
+    else:
+        with open(path, "w") as f:
+            json.dump(columns, f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run simulated gadget episodes headless.")
+    parser.add_argument("scenario", help="scenario JSON file")
+    parser.add_argument("-o", "--output", default="results.json", help="results file (.json or .csv)")
+    parser.add_argument("-j", "--processes", type=int, default=None, help="worker processes")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show gadget output from the workers")
+    parser.add_argument("--profile", metavar="PATH", help="write sampled worker stacks to PATH (folded format)")
+    args = parser.parse_args(argv)
+
+    episodes = load_scenario(args.scenario)
+    processes = args.processes or os.cpu_count()
+
+    start = time.perf_counter()
+    results = run_batch(episodes, processes, args.verbose, args.profile)
+    elapsed = time.perf_counter() - start
+
+    write_columns(results, args.output)
+
+    rate = len(episodes) / elapsed if elapsed else 0.0
+    print("Episodes: {} in {:.2f}s on {} processes".format(len(episodes), elapsed, processes))
+    print("Throughput: {:.1f} episodes/s, {:.1f} episodes/s per core".format(rate, rate / processes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+"""
+Checkpoints of a running episode, to fork what-if branches from.
+
+A Simulation runs an episode spec, as sim_batch does, but with an
+AsyncMindstormsGadget on a virtual-time event loop: the behaviors, the house
+and battery model and every pending timer run as coroutines in this one
+thread. Directives that block, such as "square", run the loop themselves
+until they return.
+
+checkpoint() forks the process. The copy-on-write child holds the whole
+simulation as it was, mode flags, sensor values, motors and pose, the random
+number generator and the waiting coroutines included, and forks again for
+each branch asked of it. A branch replaces the rest of the episode's
+schedule with its own and runs on to its duration, so trying the bump 2 s
+later costs a fork rather than a replay from the start::
+
+    sim = Simulation({"seed": 1, "house": "maps/house.json",
+                      "directives": [[1, {"type": "command", "command": "patrol"}]]})
+    sim.run_until(40)
+    with sim.checkpoint() as checkpoint:
+        results = checkpoint.branches([{"duration": 120, "sim_vars": {"touch_bump": [[40 + delay, True]]}}
+                                       for delay in (0, 1, 2)])
+
+Branches of a checkpoint run one at a time, and the simulation it was taken
+from can go on running meanwhile. Checkpoints need os.fork, so POSIX only.
+
+From the command line, each episode of a scenario is run to --at and then
+every branch of a second scenario file is run from there::
+
+    python sim_checkpoint.py scenario.json --at 40 --branches branches.json -o results.csv
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+import sim_batch
+import sim_clock
+import sim_recorder
+import sim_vars
+from lego_directive import LegoDirective
+
+
+WORLD_FIELDS = tuple(slot.lstrip('_') for slot in sim_vars.WorldState.__slots__ if slot != 'bus')
+
+
+class BranchError(Exception):
+    """
+    Raised when a branch fails. The message holds the branch's traceback.
+    """
+
+
+class Simulation():
+    """
+    One episode running on a virtual-time event loop in this thread.
+    """
+
+    def __init__(self, episode=None):
+        """
+        :param episode: the episode spec, see sim_batch
+        """
+        from housepet_gadget import STARTUP_SONG, AsyncMindstormsGadget
+
+        episode = episode if episode is not None else {}
+        self.seed = episode.get("seed", 0)
+        self.duration = episode.get("duration", sim_batch.DEFAULT_DURATION)
+        self.jingles = episode.get("jingles", False)
+        self.events = []
+        self.errors = 0
+        self._started = time.perf_counter()
+
+        self.loop = sim_clock.new_event_loop(virtual=True)
+        recorder = sim_recorder.EventRecorder(level=sim_recorder.get_recorder().level)
+        self.gadget = AsyncMindstormsGadget(loop=self.loop, world=sim_vars.WorldState(), telemetry='sim',
+                                            seed=self.seed, recorder=recorder, trace=False,
+                                            battery=sim_batch.episode_battery(episode))
+        self.clock = self.gadget.clock
+        recorder.clock = self.clock
+        self.gadget.send_custom_event = lambda namespace, name, payload: self.events.append(name)
+
+        self.house = None
+        if "house" in episode:
+            from house_map import HouseEnvironment
+
+            self.house = HouseEnvironment(sim_batch.load_house(episode["house"]), self.gadget,
+                                          episode.get("start", (0.0, 0.0, 0.0)))
+        self._tasks = []
+        self.loop.run_until_complete(self._start())
+
+        # The timeline entries still to come
+        self._pending = sim_batch.timeline(episode)
+        if self.jingles:
+            self.gadget.sound.play_song(STARTUP_SONG)
+
+    async def _start(self):
+        await self.gadget.start()
+        if self.house is not None:
+            self._tasks.append(asyncio.ensure_future(self.house.run_async()))
+
+    def now(self):
+        return self.clock.now()
+
+    def run_until(self, when):
+        """
+        Runs the simulation, applying the episode's sim_vars and directives
+        as they come due, until the given simulated time or the end of the
+        episode, whichever is first.
+        """
+        when = min(when, self.duration)
+        pending = self._pending
+        while pending and pending[0][0] <= when:
+            at, kind, name, value = pending.pop(0)
+            self._advance(at)
+            if kind == 0:
+                setattr(self.gadget.world, name, value)
+                continue
+            try:
+                self.gadget.on_custom_mindstorms_gadget_control(
+                    LegoDirective(json.dumps(value).encode("utf-8")))
+            except Exception:
+                self.errors += 1
+        self._advance(when)
+
+    def _advance(self, when):
+        # Run the loop to an absolute time, so rounding does not pile up
+        now = self.now()
+        if when > now:
+            future = self.loop.create_future()
+            self.loop.call_at(self.loop.time() + (when - now), future.set_result, None)
+            self.loop.run_until_complete(future)
+
+    def run(self):
+        """
+        Runs the episode to its end and returns its results.
+        """
+        from housepet_gadget import SHUTDOWN_SONG
+
+        self.run_until(self.duration)
+        if self.jingles:
+            self.gadget.sound.play_song(SHUTDOWN_SONG)
+        return self.results()
+
+    def results(self):
+        """
+        The results so far, with the same columns as sim_batch.
+        """
+        return sim_batch.episode_results(self.gadget, self.events, self.errors, self.house, self.seed,
+                                         self.duration, time.perf_counter() - self._started)
+
+    def apply(self, branch):
+        """
+        Replaces the rest of the schedule with a branch's. A branch is an
+        episode fragment: its "duration" replaces the episode's, each field
+        in its "sim_vars" replaces what was still to come for that field, and
+        its "directives", if given, replace the directives still to come.
+        Entries before the current time are applied straight away.
+        """
+        self.duration = branch.get("duration", self.duration)
+        fields = set(branch.get("sim_vars", {}))
+        directives = "directives" in branch
+        now = self.now()
+        kept = [entry for entry in self._pending
+                if not (entry[2] in fields if entry[1] == 0 else directives)]
+        added = [(max(at, now), kind, name, value) for at, kind, name, value in sim_batch.timeline(branch)]
+        self._pending = sorted(kept + added, key=lambda entry: (entry[0], entry[1]))
+
+    def state(self):
+        """
+        A compact, JSON serializable summary of the simulation state, to
+        compare runs and branches by.
+        """
+        gadget = self.gadget
+        world = gadget.world
+        gadget.drive.pose
+        motors = (gadget.drive.left_motor, gadget.drive.right_motor)
+        return {
+            "time": self.now(),
+            "modes": {
+                "patrol_mode": gadget.patrol_mode,
+                "follow_mode": gadget.follow_mode,
+                "sentry_mode": getattr(gadget, "sentry_mode", False),
+            },
+            "world": {name: getattr(world, name) for name in WORLD_FIELDS},
+            "motors": [[motor.address, motor.speed, motor.position, motor.stop_time()] for motor in motors],
+            "leds": gadget.leds.framebuffer.tolist(),
+            "random": hashlib.sha1(repr(self.clock.random.getstate()).encode()).hexdigest(),
+            "timers": sorted(handle.when() for handle in self.loop._scheduled if not handle.cancelled()),
+            "pending": len(self._pending),
+        }
+
+    def checkpoint(self):
+        """
+        Forks a copy of the simulation as it is now to run branches from.
+        """
+        return Checkpoint(self)
+
+    def close(self):
+        """
+        Stops the gadget and closes the event loop.
+        """
+        for task in self._tasks:
+            task.cancel()
+        self.loop.run_until_complete(self.gadget.stop())
+        if self._tasks:
+            self.loop.run_until_complete(asyncio.gather(*self._tasks, return_exceptions=True))
+        self.loop.close()
+
+    def _serve(self, conn):
+        """
+        Runs in the checkpoint process: forks a branch for every request
+        until told to stop.
+        """
+        while True:
+            try:
+                branch = conn.recv()
+            except EOFError:
+                return
+            if branch is None:
+                return
+
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    self._started = time.perf_counter()
+                    self.apply(branch)
+                    reply = (True, self.run())
+                except BaseException:
+                    reply = (False, traceback.format_exc())
+                conn.send(reply)
+                sys.stdout.flush()
+                os._exit(0)
+
+            _, status = os.waitpid(pid, 0)
+            if status:
+                conn.send((False, "branch process exited with status {}".format(status)))
+
+
+class Checkpoint():
+    """
+    A forked copy of a Simulation, frozen at the time it was taken.
+    """
+
+    def __init__(self, simulation):
+        self.time = simulation.now()
+        self._conn, conn = multiprocessing.Pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            self._conn.close()
+            try:
+                simulation._serve(conn)
+            finally:
+                sys.stdout.flush()
+                os._exit(0)
+        conn.close()
+        self.pid = pid
+
+    def branch(self, branch=None):
+        """
+        Runs a branch from the checkpoint in a fresh fork and returns its
+        results. The checkpoint itself is left as it is.
+        :param branch: the branch spec, see Simulation.apply. None or {}
+            runs the rest of the episode unchanged.
+        """
+        self._conn.send(branch if branch is not None else {})
+        ok, value = self._conn.recv()
+        if not ok:
+            raise BranchError(value)
+        value["checkpoint"] = self.time
+        return value
+
+    def branches(self, branches):
+        """
+        Runs branches one after another and returns their results, each
+        with its index in "branch".
+        """
+        rows = []
+        for index, branch in enumerate(branches):
+            row = self.branch(branch)
+            row["branch"] = index
+            rows.append(row)
+        return rows
+
+    def close(self):
+        """
+        Stops the checkpoint process.
+        """
+        if self.pid is None:
+            return
+        try:
+            self._conn.send(None)
+        except OSError:
+            pass
+        self._conn.close()
+        os.waitpid(self.pid, 0)
+        self.pid = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run what-if branches from a checkpoint of each episode.")
+    parser.add_argument("scenario", help="scenario JSON file, see sim_batch")
+    parser.add_argument("--at", type=float, required=True, help="simulated time to checkpoint at")
+    parser.add_argument("--branches", required=True,
+                        help="JSON file of branch specs, in the scenario format")
+    parser.add_argument("-o", "--output", default="branches.json", help="results file (.json or .csv)")
+    args = parser.parse_args(argv)
+
+    episodes = sim_batch.load_scenario(args.scenario)
+    branches = sim_batch.load_scenario(args.branches)
+
+    start = time.perf_counter()
+    rows = []
+    for index, episode in enumerate(episodes):
+        simulation = Simulation(episode)
+        simulation.run_until(args.at)
+        with simulation.checkpoint() as checkpoint:
+            for row in checkpoint.branches(branches):
+                row["episode"] = index
+                rows.append(row)
+        simulation.close()
+    elapsed = time.perf_counter() - start
+
+    sim_batch.write_columns(sim_batch.columns(rows), args.output)
+    print("Branches: {} from {} checkpoints in {:.2f}s".format(len(rows), len(episodes), elapsed))
+
+
+if __name__ == '__main__':
+    main()
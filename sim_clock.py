@@ -0,0 +1,396 @@
+"""
+Simulation clock shared by the gadget threads, agt and the ev3dev2 stubs.
+
+In real-time mode sleeps are plain wall clock sleeps. In fast mode the clock is
+virtual: only one thread started through the clock runs at a time, and when it
+sleeps the clock jumps straight to the next scheduled wakeup. Because the
+threads take turns in (wakeup time, sleep order), a run with a fixed seed is
+reproducible.
+
+Gadgets whose behaviors are coroutines use a LoopClock instead, which follows
+the time of their asyncio event loop. new_event_loop(fast=True) makes a loop
+that also jumps straight to its next timer.
+"""
+
+import asyncio
+import heapq
+import random
+import selectors
+import threading
+import time
+
+
+class ClockStopped(Exception):
+    """
+    Raised inside sleeping threads when their clock is stopped.
+    """
+
+
+class SimClock():
+    """
+    A clock and scheduler for simulated time.
+    """
+
+    def __init__(self, fast=False, seed=None, start=0.0, rate=1.0):
+        """
+        :param fast: if set, jump to the next wakeup instead of waiting for it
+        :param seed: seed for the clock's random number generator
+        :param start: the simulated time at which the clock starts
+        :param rate: simulated seconds per wall clock second when not fast
+        """
+        self.fast = fast
+        self.rate = rate
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.stopped = False
+
+        self._start = start
+        self._now = start
+        self._t0 = time.monotonic()
+        self._cond = threading.Condition()
+        self._sleepers = []
+        self._seq = 0
+        # Events threads are waiting on in real time, so stop can wake them
+        self._waiting = {}
+
+    def now(self):
+        """
+        Returns the current simulated time in seconds.
+        """
+        if self.fast:
+            return self._now
+        return self._start + (time.monotonic() - self._t0) * self.rate
+
+    def sleep(self, seconds):
+        """
+        Sleeps for the given number of simulated seconds.
+        :param seconds: the duration to sleep
+        """
+        if self.stopped:
+            raise ClockStopped()
+
+        if not self.fast:
+            time.sleep(max(seconds, 0) / self.rate)
+            return
+
+        with self._cond:
+            token = [False]
+            self._schedule(token, self._now + max(seconds, 0))
+            self._dispatch()
+            self._wait_turn(token)
+
+    def wait(self, event, timeout=None):
+        """
+        Waits until the event is set or the timeout, in simulated seconds,
+        passes. In fast mode the waiting thread gives up its turn, so it costs
+        nothing until the event is set.
+        :param event: the ClockEvent to wait on
+        :param timeout: the longest time to wait, or None to wait forever
+        :return: whether the event is set
+        """
+        if self.stopped:
+            raise ClockStopped()
+
+        if not self.fast:
+            with self._cond:
+                self._waiting[event] = self._waiting.get(event, 0) + 1
+            try:
+                with event._cond:
+                    event._cond.wait_for(lambda: event._flag or self.stopped,
+                                         timeout if timeout is None else timeout / self.rate)
+            finally:
+                with self._cond:
+                    self._waiting[event] -= 1
+                    if not self._waiting[event]:
+                        del self._waiting[event]
+            if self.stopped:
+                raise ClockStopped()
+            return event._flag
+
+        with self._cond:
+            token = [False]
+            with event._cond:
+                if event._flag:
+                    return True
+                event._parked.append((self, token))
+            if timeout is not None:
+                self._schedule(token, self._now + max(timeout, 0))
+            self._dispatch()
+            try:
+                self._wait_turn(token)
+            finally:
+                with event._cond:
+                    if (self, token) in event._parked:
+                        event._parked.remove((self, token))
+        return event._flag
+
+    def run_until(self, when):
+        """
+        Sleeps until the given simulated time.
+        :param when: the simulated time to wake at
+        """
+        self.sleep(when - self.now())
+
+    def spawn(self, target, *args):
+        """
+        Starts a daemon thread that is scheduled by this clock.
+        In fast mode the thread does not run until the running thread sleeps.
+        :param target: the thread function
+        :param args: arguments passed to the thread function
+        """
+        if self.fast:
+            token = [False]
+            with self._cond:
+                self._schedule(token, self._now)
+        else:
+            token = None
+
+        thread = threading.Thread(target=self._run, args=(token, target, args), daemon=True,
+                                  name=getattr(target, '__name__', None))
+        thread.start()
+        return thread
+
+    def stop(self):
+        """
+        Stops the clock. Threads sleeping on it raise ClockStopped and exit.
+        """
+        with self._cond:
+            self.stopped = True
+            self._cond.notify_all()
+            waiting = list(self._waiting)
+        for event in waiting:
+            with event._cond:
+                event._cond.notify_all()
+
+    def _run(self, token, target, args):
+        try:
+            if token is not None:
+                with self._cond:
+                    self._wait_turn(token)
+            target(*args)
+        except ClockStopped:
+            pass
+        finally:
+            if token is not None:
+                with self._cond:
+                    self._dispatch()
+
+    def _wake(self, token):
+        """
+        Schedules a thread waiting on an event to run at the current time.
+        """
+        with self._cond:
+            self._schedule(token, self._now)
+
+    def _schedule(self, token, when):
+        """
+        Adds a wakeup for a token. A token can have several wakeups; the first
+        one to be dispatched wins. Must be called with the lock held.
+        """
+        self._seq += 1
+        heapq.heappush(self._sleepers, (when, self._seq, token))
+
+    def _wait_turn(self, token):
+        while not token[0]:
+            if self.stopped:
+                raise ClockStopped()
+            self._cond.wait()
+
+    def _dispatch(self):
+        """
+        Hands the turn to the earliest sleeper. Must be called with the lock held.
+        """
+        while self._sleepers:
+            when, seq, token = heapq.heappop(self._sleepers)
+            if token[0]:
+                continue
+            self._now = max(self._now, when)
+            token[0] = True
+            self._cond.notify_all()
+            return
+
+
+class ClockEvent():
+    """
+    A flag that threads can wait on in simulated time, see SimClock.wait.
+    """
+
+    def __init__(self):
+        self._flag = False
+        self._cond = threading.Condition()
+        self._parked = []
+        self._futures = []
+
+    def is_set(self):
+        return self._flag
+
+    def set(self):
+        """
+        Sets the flag and wakes every waiting thread.
+        """
+        with self._cond:
+            self._flag = True
+            parked, self._parked = self._parked, []
+            futures, self._futures = self._futures, []
+            self._cond.notify_all()
+        for clock, token in parked:
+            clock._wake(token)
+        for loop, future in futures:
+            loop.call_soon_threadsafe(_resolve, future)
+
+    def clear(self):
+        with self._cond:
+            self._flag = False
+
+    def wait(self, timeout=None, clock=None):
+        """
+        Waits on the given clock, or the shared one, until the flag is set.
+        """
+        return (clock if clock is not None else _clock).wait(self, timeout)
+
+    async def wait_async(self, timeout=None):
+        """
+        Waits on the running event loop until the flag is set.
+        :param timeout: the longest time to wait in loop seconds, or None
+        :return: whether the flag is set
+        """
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            if self._flag:
+                return True
+            future = loop.create_future()
+            self._futures.append((loop, future))
+
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._cond:
+                if (loop, future) in self._futures:
+                    self._futures.remove((loop, future))
+        return self._flag
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(True)
+
+
+class LoopClock(SimClock):
+    """
+    A clock that follows an asyncio event loop's time, for gadgets whose
+    behaviors run as coroutines on that loop. Coroutines sleep with
+    asyncio.sleep; the blocking sleep and wait work off the loop thread, or
+    between runs of the loop, when they run it themselves until they return.
+    """
+
+    def __init__(self, loop, seed=None, start=0.0):
+        super().__init__(fast=False, seed=seed, start=start)
+        self.loop = loop
+        self._t0 = loop.time()
+
+    def now(self):
+        return self._start + self.loop.time() - self._t0
+
+    def sleep(self, seconds):
+        if self.stopped:
+            raise ClockStopped()
+        self._check_thread()
+        self._complete(asyncio.sleep(seconds))
+
+    def wait(self, event, timeout=None):
+        if self.stopped:
+            raise ClockStopped()
+        self._check_thread()
+        return self._complete(event.wait_async(timeout))
+
+    def spawn(self, target, *args):
+        raise RuntimeError("LoopClock runs coroutines, not threads")
+
+    def _complete(self, coroutine):
+        if not self.loop.is_running():
+            return self.loop.run_until_complete(coroutine)
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def _check_thread(self):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if running is self.loop:
+            raise RuntimeError("blocking call on the event loop thread, await instead")
+
+
+class _FastForwardSelector():
+    """
+    Wraps a selector so that waiting for the next timer advances a time offset
+    instead of blocking. Waiting with no timer pending still blocks.
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.offset = 0.0
+
+    def select(self, timeout=None):
+        events = self.selector.select(0)
+        if events or timeout is None or timeout <= 0:
+            return events or self.selector.select(timeout)
+        self.offset += timeout
+        return []
+
+    def __getattr__(self, name):
+        return getattr(self.selector, name)
+
+
+class _FastForwardEventLoop(asyncio.SelectorEventLoop):
+
+    def __init__(self, virtual=False):
+        super().__init__(_FastForwardSelector())
+        self._virtual = virtual
+
+    def time(self):
+        if self._virtual:
+            return self._selector.offset
+        return time.monotonic() + self._selector.offset
+
+
+def new_event_loop(fast=False, virtual=False):
+    """
+    Creates an asyncio event loop. A fast loop jumps straight to its next
+    timer whenever nothing is ready, so asyncio.sleep takes no wall time.
+    The time of a virtual loop, which is also fast, starts at 0 and moves
+    only by those jumps, so the time spent computing does not leak into it
+    and a run is reproducible.
+    """
+    if fast or virtual:
+        return _FastForwardEventLoop(virtual)
+    return asyncio.new_event_loop()
+
+
+_clock = SimClock()
+
+
+def get_clock():
+    """
+    Returns the clock shared by the simulator modules.
+    """
+    return _clock
+
+
+def set_clock(clock):
+    """
+    Replaces the shared clock, e.g. with SimClock(fast=True, seed=1).
+    :param clock: the new shared clock
+    """
+    global _clock
+    _clock = clock
+    return clock
+
+
+def now():
+    return _clock.now()
+
+
+def sleep(seconds):
+    _clock.sleep(seconds)
@@ -0,0 +1,514 @@
+#!/usr/bin/env python3
+"""
+Runs a scenario's episodes on worker processes spread over several hosts.
+
+A Coordinator holds the episodes of a scenario and serves them over TCP or a
+Unix socket. Workers, on this host or others with the same checkout, connect,
+pull episodes in batches, run them with sim_batch.run_episode and stream each
+result back as soon as it is done. Every message is one length-prefixed
+frame of compact JSON, and every worker message is answered by one reply, so
+a worker's messages double as its heartbeat.
+
+- batches: a worker asks for more work when half of its batch is done, so it
+  never waits on the network between episodes
+- work stealing: when no episodes are left to hand out, an idle worker gets
+  the back half of the busiest worker's batch, and that worker is told to
+  drop those episodes
+- retry: the episodes of a worker that disconnects, or is silent for longer
+  than the lease, go back to the front of the queue, up to attempts times
+- deduplication: an episode can end up run twice, by a worker that was
+  given up on or one whose stolen episodes were already started; only the
+  first result is kept
+
+Run the coordinator and the workers with::
+
+    python sim_dist.py coordinator scenario.json --listen 0.0.0.0:8700 -o results.csv
+    python sim_dist.py worker --connect coordinator-host:8700 -j 4
+
+or everything on this host, with a coordinator and -j local workers::
+
+    python sim_dist.py local scenario.json -j 4 -o results.csv
+"""
+
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import socket
+import socketserver
+import struct
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+import sim_batch
+
+
+FRAME = struct.Struct('>I')
+
+# Longest frame accepted, so a bad peer cannot make us allocate gigabytes
+MAX_FRAME = 64 << 20
+
+
+def encode_frame(message):
+    """
+    A message as one frame: its length, then its compact JSON.
+    """
+    data = json.dumps(message, separators=(',', ':')).encode('utf-8')
+    return FRAME.pack(len(data)) + data
+
+
+def read_frame(file):
+    """
+    Reads one frame from a binary file and returns the message.
+    :raises EOFError: if the connection closed
+    """
+    header = file.read(FRAME.size)
+    if len(header) < FRAME.size:
+        raise EOFError()
+    length, = FRAME.unpack(header)
+    if length > MAX_FRAME:
+        raise ValueError("frame of {} bytes is too long".format(length))
+    data = file.read(length)
+    if len(data) < length:
+        raise EOFError()
+    return json.loads(data)
+
+
+def parse_address(text):
+    """
+    A 'host:port' string as a (host, port) TCP address. Anything else is
+    the path of a Unix socket.
+    """
+    host, sep, port = text.rpartition(':')
+    if sep and port.isdigit() and '/' not in text:
+        return (host or '127.0.0.1', int(port))
+    return text
+
+
+class _WorkerState():
+
+    def __init__(self):
+        # Episodes handed to the worker and not yet finished, in order
+        self.outstanding = []
+        # Episodes stolen from the worker that it has not been told about
+        self.cancel = []
+        self.last_seen = time.monotonic()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        self.disable_nagle_algorithm = isinstance(self.server, _TCPServer)
+        super().setup()
+
+    def handle(self):
+        coordinator = self.server.coordinator
+        name = None
+        try:
+            while True:
+                message = read_frame(self.rfile)
+                name = message.get('worker', name)
+                self.wfile.write(encode_frame(coordinator.handle(name, message)))
+        except (EOFError, ValueError, OSError):
+            pass
+        finally:
+            if name is not None:
+                coordinator.lost(name)
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class Coordinator():
+    """
+    Hands out episodes to workers and gathers their results.
+    """
+
+    def __init__(self, episodes, address=('127.0.0.1', 0), lease=60.0, attempts=3, delay=0.05):
+        """
+        :param episodes: the episode specs
+        :param address: a (host, port) to listen on, or a Unix socket path
+        :param lease: seconds a worker may go without a message before its
+            episodes are handed to others
+        :param attempts: how many times an episode is handed out before it
+            is given up on
+        :param delay: seconds a worker with nothing to do waits before asking again
+        """
+        self.episodes = list(episodes)
+        self.lease = lease
+        self.attempts = attempts
+        self.delay = delay
+        # Episode index to result, and to the error it was given up with
+        self.results = {}
+        self.failed = {}
+        self.duplicates = 0
+        self.retries = 0
+        self.steals = 0
+
+        self._pending = collections.deque(range(len(self.episodes)))
+        self._tries = [0] * len(self.episodes)
+        self._workers = {}
+        self._owner = {}
+        self._cond = threading.Condition()
+
+        if isinstance(address, tuple):
+            self.server = _TCPServer(address, _Handler)
+        else:
+            if os.path.exists(address):
+                os.remove(address)
+            self.server = _UnixServer(address, _Handler)
+        self.server.coordinator = self
+        self.address = self.server.server_address
+
+    def start(self):
+        """
+        Serves on a background thread.
+        """
+        threading.Thread(target=self.server.serve_forever, name='Coordinator', daemon=True).start()
+        return self
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if not isinstance(self.address, tuple) and os.path.exists(self.address):
+            os.remove(self.address)
+
+    def finished(self):
+        return len(self.results) + len(self.failed) == len(self.episodes)
+
+    def handle(self, name, message):
+        """
+        Takes a worker's results and returns the reply: more episodes, the
+        episodes stolen from it, or that there is nothing left to do.
+        """
+        with self._cond:
+            worker = self._workers.get(name)
+            if worker is None:
+                worker = self._workers[name] = _WorkerState()
+            worker.last_seen = time.monotonic()
+
+            for index, result in message.get('results', ()):
+                self._finish(index, result)
+            for index, error in message.get('errors', ()):
+                self._release(index, error)
+            self._reap()
+
+            if self.finished():
+                return {'op': 'done'}
+
+            tasks = []
+            want = message.get('want', 0)
+            while len(tasks) < want and self._pending:
+                index = self._pending.popleft()
+                self._tries[index] += 1
+                tasks.append(index)
+            if want and not tasks and not worker.outstanding:
+                tasks = self._steal()
+            for index in tasks:
+                self._owner[index] = name
+            worker.outstanding.extend(tasks)
+
+            cancel, worker.cancel = worker.cancel, []
+            return {'op': 'work', 'tasks': [[index, self.episodes[index]] for index in tasks], 'cancel': cancel,
+                    'delay': self.delay}
+
+    def lost(self, name):
+        """
+        Hands a disconnected worker's episodes back to the queue.
+        """
+        with self._cond:
+            worker = self._workers.pop(name, None)
+            if worker is not None:
+                self._requeue(worker)
+
+    def wait(self, timeout=None):
+        """
+        Waits until every episode has a result or has been given up on,
+        checking the leases meanwhile.
+        :return: whether all episodes are finished
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while not self.finished():
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(min(1.0, self.lease, remaining if remaining is not None else 1.0))
+                self._reap()
+            return True
+
+    def columns(self):
+        """
+        The results as a dict of columns, ordered by episode, with the
+        episode index in 'episode'.
+        """
+        with self._cond:
+            rows = [dict(self.results[index], episode=index) for index in sorted(self.results)]
+        return sim_batch.columns(rows)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'episodes': len(self.episodes),
+                'finished': len(self.results),
+                'failed': len(self.failed),
+                'pending': len(self._pending),
+                'workers': len(self._workers),
+                'retries': self.retries,
+                'steals': self.steals,
+                'duplicates': self.duplicates,
+            }
+
+    # The methods below are called with the lock held
+
+    def _finish(self, index, result):
+        if index in self.results or index in self.failed:
+            self.duplicates += 1
+            return
+        self.results[index] = result
+        self._disown(index)
+        if index in self._pending:
+            self._pending.remove(index)
+        self._cond.notify_all()
+
+    def _release(self, index, error):
+        """
+        Puts an episode that failed or was lost back in the queue, or gives
+        up on it after too many attempts.
+        """
+        if index in self.results or index in self.failed:
+            return
+        self._disown(index)
+        if index in self._pending:
+            return
+        if self._tries[index] >= self.attempts:
+            self.failed[index] = error
+            self._cond.notify_all()
+        else:
+            self.retries += 1
+            self._pending.appendleft(index)
+
+    def _disown(self, index):
+        owner = self._workers.get(self._owner.pop(index, None))
+        if owner is not None and index in owner.outstanding:
+            owner.outstanding.remove(index)
+
+    def _requeue(self, worker):
+        # Back to the front in their original order
+        for index in reversed(list(worker.outstanding)):
+            self._release(index, "lost with its worker")
+        worker.outstanding = []
+
+    def _reap(self):
+        now = time.monotonic()
+        for name, worker in list(self._workers.items()):
+            if worker.outstanding and now - worker.last_seen > self.lease:
+                self._requeue(worker)
+
+    def _steal(self):
+        """
+        Takes the back half of the batch of the worker with the most
+        episodes outstanding. The first episode is left, as it is probably
+        running.
+        """
+        victim = max(self._workers.values(), key=lambda worker: len(worker.outstanding), default=None)
+        if victim is None or len(victim.outstanding) < 2:
+            return []
+        count = len(victim.outstanding) // 2
+        stolen = victim.outstanding[-count:]
+        del victim.outstanding[-count:]
+        victim.cancel.extend(stolen)
+        self.steals += count
+        return stolen
+
+
+def _connect(address, timeout):
+    """
+    Connects to the coordinator, retrying until the timeout in case it is
+    still starting.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if isinstance(address, tuple):
+                sock = socket.create_connection(address)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            else:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    sock.connect(address)
+                except OSError:
+                    sock.close()
+                    raise
+            return sock
+        except OSError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.2)
+
+
+def run_worker(address, batch=4, name=None, connect_timeout=30.0):
+    """
+    Pulls episodes from a coordinator and runs them until it has none left.
+    :param address: the coordinator's (host, port) or Unix socket path
+    :param batch: how many episodes to hold at once
+    :param name: the worker's name, unique per coordinator, defaults to host:pid
+    :param connect_timeout: seconds to keep trying to connect
+    :return: the number of episodes run
+    """
+    name = name or "{}:{}".format(socket.gethostname(), os.getpid())
+    sock = _connect(address, connect_timeout)
+    rfile = sock.makefile('rb')
+    queue = collections.deque()
+    results = []
+    errors = []
+    ran = 0
+    try:
+        while True:
+            want = batch - len(queue) if len(queue) <= batch // 2 else 0
+            sock.sendall(encode_frame({'worker': name, 'want': want, 'results': results, 'errors': errors}))
+            results = []
+            errors = []
+            reply = read_frame(rfile)
+            if reply['op'] == 'done':
+                return ran
+
+            if reply['cancel']:
+                cancel = set(reply['cancel'])
+                queue = collections.deque(task for task in queue if task[0] not in cancel)
+            queue.extend(reply['tasks'])
+            if not queue:
+                time.sleep(reply['delay'])
+                continue
+
+            index, episode = queue.popleft()
+            try:
+                results.append([index, sim_batch.run_episode(episode)])
+            except Exception:
+                errors.append([index, traceback.format_exc()])
+            ran += 1
+    except EOFError:
+        # The coordinator went away
+        return ran
+    finally:
+        rfile.close()
+        sock.close()
+
+
+def _worker_main(address, batch, verbose):
+    sim_batch.init_worker(verbose, None)
+    run_worker(address, batch)
+
+
+def start_workers(address, count, batch=4, verbose=False):
+    """
+    Starts worker processes on this host and returns them.
+    """
+    workers = [multiprocessing.Process(target=_worker_main, args=(address, batch, verbose), daemon=True)
+               for _ in range(count)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+def run_local(episodes, workers=None, batch=4, unix=False, verbose=False, lease=60.0, attempts=3):
+    """
+    Runs the episodes through a coordinator and worker processes on this
+    host, over TCP on the loopback interface or a Unix socket.
+    :return: the coordinator, once every episode is finished
+    """
+    workers = workers or os.cpu_count()
+    address = ('127.0.0.1', 0)
+    directory = None
+    if unix:
+        directory = tempfile.mkdtemp()
+        address = os.path.join(directory, 'coordinator.sock')
+    coordinator = Coordinator(episodes, address, lease, attempts).start()
+    try:
+        processes = start_workers(coordinator.address, workers, batch, verbose)
+        while not coordinator.wait(timeout=1.0):
+            if not any(process.is_alive() for process in processes):
+                raise RuntimeError("all workers exited with {} episodes unfinished".format(
+                    len(coordinator.episodes) - len(coordinator.results) - len(coordinator.failed)))
+        for process in processes:
+            process.join()
+    finally:
+        coordinator.close()
+        if directory is not None:
+            os.rmdir(directory)
+    return coordinator
+
+
+def _report(coordinator, elapsed):
+    stats = coordinator.stats()
+    rate = stats['finished'] / elapsed if elapsed else 0.0
+    print("Episodes: {} finished, {} failed in {:.2f}s ({:.1f} episodes/s)".format(
+        stats['finished'], stats['failed'], elapsed, rate))
+    print("Retries: {}, stolen: {}, duplicate results: {}".format(
+        stats['retries'], stats['steals'], stats['duplicates']))
+    for index, error in sorted(coordinator.failed.items()):
+        print("Episode {} failed: {}".format(index, error.strip().splitlines()[-1]), file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Distribute simulated gadget episodes over worker processes.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve = commands.add_parser("coordinator", help="serve a scenario's episodes to workers")
+    serve.add_argument("scenario", help="scenario JSON file, see sim_batch")
+    serve.add_argument("--listen", default="127.0.0.1:8700", help="host:port or Unix socket path")
+    serve.add_argument("-o", "--output", default="results.json", help="results file (.json or .csv)")
+    serve.add_argument("--lease", type=float, default=60.0, help="seconds before a silent worker is given up on")
+    serve.add_argument("--attempts", type=int, default=3, help="times an episode is tried")
+
+    work = commands.add_parser("worker", help="run episodes from a coordinator")
+    work.add_argument("--connect", default="127.0.0.1:8700", help="host:port or Unix socket path")
+    work.add_argument("-j", "--processes", type=int, default=None, help="worker processes")
+    work.add_argument("--batch", type=int, default=4, help="episodes each worker holds at once")
+    work.add_argument("-v", "--verbose", action="store_true", help="show gadget output from the workers")
+
+    local = commands.add_parser("local", help="run a coordinator and workers on this host")
+    local.add_argument("scenario", help="scenario JSON file, see sim_batch")
+    local.add_argument("-o", "--output", default="results.json", help="results file (.json or .csv)")
+    local.add_argument("-j", "--processes", type=int, default=None, help="worker processes")
+    local.add_argument("--batch", type=int, default=4, help="episodes each worker holds at once")
+    local.add_argument("--unix", action="store_true", help="connect over a Unix socket instead of TCP")
+    local.add_argument("-v", "--verbose", action="store_true", help="show gadget output from the workers")
+    args = parser.parse_args(argv)
+
+    if args.command == "worker":
+        processes = start_workers(parse_address(args.connect), args.processes or os.cpu_count(), args.batch,
+                                  args.verbose)
+        for process in processes:
+            process.join()
+        return
+
+    episodes = sim_batch.load_scenario(args.scenario)
+    start = time.perf_counter()
+    if args.command == "local":
+        coordinator = run_local(episodes, args.processes, args.batch, args.unix, args.verbose)
+    else:
+        coordinator = Coordinator(episodes, parse_address(args.listen), args.lease, args.attempts).start()
+        print("Serving {} episodes on {}".format(len(episodes), args.listen))
+        try:
+            coordinator.wait()
+        finally:
+            coordinator.close()
+    elapsed = time.perf_counter() - start
+
+    sim_batch.write_columns(coordinator.columns(), args.output)
+    _report(coordinator, elapsed)
+
+
+if __name__ == '__main__':
+    main()
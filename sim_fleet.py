@@ -0,0 +1,218 @@
+"""
+Vectorized fleet simulator for the follow-the-beacon behavior.
+
+Advances N robots at once with NumPy, using the control law of
+MindstormsGadget._follow_thread: read the IR heading, do nothing for a second
+if it is 0 (beacon lost), otherwise drive MoveSteering.on_for_rotations with
+steering -heading, SpeedPercent(30) and 2 rotations, then wait a second.
+
+The IR heading follows the pet's sensor mounting: a beacon to the robot's left
+reads as a positive heading, so steering by -heading turns towards it.
+
+Given a house_map.HouseMap, walls and furniture block the IR beacon and stop
+robots that run into them.
+"""
+
+import numpy as np
+
+from ev3dev2.motor import AXLE_TRACK, WHEEL_DIAMETER, LargeMotor, SpeedPercent
+
+
+# EV3 large motor rated speed, in tacho counts (degrees) per second
+MOTOR_MAX_SPEED = LargeMotor.max_speed
+
+# IR seeker model
+IR_MAX_HEADING = 25
+IR_DEGREES_PER_HEADING = 3.0
+IR_RANGE = 2.0
+
+# _follow_thread parameters
+FOLLOW_SPEED_PERCENT = 30
+FOLLOW_ROTATIONS = 2
+FOLLOW_POLL = 1.0
+
+
+def steering_speeds(steering, speed):
+    """
+    Splits a MoveSteering steering value (-100 to 100) and speed into left and
+    right motor speeds, like MoveSteering.get_speed_steering.
+    :param steering: array of steering values
+    :param speed: the speed, in any unit
+    """
+    steering = np.asarray(steering, dtype=np.float64)
+    slow = speed - speed * np.abs(steering) / 50.0
+    left = np.where(steering < 0, slow, speed)
+    right = np.where(steering > 0, slow, speed)
+    return left, right
+
+
+class FleetSim():
+    """
+    N robots following their beacons, stored as parallel arrays.
+    """
+
+    def __init__(self, x, y, theta, beacon_x, beacon_y, house=None):
+        """
+        :param x: robot x positions in metres
+        :param y: robot y positions in metres
+        :param theta: robot headings in radians, counter-clockwise from +x
+        :param beacon_x: beacon x positions, one per robot
+        :param beacon_y: beacon y positions, one per robot
+        :param house: an optional house_map.HouseMap the robots drive in
+        """
+        self.house = house
+        self.x = np.array(x, dtype=np.float64)
+        self.y = np.array(y, dtype=np.float64)
+        self.theta = np.array(theta, dtype=np.float64)
+        self.beacon_x = np.array(beacon_x, dtype=np.float64)
+        self.beacon_y = np.array(beacon_y, dtype=np.float64)
+
+        n = len(self.x)
+        self.time = 0.0
+        self.ir_heading = np.zeros(n, dtype=np.int8)
+        self.steering = np.zeros(n, dtype=np.int16)
+        self.left_speed = np.zeros(n)
+        self.right_speed = np.zeros(n)
+        self.drive_left = np.zeros(n)
+        self.idle_left = np.zeros(n)
+        self.collisions = 0
+
+    @classmethod
+    def random(cls, n, seed=None, radius=1.5):
+        """
+        Places n robots at the origin with random headings and a beacon at a
+        random point within radius of each.
+        """
+        rng = np.random.default_rng(seed)
+        angle = rng.uniform(-np.pi, np.pi, n)
+        dist = radius * np.sqrt(rng.uniform(0.0, 1.0, n))
+        return cls(np.zeros(n), np.zeros(n), rng.uniform(-np.pi, np.pi, n),
+                   dist * np.cos(angle), dist * np.sin(angle))
+
+    @classmethod
+    def in_house(cls, house, n, seed=None):
+        """
+        Places n robots at random free spots of a HouseMap with random
+        headings, all following the house's beacon.
+        """
+        rng = np.random.default_rng(seed)
+        x0, y0, x1, y1 = house.bounds()
+        x = np.empty(n)
+        y = np.empty(n)
+        placed = 0
+        while placed < n:
+            px, py = rng.uniform(x0, x1), rng.uniform(y0, y1)
+            if house.room_at(px, py) is not None and not house.collides(px, py):
+                x[placed], y[placed] = px, py
+                placed += 1
+        bx, by = house.beacon
+        return cls(x, y, rng.uniform(-np.pi, np.pi, n), np.full(n, bx), np.full(n, by), house=house)
+
+    def __len__(self):
+        return len(self.x)
+
+    def beacon_distance(self):
+        return np.hypot(self.beacon_x - self.x, self.beacon_y - self.y)
+
+    def read_ir_heading(self):
+        """
+        Computes every robot's IR heading, 0 where the beacon is out of view.
+        """
+        if self.house is not None:
+            return self.house.ir_headings(self.x, self.y, self.theta, self.beacon_x, self.beacon_y)
+
+        dx = self.beacon_x - self.x
+        dy = self.beacon_y - self.y
+        bearing = np.arctan2(dy, dx) - self.theta
+        bearing = (bearing + np.pi) % (2 * np.pi) - np.pi
+
+        heading = np.rint(np.degrees(bearing) / IR_DEGREES_PER_HEADING)
+        visible = (np.abs(heading) <= IR_MAX_HEADING) & (np.hypot(dx, dy) <= IR_RANGE)
+        return np.where(visible, heading, 0).astype(np.int8)
+
+    def step(self, dt=0.1):
+        """
+        Advances every robot by dt seconds.
+        :param dt: the step length in seconds
+        """
+        ready = (self.drive_left <= 0) & (self.idle_left <= 0)
+        if ready.any():
+            self._control(ready)
+
+        move_t = np.minimum(self.drive_left, dt)
+        if self.house is None:
+            self._integrate(move_t)
+        else:
+            self._integrate_in_house(move_t)
+        self.idle_left -= dt - move_t
+        np.maximum(self.drive_left - dt, 0, out=self.drive_left)
+        self.time += dt
+
+    def run(self, seconds, dt=0.1):
+        for _ in range(int(round(seconds / dt))):
+            self.step(dt)
+
+    def _control(self, ready):
+        heading = self.read_ir_heading()[ready]
+        self.ir_heading[ready] = heading
+
+        # Can't see the beacon
+        lost = heading == 0
+        steering = -heading.astype(np.int16)
+        self.steering[ready] = steering
+
+        left, right = steering_speeds(steering, FOLLOW_SPEED_PERCENT)
+        left[lost] = 0
+        right[lost] = 0
+        left = SpeedPercent.to_native_array(left, LargeMotor)
+        right = SpeedPercent.to_native_array(right, LargeMotor)
+
+        # on_for_rotations runs the faster motor for the given rotations
+        fastest = np.maximum(np.abs(left), np.abs(right))
+        duration = np.divide(FOLLOW_ROTATIONS * 360.0, fastest, out=np.zeros_like(fastest), where=fastest > 0)
+
+        self.left_speed[ready] = left
+        self.right_speed[ready] = right
+        self.drive_left[ready] = duration
+        self.idle_left[ready] = FOLLOW_POLL
+
+    def _integrate_in_house(self, t):
+        """
+        Like _integrate, but robots that would end up touching a wall or
+        furniture stay where they were and stop.
+        """
+        moving = np.flatnonzero(t > 0)
+        x0 = self.x[moving]
+        y0 = self.y[moving]
+        self._integrate(t)
+
+        house = self.house
+        hit = np.fromiter((house.collides(x, y) or not house.line_of_sight(fx, fy, x, y)
+                           for x, y, fx, fy in zip(self.x[moving].tolist(), self.y[moving].tolist(),
+                                                   x0.tolist(), y0.tolist())),
+                          dtype=bool, count=len(moving))
+        stopped = moving[hit]
+        self.x[stopped] = x0[hit]
+        self.y[stopped] = y0[hit]
+        self.drive_left[stopped] = 0
+        self.collisions += len(stopped)
+
+    def _integrate(self, t):
+        """
+        Moves every robot along the arc given by its wheel speeds for t seconds.
+        """
+        metres_per_degree = np.pi * WHEEL_DIAMETER / 360.0
+        v_left = self.left_speed * metres_per_degree
+        v_right = self.right_speed * metres_per_degree
+        v = (v_left + v_right) / 2
+        w = (v_right - v_left) / AXLE_TRACK
+
+        theta1 = self.theta + w * t
+        turning = np.abs(w) > 1e-9
+        safe_w = np.where(turning, w, 1.0)
+        dx = np.where(turning, v / safe_w * (np.sin(theta1) - np.sin(self.theta)), v * t * np.cos(self.theta))
+        dy = np.where(turning, -v / safe_w * (np.cos(theta1) - np.cos(self.theta)), v * t * np.sin(self.theta))
+
+        self.x += dx
+        self.y += dy
+        self.theta = theta1
@@ -0,0 +1,270 @@
+"""
+Counters, histograms and timers for the gadget, its devices and its clock.
+
+Metrics are off unless enable() is called or $HOUSEPET_METRICS is set before
+the gadgets are created. When they are off nothing is wrapped, so they cost
+nothing. When they are on, instrument_gadget wraps the gadget's behaviors,
+directive handling, send_custom_event, its telemetry fetches, the ev3dev2
+actuator and sensor calls and its clock's sleep and wait with timers. Each
+timer is kept per thread; threads started by SimClock.spawn are named after
+their behavior.
+
+snapshot() returns everything as a dict, and serve() makes the same snapshot
+available as JSON over HTTP, e.g. ``curl localhost:9100/metrics``.
+"""
+
+import functools
+import json
+import math
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sim_clock import ClockStopped
+
+
+# Histogram buckets are powers of two microseconds, up to about 9 hours
+BUCKETS = 45
+
+GADGET_METHODS = ('on_custom_mindstorms_gadget_control', 'dispatch_directives', 'send_custom_event',
+                  '_send_event', '_move', '_activate', '_turn', '_patrol_step', '_read_light', '_read_power')
+
+DEVICE_METHODS = {
+    'drive': ('on', 'on_for_seconds', 'on_for_rotations', 'on_for_degrees', 'off'),
+    'steerdrive': ('on', 'on_for_seconds', 'on_for_rotations', 'off'),
+    'leds': ('set_color',),
+    'sound': ('play_song',),
+    'ir': ('heading', 'wait_for_heading_change'),
+    'touch': ('wait_for_bump',),
+    'light': ('wait_for_ambient_change',),
+}
+
+
+class Histogram():
+    """
+    A histogram of durations in seconds, in power of two microsecond buckets.
+    """
+
+    __slots__ = ('counts', 'count', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def observe(self, seconds):
+        bucket = math.frexp(seconds * 1e6)[1] if seconds > 0 else 0
+        self.counts[min(max(bucket, 0), BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        for i, n in enumerate(other.counts):
+            self.counts[i] += n
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """
+        Returns an upper bound for the q quantile, accurate to a factor of two.
+        """
+        rank = q * self.count
+        seen = 0
+        for bucket, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return min(2.0 ** bucket / 1e6, self.max)
+        return self.max
+
+    def snapshot(self):
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'mean': self.total / self.count,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+        }
+
+
+class Metrics():
+    """
+    A registry of counters and per-thread timers.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timers = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        """
+        Adds a duration to the named timer of the current thread.
+        """
+        key = (name, threading.current_thread().name)
+        with self._lock:
+            histogram = self._timers.get(key)
+            if histogram is None:
+                histogram = self._timers[key] = Histogram()
+            histogram.observe(seconds)
+
+    def wrap(self, func, name):
+        """
+        Returns func timed as the named timer. Exceptions other than
+        ClockStopped are counted in name.errors.
+        """
+        perf_counter = time.perf_counter
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except ClockStopped:
+                raise
+            except Exception:
+                self.incr(name + '.errors')
+                raise
+            finally:
+                self.observe(name, perf_counter() - start)
+
+        timed.__wrapped_metrics__ = True
+        return timed
+
+    def instrument(self, obj, methods, prefix):
+        """
+        Replaces the named methods of obj with timed ones named prefix.method.
+        Does nothing when metrics are off.
+        """
+        if not self.enabled or obj is None:
+            return obj
+        for method in methods:
+            func = getattr(obj, method, None)
+            if func is None or getattr(func, '__wrapped_metrics__', False):
+                continue
+            setattr(obj, method, self.wrap(func, '{}.{}'.format(prefix, method)))
+        return obj
+
+    def instrument_clock(self, clock):
+        """
+        Times the clock's sleep and wait, and counts the simulated seconds slept.
+        """
+        if not self.enabled or getattr(clock.sleep, '__wrapped_metrics__', False):
+            return
+        timed_sleep = self.wrap(clock.sleep, 'clock.sleep')
+
+        @functools.wraps(timed_sleep)
+        def sleep(seconds):
+            self.incr('clock.sleep.sim_seconds', max(seconds, 0))
+            return timed_sleep(seconds)
+
+        sleep.__wrapped_metrics__ = True
+        clock.sleep = sleep
+        clock.wait = self.wrap(clock.wait, 'clock.wait')
+
+    def instrument_gadget(self, gadget):
+        """
+        Times a MindstormsGadget's behaviors and devices and its clock.
+        """
+        if not self.enabled:
+            return
+        self.instrument(gadget, GADGET_METHODS, 'gadget')
+        for attr, methods in DEVICE_METHODS.items():
+            self.instrument(getattr(gadget, attr, None), methods, attr)
+        self.instrument_clock(gadget.clock)
+        self.incr('gadgets')
+
+    def snapshot(self):
+        """
+        Returns the counters and timers as a dict. Each timer has its totals
+        over all threads and a breakdown per thread.
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            totals = {}
+            threads = {}
+            for (name, thread), histogram in self._timers.items():
+                totals.setdefault(name, Histogram()).merge(histogram)
+                threads.setdefault(name, {})[thread] = histogram.snapshot()
+
+        timers = {}
+        for name in sorted(totals):
+            timers[name] = totals[name].snapshot()
+            timers[name]['threads'] = threads[name]
+        return {'time': time.time(), 'counters': counters, 'timers': timers}
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._timers.clear()
+
+
+_metrics = Metrics(enabled=bool(os.environ.get('HOUSEPET_METRICS')))
+
+
+def get_metrics():
+    """
+    Returns the shared metrics registry.
+    """
+    return _metrics
+
+
+def enable():
+    """
+    Turns the shared metrics on for gadgets created from now on.
+    """
+    _metrics.enabled = True
+    return _metrics
+
+
+def snapshot():
+    return _metrics.snapshot()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        data = json.dumps(self.server.metrics.snapshot()).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve(port=0, host='127.0.0.1', metrics=None):
+    """
+    Serves a metrics snapshot as JSON at /metrics from a background thread.
+    :param port: the port, or 0 for any free port
+    :param metrics: the registry to serve, defaults to the shared one
+    :return: the server; its server_address has the port
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = metrics if metrics is not None else _metrics
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
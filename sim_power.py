@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+"""
+Battery and power model for the simulated pet.
+
+A BatteryModel describes the pet's one cell LiPo battery, what its motors,
+LEDs and electronics draw and what its solar panel charges with at a given
+ambient light level. A PowerModel attaches a BatteryModel to a
+MindstormsGadget: the motors and LEDs tell it before every change, and the
+ColorSensor's ambient light drives the charge current, so the state of charge
+is integrated exactly over each stretch of constant load. It keeps the
+world's batt_voltage, load_current and charge_current up to date, which is
+what the sim telemetry backend reports.
+
+Days of operation are too long to step through with the gadget, so
+fast_forward integrates the state of charge over arrays of load and charge
+current at once, and simulate_days builds those arrays from a mix of
+behaviors, whose average load is measured once from short gadget runs, and
+a daylight curve::
+
+    python sim_power.py --days 7 --mix idle=0.7 patrol=0.2 follow=0.1
+
+Currents are in mA and the capacity in mAh.
+"""
+
+import argparse
+import functools
+import math
+
+import numpy as np
+
+import sim_clock
+import sim_recorder
+import sim_vars
+
+
+# Open circuit voltage of a one cell LiPo against state of charge
+OCV_SOC = (0.0, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+OCV_VOLTS = (3.0, 3.3, 3.45, 3.58, 3.65, 3.7, 3.74, 3.79, 3.85, 3.93, 4.03, 4.2)
+
+
+class BatteryModel():
+    """
+    The battery, the loads on it and the solar charger.
+    """
+
+    def __init__(self, capacity_mah=2000.0, resistance=0.15, idle_ma=80.0, motor_ma=400.0, led_ma=15.0,
+                 solar_ma=2.5, restart_soc=0.2):
+        """
+        :param capacity_mah: the battery capacity
+        :param resistance: the internal resistance in ohms
+        :param idle_ma: the draw of the brick and sensors while on
+        :param motor_ma: the draw of one motor at full speed, which scales
+            with the speed
+        :param led_ma: the draw of one LED at full brightness
+        :param solar_ma: the charge current per unit of ambient light
+        :param restart_soc: the state of charge at which an empty pet turns
+            on again while charging
+        """
+        self.capacity_mah = capacity_mah
+        self.resistance = resistance
+        self.idle_ma = idle_ma
+        self.motor_ma = motor_ma
+        self.led_ma = led_ma
+        self.solar_ma = solar_ma
+        self.restart_soc = restart_soc
+
+    @classmethod
+    def from_dict(cls, spec):
+        return cls(**spec)
+
+    def voltage(self, soc, current_ma=0.0):
+        """
+        The terminal voltage at a state of charge and a net discharge current.
+        Takes scalars or arrays.
+        """
+        volts = np.interp(soc, OCV_SOC, OCV_VOLTS) - self.resistance * np.asarray(current_ma) / 1000.0
+        return float(volts) if np.ndim(volts) == 0 else volts
+
+    def charge_current(self, light):
+        return self.solar_ma * light
+
+
+class PowerModel():
+    """
+    Tracks the battery of one MindstormsGadget.
+    """
+
+    def __init__(self, gadget, model=None, soc=1.0, interval=1.0):
+        """
+        :param gadget: the MindstormsGadget
+        :param model: the BatteryModel, defaults to BatteryModel()
+        :param soc: the starting state of charge, from 0 to 1
+        :param interval: seconds of simulated time between updates of the
+            world's power readings while nothing changes
+        """
+        from ev3dev2.sensor import bus_for
+
+        self.gadget = gadget
+        self.model = model if model is not None else BatteryModel()
+        self.soc = float(soc)
+        self.interval = interval
+        self.clock = gadget.clock
+        self.world = gadget.world
+
+        self.consumed_mah = 0.0
+        self.charged_mah = 0.0
+        self.empty_at = None
+        self._updated_at = self.clock.now()
+
+        self.motors = [gadget.drive.left_motor, gadget.drive.right_motor]
+        for motor in self.motors:
+            motor.power = self
+        gadget.leds.power = self
+        # The light in effect until now is the old one, so integrate first
+        bus_for(self.world).subscribe('ambient_light_intensity', self._light_changed)
+        self._light = self.world.ambient_light_intensity
+        self._publish(self._load_at(self._updated_at))
+
+    def start(self):
+        """
+        Updates the power readings on a thread of the gadget's clock.
+        """
+        self.clock.spawn(self._update_thread)
+
+    def _update_thread(self):
+        while True:
+            self.clock.sleep(self.interval)
+            self.update()
+
+    async def run_async(self):
+        import asyncio
+
+        while True:
+            await asyncio.sleep(self.interval)
+            self.update()
+
+    def _light_changed(self, name, value):
+        self.update()
+        self._light = value
+
+    def _led_load(self):
+        return self.model.led_ma * float(self.gadget.leds.framebuffer.sum())
+
+    def _load_at(self, when):
+        model = self.model
+        load = model.idle_ma + self._led_load()
+        for motor in self.motors:
+            load += model.motor_ma * abs(motor.speed_at(when)) / motor.max_speed
+        return load
+
+    def update(self):
+        """
+        Integrates the state of charge up to now and updates the world's
+        power readings.
+        """
+        now = self.clock.now()
+        dt = now - self._updated_at
+        if dt <= 0:
+            return
+        model = self.model
+        start = self._updated_at
+        self._updated_at = now
+
+        # Motor speeds are constant since the last update, apart from timed
+        # runs that ended in between
+        load_mas = (model.idle_ma + self._led_load()) * dt
+        for motor in self.motors:
+            speed = abs(motor.speed_at(start))
+            if speed:
+                end = now if motor._t1 is None else min(now, motor._t1)
+                load_mas += model.motor_ma * speed / motor.max_speed * max(end - start, 0.0)
+        charge_mas = model.charge_current(self._light) * dt
+
+        consumed = load_mas / 3600.0
+        charged = charge_mas / 3600.0
+        self.consumed_mah += consumed
+        self.charged_mah += charged
+        self.soc = min(1.0, max(0.0, self.soc + (charged - consumed) / model.capacity_mah))
+        if self.soc == 0.0 and self.empty_at is None:
+            self.empty_at = now
+        self._publish(self._load_at(now))
+
+    def _publish(self, load):
+        charge = self.model.charge_current(self._light)
+        world = self.world
+        world.load_current = load
+        world.charge_current = charge
+        world.batt_voltage = self.model.voltage(self.soc, load - charge)
+
+
+def fast_forward(model, load_ma, charge_ma, dt, soc=1.0):
+    """
+    Integrates the state of charge over arrays of load and charge current,
+    one entry per dt seconds. The battery is full at 1. When it runs empty
+    the pet turns off, drawing nothing, until charging brings it back to the
+    model's restart_soc.
+
+    Each stretch between turning off and on is integrated with a cumulative
+    sum. Charging into a full battery is handled with a running maximum of
+    the overshoot, so the number of Python level steps is the number of
+    times the pet runs empty, not the number of entries.
+
+    :return: the state of charge after each entry and a bool array of
+        whether the pet was on during it
+    """
+    load_ma = np.asarray(load_ma, dtype=np.float64)
+    charge_ma = np.asarray(charge_ma, dtype=np.float64)
+    n = len(load_ma)
+    scale = dt / 3600.0 / model.capacity_mah
+    socs = np.empty(n)
+    on = np.zeros(n, dtype=bool)
+
+    i = 0
+    is_on = soc > 0
+    while i < n:
+        if is_on:
+            level = soc + np.cumsum((charge_ma[i:] - load_ma[i:]) * scale)
+            # Anything above full is wasted, and later levels are lower by it
+            level -= np.maximum.accumulate(np.maximum(level - 1.0, 0.0))
+            end = np.flatnonzero(level <= 0.0)
+            j = end[0] + 1 if len(end) else n - i
+            on[i:i + j] = True
+            level[j - 1] = max(level[j - 1], 0.0)
+        else:
+            level = soc + np.cumsum(charge_ma[i:] * scale)
+            end = np.flatnonzero(level >= model.restart_soc)
+            j = end[0] + 1 if len(end) else n - i
+        socs[i:i + j] = level[:j]
+        soc = level[j - 1]
+        is_on = not is_on
+        i += j
+    return socs, on
+
+
+def daylight(t, peak=80.0, sunrise=6.0, sunset=20.0, indoor=10.0):
+    """
+    Ambient light at times of day: a half sine between sunrise and sunset
+    on top of the indoor level.
+    :param t: seconds since midnight of the first day, scalar or array
+    :param peak: the light at noon above the indoor level
+    :param sunrise: the hour of sunrise
+    :param sunset: the hour of sunset
+    :param indoor: the light at night
+    """
+    hour = np.asarray(t, dtype=np.float64) / 3600.0 % 24.0
+    phase = (hour - sunrise) / (sunset - sunrise)
+    return indoor + peak * np.where((phase > 0) & (phase < 1), np.sin(np.pi * phase), 0.0)
+
+
+# How each behavior is started on a gadget for measuring its load
+BEHAVIORS = {
+    'idle': lambda gadget: None,
+    'patrol': lambda gadget: setattr(gadget, 'patrol_mode', True),
+    'follow': lambda gadget: setattr(gadget, 'follow_mode', True),
+}
+
+
+def measure_load(behavior, model=None, seconds=600, seed=0):
+    """
+    Runs a gadget in one behavior on a fast clock, in the dark, and returns
+    its average load in mA.
+    :param behavior: a BEHAVIORS name
+    """
+    from housepet_gadget import MindstormsGadget
+
+    clock = sim_clock.SimClock(fast=True, seed=seed)
+    world = sim_vars.WorldState()
+    gadget = MindstormsGadget(clock=clock, world=world, telemetry='sim', trace=False,
+                              recorder=sim_recorder.EventRecorder(level=sim_recorder.OFF, clock=clock))
+    gadget.send_custom_event = lambda namespace, name, payload: None
+    power = PowerModel(gadget, model)
+    BEHAVIORS[behavior](gadget)
+    try:
+        clock.run_until(seconds)
+        power.update()
+    finally:
+        clock.stop()
+    return power.consumed_mah * 3600.0 / seconds
+
+
+@functools.lru_cache(maxsize=None)
+def _behavior_load(behavior, spec):
+    return measure_load(behavior, BatteryModel(**dict(spec)))
+
+
+def behavior_loads(model, behaviors=BEHAVIORS):
+    """
+    The average load of each behavior with a model, measured once per model
+    settings.
+    """
+    spec = tuple(sorted(vars(model).items()))
+    return {behavior: _behavior_load(behavior, spec) for behavior in behaviors}
+
+
+def simulate_days(model, mix, days, dt=1.0, block=60.0, seed=0, soc=1.0, light=daylight):
+    """
+    Fast-forwards days of operation with a mix of behaviors.
+    :param model: the BatteryModel
+    :param mix: behavior name to the share of time spent in it
+    :param days: the number of days to simulate
+    :param dt: the integration step in seconds
+    :param block: seconds spent in one behavior before picking the next
+    :param seed: the seed for picking behaviors
+    :param soc: the starting state of charge
+    :param light: a function of the time in seconds returning the ambient light
+    :return: a dict with the times, the state of charge and on arrays, the
+        measured behavior loads, the number of times the pet ran empty, the
+        mean time it ran before that, the time until it first did and the
+        time it spent off, in seconds
+    """
+    names = list(mix)
+    weights = np.array([mix[name] for name in names], dtype=np.float64)
+    loads = behavior_loads(model, names)
+
+    n = int(days * 86400 / dt)
+    t = np.arange(n) * dt
+    per_block = max(1, int(round(block / dt)))
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(len(names), size=-(-n // per_block), p=weights / weights.sum())
+    load = np.array([loads[name] for name in names])[picks].repeat(per_block)[:n]
+    charge = model.charge_current(light(t))
+
+    socs, on = fast_forward(model, load, charge, dt, soc)
+
+    # Runs of being on that end with the pet running empty
+    edges = np.flatnonzero(np.diff(on.astype(np.int8)))
+    starts = np.concatenate(([0], edges + 1))
+    runs = [(s, e) for s, e in zip(starts, np.concatenate((edges + 1, [n]))) if on[s]]
+    emptied = [(e - s) * dt for s, e in runs if e < n]
+    first_empty = np.flatnonzero(~on)
+    return {
+        'times': t,
+        'soc': socs,
+        'on': on,
+        'loads': loads,
+        'brownouts': len(emptied),
+        'runtime_per_charge': float(np.mean(emptied)) if emptied else math.inf,
+        'runtime_from_start': float(first_empty[0] * dt) if len(first_empty) else math.inf,
+        'time_off': float((~on).sum() * dt),
+    }
+
+
+def _parse_mix(items):
+    mix = {}
+    for item in items:
+        name, _, share = item.partition('=')
+        if name not in BEHAVIORS:
+            raise argparse.ArgumentTypeError("unknown behavior {}".format(name))
+        mix[name] = float(share or 1)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Estimate battery runtime for a mix of behaviors.")
+    parser.add_argument("--days", type=float, default=7)
+    parser.add_argument("--mix", nargs="+", default=["idle=0.7", "patrol=0.2", "follow=0.1"],
+                        help="behavior=share pairs, behaviors: " + ", ".join(BEHAVIORS))
+    parser.add_argument("--capacity", type=float, default=2000.0, help="battery capacity in mAh")
+    parser.add_argument("--solar", type=float, default=2.5, help="charge current in mA per unit of light")
+    parser.add_argument("--peak-light", type=float, default=80.0, help="ambient light at noon")
+    parser.add_argument("--dt", type=float, default=1.0, help="integration step in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="write the hourly state of charge to this CSV file")
+    args = parser.parse_args(argv)
+
+    model = BatteryModel(capacity_mah=args.capacity, solar_ma=args.solar)
+    mix = _parse_mix(args.mix)
+    result = simulate_days(model, mix, args.days, args.dt, seed=args.seed,
+                           light=functools.partial(daylight, peak=args.peak_light))
+
+    for name, load in result['loads'].items():
+        print("{:<8} {:7.1f} mA".format(name, load))
+    print("Runtime from full: {:.1f} h, per charge: {:.1f} h".format(
+        result['runtime_from_start'] / 3600, result['runtime_per_charge'] / 3600))
+    print("Ran empty {} times, off {:.1f} h of {:.0f} h".format(
+        result['brownouts'], result['time_off'] / 3600, args.days * 24))
+    print("Final state of charge: {:.0%}".format(result['soc'][-1]))
+
+    if args.output:
+        step = max(1, int(3600 / args.dt))
+        with open(args.output, "w") as f:
+            f.write("hour,soc,volts\n")
+            for t, soc in zip(result['times'][::step], result['soc'][::step]):
+                f.write("{:.0f},{:.4f},{:.3f}\n".format(t / 3600, soc, model.voltage(soc)))
+
+
+if __name__ == '__main__':
+    main()
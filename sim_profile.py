@@ -0,0 +1,94 @@
+"""
+A sampling profiler for the runner entry points.
+
+Sampler looks at the stack of every thread at a fixed interval from a
+background thread and counts each distinct stack. write() saves the counts in
+the folded format read by flamegraph.pl and speedscope, one
+``thread;outer;...;inner count`` line per stack. Threads that are parked in
+the clock show up under their wait, which is where a fast-mode run's idle
+threads spend their time.
+"""
+
+import collections
+import os
+import sys
+import threading
+
+
+class Sampler():
+    """
+    Samples the stacks of all threads of this process.
+    """
+
+    def __init__(self, interval=0.005):
+        """
+        :param interval: seconds between samples
+        """
+        self.interval = interval
+        self.samples = 0
+        self.stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        return self
+
+    def _run(self):
+        own = threading.get_ident()
+        code_names = {}
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    name = code_names.get(code)
+                    if name is None:
+                        name = code_names[code] = "{} ({}:{})".format(
+                            code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+                    stack.append(name)
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def write(self, path):
+        """
+        Writes the sampled stacks in the folded format.
+        """
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write("{} {}\n".format(stack, count))
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def merge_folded(paths, path):
+    """
+    Adds up several folded profiles, e.g. one per worker process, into one.
+    """
+    stacks = collections.Counter()
+    for part in paths:
+        with open(part) as f:
+            for line in f:
+                stack, _, count = line.rstrip('\n').rpartition(' ')
+                stacks[stack] += int(count)
+    with open(path, 'w') as f:
+        for stack, count in stacks.most_common():
+            f.write("{} {}\n".format(stack, count))
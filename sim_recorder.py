@@ -0,0 +1,314 @@
+"""
+Low-overhead event recorder for the simulated devices and gadget.
+
+Devices record timestamped LED, motor, sensor, event, directive and log
+records instead of printing them. Recording a record appends one tuple to a
+ring buffer; formatting and I/O happen elsewhere. If the recorder has a path, a
+background thread drains the buffer every flush_interval seconds and appends
+the records to a columnar binary file that read_events reads back. Without a
+path the ring buffer keeps the latest capacity records, see records().
+
+The level decides what a recorder does:
+
+- OFF: records are dropped
+- RECORD: records are kept, nothing is printed
+- TEXT: records are kept and also printed as text lines, like the old prints
+
+The shared recorder's level defaults to $HOUSEPET_EVENT_LEVEL ('off',
+'record' or 'text'), or 'text'.
+
+File format: an 8 byte magic, then chunks. Each chunk is a header
+'<4sII' (b'CHNK', string count, record count), the chunk's strings, each a
+'<I' byte length and UTF-8 bytes, then the columns of the chunk's records as
+little-endian arrays: time float64, kind uint8, source uint32, name uint32,
+value float64 and text uint32. source, name and text index the chunk's
+strings, with NO_STRING for none. A record's value is either the value column
+or, for values that are not numbers, the text column.
+"""
+
+import array
+import collections
+import json
+import logging
+import os
+import struct
+import sys
+import threading
+
+import sim_clock
+
+logger = logging.getLogger(__name__)
+
+OFF = 0
+RECORD = 1
+TEXT = 2
+
+LEVELS = {'off': OFF, 'record': RECORD, 'text': TEXT}
+
+# Record kinds
+LED = 1
+MOTOR = 2
+SENSOR = 3
+EVENT = 4
+DIRECTIVE = 5
+LOG = 6
+
+KIND_NAMES = {LED: 'led', MOTOR: 'motor', SENSOR: 'sensor', EVENT: 'event', DIRECTIVE: 'directive', LOG: 'log'}
+
+TEXT_FORMATS = {
+    LED: "LED: {source} is {value}",
+    MOTOR: "Motor: {source} {name} {value}",
+    SENSOR: "{source} {name}: {value}",
+    EVENT: "Event: {source} {name} {value}",
+    DIRECTIVE: "Directive: {name} {value}",
+}
+
+MAGIC = b'HPEVT\x00\x00\x01'
+CHUNK = struct.Struct('<4sII')
+STRING_LENGTH = struct.Struct('<I')
+NO_STRING = 0xFFFFFFFF
+
+# Column name and array typecode, in file order
+COLUMNS = (('time', 'd'), ('kind', 'B'), ('source', 'I'), ('name', 'I'), ('value', 'd'), ('text', 'I'))
+
+
+def _format_text(record):
+    t, kind, source, name, value = record
+    if kind == LOG:
+        return name % value if value else name
+    return TEXT_FORMATS[kind].format(source=source, name=name, value=value)
+
+
+class EventRecorder():
+    """
+    Records device and gadget records into a ring buffer.
+    """
+
+    def __init__(self, path=None, level=RECORD, capacity=65536, flush_interval=0.5, clock=None, stream=None):
+        """
+        :param path: a file to append the records to from a background thread,
+            or None to keep them in memory
+        :param level: OFF, RECORD or TEXT
+        :param capacity: the ring buffer size in records. The oldest records are
+            overwritten if the flusher falls behind.
+        :param flush_interval: seconds between flushes to the file
+        :param clock: the clock timestamping records, defaults to the shared
+            sim_clock clock
+        :param stream: where TEXT lines go, defaults to sys.stdout
+        """
+        self.path = path
+        self.level = level
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.stream = stream
+
+        self._buffer = collections.deque(maxlen=capacity)
+        self._file = None
+        self._file_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._flusher = None
+        if path is not None:
+            self._file = open(path, 'wb')
+            self._file.write(MAGIC)
+            self._flusher = threading.Thread(target=self._flush_loop, name='EventRecorder', daemon=True)
+            self._flusher.start()
+
+    def record(self, kind, source, name, value=None):
+        """
+        Records one record, timestamped with the clock's current time.
+        """
+        if not self.level:
+            return
+        clock = self.clock
+        record = (clock.now() if clock is not None else sim_clock.now(), kind, source, name, value)
+        self._buffer.append(record)
+        if self.level >= TEXT:
+            self._write_text(record)
+
+    def led(self, group, color):
+        self.record(LED, group, 'color', color)
+
+    def motor(self, address, name, value):
+        self.record(MOTOR, address, name, value)
+
+    def sensor(self, source, name, value):
+        self.record(SENSOR, source, name, value)
+
+    def event(self, namespace, name, payload):
+        self.record(EVENT, namespace, name, payload)
+
+    def directive(self, name, payload):
+        self.record(DIRECTIVE, None, name, payload)
+
+    def log(self, message, *args):
+        """
+        Records a log message. The message is only formatted with args when it
+        is printed or written.
+        """
+        self.record(LOG, None, message, args)
+
+    def _write_text(self, record):
+        stream = self.stream if self.stream is not None else sys.stdout
+        stream.write(_format_text(record) + "\n")
+
+    def records(self):
+        """
+        Returns the records still in the ring buffer as (time, kind, source,
+        name, value) tuples, oldest first.
+        """
+        while True:
+            try:
+                return list(self._buffer)
+            except RuntimeError:
+                # Appended to while copying
+                continue
+
+    def flush(self):
+        """
+        Writes the buffered records to the file, if the recorder has one.
+        """
+        if self._file is None:
+            return
+        with self._file_lock:
+            buffer = self._buffer
+            if len(buffer) == self.capacity:
+                logger.warning("Event ring buffer full, records may have been dropped")
+            popleft = buffer.popleft
+            records = [popleft() for _ in range(len(buffer))]
+            if records:
+                self._file.write(encode_chunk(records))
+                self._file.flush()
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        """
+        Stops the flusher and writes the remaining records.
+        """
+        if self._flusher is not None:
+            self._stop.set()
+            self._flusher.join()
+            self._flusher = None
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def encode_chunk(records):
+    """
+    Encodes records as one file chunk.
+    """
+    strings = {}
+
+    def intern(s):
+        if s is None:
+            return NO_STRING
+        index = strings.get(s)
+        if index is None:
+            index = strings[s] = len(strings)
+        return index
+
+    columns = [array.array(typecode) for _, typecode in COLUMNS]
+    times, kinds, sources, names, values, texts = columns
+    for t, kind, source, name, value in records:
+        times.append(t)
+        kinds.append(kind)
+        sources.append(intern(source))
+        if kind == LOG:
+            names.append(intern(name))
+            values.append(float('nan'))
+            texts.append(intern(name % value if value else name))
+            continue
+
+        names.append(intern(name))
+        if isinstance(value, (int, float)):
+            values.append(value)
+            texts.append(NO_STRING)
+        else:
+            values.append(float('nan'))
+            if value is not None and not isinstance(value, str):
+                value = json.dumps(value, default=str)
+            texts.append(intern(value))
+
+    parts = [CHUNK.pack(b'CHNK', len(strings), len(records))]
+    for s in strings:
+        data = s.encode('utf-8')
+        parts.append(STRING_LENGTH.pack(len(data)))
+        parts.append(data)
+    for column in columns:
+        if sys.byteorder != 'little':
+            column.byteswap()
+        parts.append(column.tobytes())
+    return b''.join(parts)
+
+
+def read_events(path):
+    """
+    Reads a recorder file and yields its records as (time, kind, source,
+    name, value) tuples. Numbers come back as floats, other values as their
+    JSON text, and log records have the formatted message as value.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("{} is not an event recorder file".format(path))
+
+    offset = len(MAGIC)
+    while offset < len(data):
+        tag, string_count, count = CHUNK.unpack_from(data, offset)
+        if tag != b'CHNK':
+            raise ValueError("Bad chunk at offset {} of {}".format(offset, path))
+        offset += CHUNK.size
+
+        strings = []
+        for _ in range(string_count):
+            (length,) = STRING_LENGTH.unpack_from(data, offset)
+            offset += STRING_LENGTH.size
+            strings.append(data[offset:offset + length].decode('utf-8'))
+            offset += length
+        strings.append(None)
+
+        columns = []
+        for _, typecode in COLUMNS:
+            column = array.array(typecode)
+            size = column.itemsize * count
+            column.frombytes(data[offset:offset + size])
+            if sys.byteorder != 'little':
+                column.byteswap()
+            columns.append(column)
+            offset += size
+
+        for t, kind, source, name, value, text in zip(*columns):
+            if text != NO_STRING:
+                value = strings[text]
+            elif value != value:
+                value = None
+            yield t, kind, strings[min(source, string_count)], strings[min(name, string_count)], value
+
+
+_recorder = EventRecorder(level=LEVELS.get(os.environ.get('HOUSEPET_EVENT_LEVEL', 'text'), TEXT))
+
+
+def get_recorder():
+    """
+    Returns the shared recorder used by devices that aren't given one.
+    """
+    return _recorder
+
+
+def set_recorder(recorder):
+    """
+    Replaces the shared recorder. Devices created afterwards use it.
+    """
+    global _recorder
+    _recorder = recorder
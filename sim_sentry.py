@@ -0,0 +1,278 @@
+"""
+Sentry and proximity detection on the IR proximity stream.
+
+A SentryDetector takes proximity samples in blocks, for one robot or for a
+whole fleet as a (robots, samples) array, and finds two kinds of event:
+
+- PROXIMITY: something is close. The proximity, averaged over a short
+  window, has stayed below near for the debounce time. It clears once the
+  average has stayed above near + hysteresis as long.
+- SENTRY: something moved in front of the sensor while guarding. The short
+  average has stayed further than sigma standard deviations of a longer
+  baseline window, and at least min_delta, from the baseline's mean for the
+  debounce time. It clears once it has stayed back within that band as
+  long, or the baseline has caught up with the new scene.
+
+Only the start of each is reported, and then at most once per cooldown per
+robot and kind, so a reading flapping at the threshold makes one event. The
+windows are running sums, updated over a block with cumulative sums, so a
+sample costs the same whatever the window lengths, and only the last
+baseline + window samples of each robot are kept.
+
+A SentryMonitor runs a detector on a MindstormsGadget's InfraredSensor while
+it is in sentry mode, and synthetic makes proximity traces for a fleet.
+"""
+
+import numpy as np
+
+
+PROXIMITY = 'Proximity'
+SENTRY = 'Sentry'
+
+
+def _runs(cond, carry):
+    """
+    The length of the run of True ending at each sample of a (robots,
+    samples) array, continuing the runs carried from the last block.
+    """
+    index = np.arange(cond.shape[1])
+    last_false = np.maximum.accumulate(np.where(cond, -1, index), axis=1)
+    runs = index - last_false
+    return np.where(last_false < 0, runs + carry[:, None], runs)
+
+
+def _latch(on, off, state):
+    """
+    The state after each sample of a latch set by on and reset by off,
+    starting from each robot's state.
+    """
+    index = np.arange(on.shape[1])
+    last_on = np.maximum.accumulate(np.where(on, index, -1), axis=1)
+    last_off = np.maximum.accumulate(np.where(off, index, -1), axis=1)
+    return np.where(last_on == last_off, state[:, None], last_on > last_off)
+
+
+class SentryDetector():
+    """
+    Debounced proximity and intrusion detection over blocks of samples from
+    a fleet of robots.
+    """
+
+    def __init__(self, robots=1, rate=1000.0, window=0.05, baseline=1.0, near=30.0, hysteresis=10.0,
+                 sigma=4.0, min_delta=10.0, debounce=0.1, cooldown=2.0):
+        """
+        :param robots: the number of robots, one row of samples each
+        :param rate: samples per second
+        :param window: seconds the short average is taken over
+        :param baseline: seconds of samples before the short window that the
+            baseline is taken over
+        :param near: the proximity below which something is close
+        :param hysteresis: how far above near the proximity must go to clear
+        :param sigma: baseline standard deviations that count as an intrusion
+        :param min_delta: the smallest change from the baseline that counts as
+            an intrusion, so a steady reading does not trigger on noise
+        :param debounce: seconds a condition must hold to set or clear
+        :param cooldown: the fewest seconds between events of one kind for one robot
+        """
+        self.robots = robots
+        self.rate = rate
+        self.near = near
+        self.hysteresis = hysteresis
+        self.sigma = sigma
+        self.min_delta = min_delta
+        self.cooldown = cooldown
+        self._short = max(1, int(round(window * rate)))
+        self._base = max(1, int(round(baseline * rate)))
+        self._debounce = max(1, int(round(debounce * rate)))
+        self._length = self._base + self._short
+        self.reset()
+
+    def reset(self, time=0.0):
+        """
+        Forgets every sample seen. The next block starts at the given time.
+        """
+        self.start = time
+        self.samples = 0
+        self.events = 0
+        self.suppressed = 0
+        self._ring = None
+        self._last = np.full((2, self.robots), -np.inf)
+
+    def _fill(self, first):
+        """
+        Starts every window full of each robot's first sample.
+        """
+        robots = self.robots
+        self._ring = np.repeat(first[:, None], self._length, axis=1)
+        self._pos = 0
+        self._since_refresh = 0
+        self._sums = (first * self._short, first * self._base, first * first * self._base)
+        zeros = np.zeros(robots, dtype=np.int64)
+        self._carry = [zeros.copy() for _ in range(4)]
+        self._near = np.zeros(robots, dtype=bool)
+        self._intruded = np.zeros(robots, dtype=bool)
+
+    def _refresh(self):
+        """
+        Recomputes the running sums from the ring, so rounding does not pile up.
+        """
+        ordered = np.roll(self._ring, -self._pos, axis=1)
+        base = ordered[:, :self._base]
+        self._sums = (ordered[:, self._base:].sum(axis=1), base.sum(axis=1), (base * base).sum(axis=1))
+        self._since_refresh = 0
+
+    def process(self, samples, armed=None):
+        """
+        Takes the next block of samples and returns the events it starts.
+        :param samples: a (robots, n) array, or an (n,) array for one robot
+        :param armed: whether each robot is guarding, as a bool or a
+            (robots,) array. Only armed robots detect intrusions. Defaults to all.
+        :return: the events as (time, robot, name, payload) tuples in time order
+        """
+        samples = np.asarray(samples, dtype=np.float64)
+        if samples.ndim == 1:
+            samples = samples[None, :]
+        if samples.shape[0] != self.robots:
+            raise ValueError("expected samples for %d robots, got %d" % (self.robots, samples.shape[0]))
+        armed = np.broadcast_to(np.asarray(True if armed is None else armed, dtype=bool), (self.robots,))
+        if samples.shape[1] == 0:
+            return []
+        if self._ring is None:
+            self._fill(samples[:, 0])
+
+        events = []
+        # The ring must still hold every sample leaving the windows
+        for start in range(0, samples.shape[1], self._length):
+            events.extend(self._process(samples[:, start:start + self._length], armed))
+        return events
+
+    def _process(self, x, armed):
+        n = x.shape[1]
+        ring = self._ring
+        length = self._length
+        short = self._short
+        base = self._base
+
+        # The samples leaving the short window move into the baseline window
+        # and the oldest ones leave that
+        steps = np.arange(n)
+        tail = np.concatenate((ring[:, (self._pos + base + np.arange(short)) % length], x), axis=1)
+        to_base = tail[:, :n]
+        from_base = ring[:, (self._pos + steps) % length]
+
+        s_short, s_base, q_base = self._sums
+        sum_short = s_short[:, None] + np.cumsum(x - to_base, axis=1)
+        sum_base = s_base[:, None] + np.cumsum(to_base - from_base, axis=1)
+        sum_squares = q_base[:, None] + np.cumsum(to_base * to_base - from_base * from_base, axis=1)
+        self._sums = (sum_short[:, -1], sum_base[:, -1], sum_squares[:, -1])
+
+        ring[:, (self._pos + steps) % length] = x
+        self._pos = (self._pos + n) % length
+        self._since_refresh += n
+        if self._since_refresh >= length:
+            self._refresh()
+
+        mean = sum_short / short
+        base_mean = sum_base / base
+        std = np.sqrt(np.maximum(sum_squares / base - base_mean * base_mean, 0.0))
+        intruding = armed[:, None] & (np.abs(mean - base_mean) > np.maximum(self.sigma * std, self.min_delta))
+
+        conditions = (mean < self.near, mean > self.near + self.hysteresis, intruding, ~intruding)
+        held = []
+        for i, cond in enumerate(conditions):
+            runs = _runs(cond, self._carry[i])
+            self._carry[i] = np.minimum(runs[:, -1], self._debounce)
+            held.append(runs >= self._debounce)
+
+        events = []
+        for kind, (name, on, off, state) in enumerate(((PROXIMITY, held[0], held[1], self._near),
+                                                      (SENTRY, held[2], held[3], self._intruded))):
+            latched = _latch(on, off, state)
+            rising = latched & ~np.concatenate((state[:, None], latched[:, :-1]), axis=1)
+            state[:] = latched[:, -1]
+            robots, cols = np.nonzero(rising)
+            for robot, col in zip(robots.tolist(), cols.tolist()):
+                when = self.start + (self.samples + col) / self.rate
+                if when - self._last[kind, robot] < self.cooldown:
+                    self.suppressed += 1
+                    continue
+                self._last[kind, robot] = when
+                payload = {'distance': round(float(mean[robot, col]), 1)}
+                if name == SENTRY:
+                    payload['baseline'] = round(float(base_mean[robot, col]), 1)
+                events.append((when, robot, name, payload))
+
+        self.samples += n
+        self.events += len(events)
+        events.sort(key=lambda event: (event[0], event[1]))
+        return events
+
+
+class SentryMonitor():
+    """
+    Runs a SentryDetector on a MindstormsGadget's IR proximity while it is in
+    sentry mode.
+    """
+
+    def __init__(self, gadget, rate=1000.0, interval=0.1, noise=0.0, **detector):
+        """
+        :param gadget: the MindstormsGadget
+        :param rate: proximity samples per second
+        :param interval: seconds between reads of the samples
+        :param noise: the standard deviation of the sensor noise
+        :param detector: SentryDetector parameters
+        """
+        self.gadget = gadget
+        self.clock = gadget.clock
+        self.interval = interval
+        self.noise = noise
+        self.detector = SentryDetector(1, rate, **detector)
+        self.stream = None
+
+    def start(self):
+        """
+        Starts sampling from now, with fresh windows.
+        """
+        self.stop()
+        self.stream = self.gadget.ir.proximity_stream(self.detector.rate, self.noise)
+        self.detector.reset(self.clock.now())
+
+    def stop(self):
+        """
+        Stops sampling, so nothing is kept while sentry mode is off.
+        """
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    def poll(self):
+        """
+        Reads the samples due and returns the events they start as (name,
+        payload) pairs, see SentryDetector.process.
+        """
+        if self.stream is None:
+            return []
+        samples = self.stream.read()
+        if self.stream.dropped:
+            # Samples were skipped, so the windows start again from here
+            self.detector.reset(self.clock.now() - len(samples) / self.detector.rate)
+            self.stream.dropped = 0
+        return [(name, payload) for _, _, name, payload in self.detector.process(samples)]
+
+
+def synthetic(robots, samples, rate=1000.0, seed=0, noise=2.0, visits=1.0):
+    """
+    Proximity traces for a fleet: a steady scene per robot with sensor noise
+    and, on average, the given number of visitors per robot coming close for
+    a second or two.
+    :return: a (robots, samples) float array
+    """
+    rng = np.random.default_rng(seed)
+    traces = np.repeat(rng.uniform(60, 100, robots)[:, None], samples, axis=1)
+    traces += rng.normal(0.0, noise, traces.shape)
+    for robot in range(robots):
+        for _ in range(rng.poisson(visits)):
+            start = rng.integers(0, samples)
+            traces[robot, start:start + int(rng.uniform(1, 2) * rate)] = rng.uniform(5, 25)
+    return traces
+
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+Record and replay of what a gadget saw.
+
+A TraceWriter attached to a MindstormsGadget appends every sensor field change
+made to its world from outside, every control directive payload and every
+power reading to a compact binary trace. Changes the gadget makes itself,
+such as consuming a bump, are left out, since a replay makes them again.
+Sensor values that are not numbers, such as None, are not recorded.
+
+TraceReader walks a trace through a read-only memory map, one record at a
+time, and drops the pages it has passed, so replaying a multi-gigabyte trace
+takes constant memory. TracePlayer feeds the records back into a gadget on
+its clock, and TraceTelemetryBackend serves the recorded power readings.
+
+Replay a trace with a fresh gadget, as fast as possible or at a multiple of
+the recorded speed::
+
+    python sim_trace.py overnight.trace
+    python sim_trace.py overnight.trace --speed 10
+
+File format: an 8 byte magic and a '<d' Unix time the trace was started at,
+then records. Each record is a '<dBI' header (seconds since the start, kind,
+body length) and a body:
+
+- SENSOR: '<BBd' index into sim_vars.SENSOR_FIELDS, value type (VALUE_TYPES)
+  and value
+- DIRECTIVE: the raw payload bytes
+- POWER: '<ddd' batt_voltage, load_current and charge_current, NaN if missing
+- END: empty, written when the writer is closed
+
+A record cut short by a crash ends the trace.
+"""
+
+import argparse
+import math
+import mmap
+import numbers
+import struct
+import threading
+import time
+
+import sim_clock
+import sim_metrics
+import sim_profile
+import sim_vars
+from ev3dev2.sensor import bus_for
+from lego_directive import LegoDirective
+
+
+MAGIC = b'HPTRC\x00\x00\x01'
+HEADER = struct.Struct('<d')
+RECORD = struct.Struct('<dBI')
+SENSOR_BODY = struct.Struct('<BBd')
+POWER_BODY = struct.Struct('<ddd')
+
+SENSOR = 1
+DIRECTIVE = 2
+POWER = 3
+END = 4
+
+VALUE_TYPES = (float, int, bool)
+POWER_NAMES = ('batt_voltage', 'load_current', 'charge_current')
+
+# Seconds between flushes of the write buffer
+FLUSH_INTERVAL = 1.0
+
+# Bytes a reader passes before releasing the pages behind it
+RELEASE_SIZE = 16 * 1024 * 1024
+
+
+class TraceWriter():
+    """
+    Appends records to a trace file. Safe to use from several threads.
+    """
+
+    def __init__(self, path, clock=None):
+        """
+        :param path: the trace file, truncated if it exists
+        :param clock: the clock timestamping records, defaults to the shared sim_clock clock
+        """
+        self.path = path
+        self.clock = clock if clock is not None else sim_clock.get_clock()
+        self.start = self.clock.now()
+        self.world = None
+        self.skipped = 0
+
+        self._lock = threading.Lock()
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC + HEADER.pack(time.time()))
+        self._flushed_at = time.monotonic()
+
+    def attach(self, world):
+        """
+        Records the world's current sensor values and then every change to
+        them made from outside the gadget.
+        """
+        self.world = world
+        bus = bus_for(world)
+        for name in sim_vars.SENSOR_FIELDS:
+            self.sensor(name, getattr(world, name))
+            bus.subscribe(name, self._changed)
+
+    def detach(self):
+        if self.world is not None:
+            bus = bus_for(self.world)
+            for name in sim_vars.SENSOR_FIELDS:
+                bus.unsubscribe(name, self._changed)
+            self.world = None
+
+    def _changed(self, name, value):
+        if not bus_for(self.world).own:
+            self.sensor(name, value)
+
+    def sensor(self, name, value):
+        """
+        Records a sensor value. Values that are not numbers cannot be packed
+        and are only counted in skipped.
+        """
+        if type(value) in VALUE_TYPES:
+            value_type = VALUE_TYPES.index(type(value))
+        elif isinstance(value, numbers.Real):
+            value_type = 0
+        else:
+            self.skipped += 1
+            return
+        self._write(SENSOR, SENSOR_BODY.pack(sim_vars.SENSOR_FIELDS.index(name), value_type, value))
+
+    def directive(self, payload):
+        """
+        :param payload: the raw directive payload, bytes or str
+        """
+        self._write(DIRECTIVE, payload.encode('utf-8') if isinstance(payload, str) else bytes(payload))
+
+    def power(self, values):
+        """
+        :param values: the telemetry values, a dict of POWER_NAMES to readings
+        """
+        readings = [values.get(name) for name in POWER_NAMES]
+        self._write(POWER, POWER_BODY.pack(*(math.nan if r is None else r for r in readings)))
+
+    def _write(self, kind, body):
+        header = RECORD.pack(self.clock.now() - self.start, kind, len(body))
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(header + body)
+            now = time.monotonic()
+            if now - self._flushed_at >= FLUSH_INTERVAL:
+                self._file.flush()
+                self._flushed_at = now
+
+    def close(self):
+        self.detach()
+        self._write(END, b'')
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TraceReader():
+    """
+    Iterates over the records of a trace through a memory map.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            self._map.close()
+            raise ValueError("{} is not a trace file".format(path))
+        (self.started_at,) = HEADER.unpack_from(self._map, len(MAGIC))
+
+    def __iter__(self):
+        """
+        Yields (time, kind, value) tuples. value is a (field name, value) pair
+        for SENSOR records, the payload bytes for DIRECTIVE records, a dict of
+        readings for POWER records and empty bytes for the END record.
+        """
+        data = self._map
+        size = len(data)
+        offset = len(MAGIC) + HEADER.size
+        released = 0
+        while offset + RECORD.size <= size:
+            t, kind, length = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+            if offset + length > size:
+                break
+            if kind == SENSOR:
+                index, value_type, value = SENSOR_BODY.unpack_from(data, offset)
+                value = (sim_vars.SENSOR_FIELDS[index], VALUE_TYPES[value_type](value))
+            elif kind == POWER:
+                value = {name: r for name, r in zip(POWER_NAMES, POWER_BODY.unpack_from(data, offset))
+                         if not math.isnan(r)}
+            else:
+                value = data[offset:offset + length]
+            offset += length
+            yield t, kind, value
+
+            if offset - released >= RELEASE_SIZE and hasattr(mmap, 'MADV_DONTNEED'):
+                end = offset - offset % mmap.PAGESIZE
+                data.madvise(mmap.MADV_DONTNEED, released, end - released)
+                released = end
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TracePlayer():
+    """
+    Feeds a trace's sensor values and directives into a gadget.
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+
+    def play(self, gadget, until=None):
+        """
+        Applies each record at its recorded time on the gadget's clock, and
+        returns at the end of the session or at until. Records with the same
+        time are applied together, without the behaviors running in between,
+        since the behaviors only run when the clock moves forward. Power
+        readings are left to a TraceTelemetryBackend.
+        :param gadget: the MindstormsGadget to feed
+        :param until: stop at this many seconds into the trace, or None
+        :return: the number of records applied
+        """
+        clock = gadget.clock
+        start = clock.now()
+        count = 0
+        for t, kind, value in self.reader:
+            if until is not None and t > until:
+                break
+            if kind == POWER:
+                continue
+            if start + t > clock.now():
+                clock.run_until(start + t)
+            if kind == SENSOR:
+                setattr(gadget.world, *value)
+            elif kind == END:
+                break
+            else:
+                gadget.on_custom_mindstorms_gadget_control(LegoDirective(value))
+            count += 1
+        if until is not None:
+            clock.run_until(start + until)
+        return count
+
+
+class TraceTelemetryBackend():
+    """
+    Serves a trace's power readings in the order they were recorded, one per
+    fetch. The last reading is repeated once they run out.
+    """
+
+    def __init__(self, path):
+        self.reader = TraceReader(path)
+        self._readings = (value for t, kind, value in self.reader if kind == POWER)
+        self.values = {}
+
+    def fetch(self):
+        self.values = next(self._readings, self.values)
+        return self.values
+
+    def close(self):
+        """
+        Closes the trace. Fetches then repeat the last reading.
+        """
+        self._readings.close()
+        self.reader.close()
+
+
+def replay(path, speed=None, seed=None, until=None):
+    """
+    Replays a trace into a new gadget with its own world.
+    :param path: the trace file
+    :param speed: replay at this multiple of the recorded speed, or as fast
+        as possible if None
+    :param seed: seed for the gadget's clock
+    :param until: stop at this many seconds into the trace, or None
+    :return: the gadget
+    """
+    from housepet_gadget import MindstormsGadget
+
+    clock = sim_clock.set_clock(sim_clock.SimClock(fast=speed is None, seed=seed, rate=speed or 1.0))
+    world = sim_vars.WorldState()
+    gadget = MindstormsGadget(clock=clock, world=world, telemetry=lambda world: TraceTelemetryBackend(path),
+                              trace=False)
+    with TraceReader(path) as reader:
+        try:
+            TracePlayer(reader).play(gadget, until)
+        finally:
+            clock.stop()
+            gadget.close_telemetry()
+    return gadget
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a gadget trace.")
+    parser.add_argument("trace", help="trace file")
+    parser.add_argument("--speed", type=float, default=None,
+                        help="multiple of the recorded speed, default as fast as possible")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--until", type=float, default=None, help="stop at this many seconds into the trace")
+    parser.add_argument("--profile", metavar="PATH", help="write sampled stacks to PATH (folded format)")
+    parser.add_argument("--metrics-port", type=int, default=None, help="serve metrics on this local port")
+    args = parser.parse_args(argv)
+
+    if args.metrics_port is not None:
+        sim_metrics.enable()
+        sim_metrics.serve(args.metrics_port)
+
+    sampler = sim_profile.Sampler().start() if args.profile else None
+    start = time.perf_counter()
+    try:
+        gadget = replay(args.trace, args.speed, args.seed, args.until)
+    finally:
+        if sampler is not None:
+            sampler.stop().write(args.profile)
+    x, y, theta = gadget.drive.pose
+    print("Replayed {} in {:.2f}s".format(args.trace, time.perf_counter() - start))
+    print("Pose: ({:.3f}, {:.3f}, {:.3f}), patrol {}, follow {}".format(
+        x, y, theta, gadget.patrol_mode, gadget.follow_mode))
+
+
+if __name__ == '__main__':
+    main()
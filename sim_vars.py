@@ -1,3 +1,119 @@
+import sys
+import types
+
 led_count = 0
 ir_beacon_heading = 2
-touch_bump = False
\ No newline at end of file
+touch_bump = False
+ambient_light_intensity = 0
+ir_proximity = 100
+pose_x = 0.0
+pose_y = 0.0
+pose_theta = 0.0
+batt_voltage = 3.7
+load_current = 0.0
+charge_current = 0.0
+
+# Fields whose changes are published on the world's sensor bus
+SENSOR_FIELDS = ('ir_beacon_heading', 'touch_bump', 'ambient_light_intensity', 'ir_proximity')
+
+
+def _sensor_field(name):
+    slot = '_' + name
+
+    def get(self):
+        return getattr(self, slot)
+
+    def set(self, value):
+        old = getattr(self, slot)
+        setattr(self, slot, value)
+        if self.bus is not None and value != old:
+            self.bus.publish(name, value)
+
+    return property(get, set)
+
+
+class WorldState(object):
+    """
+    The simulated world seen by one robot. Sensors and actuators that are given
+    a WorldState read and write it instead of the module globals, so several
+    robots can share one interpreter. Changes to the SENSOR_FIELDS are
+    published on the world's sensor bus, see ev3dev2.sensor.
+    """
+
+    __slots__ = ('bus', 'led_count', '_ir_beacon_heading', '_touch_bump', '_ambient_light_intensity',
+                 '_ir_proximity', 'pose_x', 'pose_y', 'pose_theta', 'batt_voltage', 'load_current', 'charge_current')
+
+    ir_beacon_heading = _sensor_field('ir_beacon_heading')
+    touch_bump = _sensor_field('touch_bump')
+    ambient_light_intensity = _sensor_field('ambient_light_intensity')
+    ir_proximity = _sensor_field('ir_proximity')
+
+    def __init__(self, led_count=0, ir_beacon_heading=2, touch_bump=False, ambient_light_intensity=0,
+                 pose_x=0.0, pose_y=0.0, pose_theta=0.0, batt_voltage=3.7, load_current=0.0, charge_current=0.0,
+                 ir_proximity=100):
+        self.bus = None
+        self.led_count = led_count
+        self._ir_beacon_heading = ir_beacon_heading
+        self._touch_bump = touch_bump
+        self._ambient_light_intensity = ambient_light_intensity
+        self._ir_proximity = ir_proximity
+        self.pose_x = pose_x
+        self.pose_y = pose_y
+        self.pose_theta = pose_theta
+        self.batt_voltage = batt_voltage
+        self.load_current = load_current
+        self.charge_current = charge_current
+
+
+def _module_var(name):
+    module = globals()
+
+    def get(self):
+        return module[name]
+
+    def set(self, value):
+        setattr(sys.modules[__name__], name, value)
+
+    return property(get, set)
+
+
+class _ModuleWorldState(WorldState):
+    """
+    A WorldState backed by the module globals, used when no world is given.
+    """
+
+    __slots__ = ()
+
+    led_count = _module_var('led_count')
+    ir_beacon_heading = _module_var('ir_beacon_heading')
+    touch_bump = _module_var('touch_bump')
+    ambient_light_intensity = _module_var('ambient_light_intensity')
+    ir_proximity = _module_var('ir_proximity')
+    pose_x = _module_var('pose_x')
+    pose_y = _module_var('pose_y')
+    pose_theta = _module_var('pose_theta')
+    batt_voltage = _module_var('batt_voltage')
+    load_current = _module_var('load_current')
+    charge_current = _module_var('charge_current')
+
+    def __init__(self):
+        self.bus = None
+
+
+GLOBAL_WORLD = _ModuleWorldState()
+
+
+class _SimVarsModule(types.ModuleType):
+    """
+    Publishes changes to the sensor globals on GLOBAL_WORLD's bus, so old
+    scripts that assign sim_vars.touch_bump directly still wake waiting sensors.
+    """
+
+    def __setattr__(self, name, value):
+        old = self.__dict__.get(name)
+        super().__setattr__(name, value)
+        if name in SENSOR_FIELDS and GLOBAL_WORLD.bus is not None and value != old:
+            GLOBAL_WORLD.bus.publish(name, value)
+
+
+sys.modules[__name__].__class__ = _SimVarsModule
@@ -0,0 +1,137 @@
+"""
+Telemetry backends for the power board readings.
+
+IotTelemetryClient reads the Arduino IoT Cloud thing. All of the thing's
+properties are fetched with one bulk request over a pooled keep-alive session.
+The last good values are cached for a TTL and kept when a request fails, and
+the OAuth token is only fetched again once it has expired. The HTTP and OAuth
+libraries are imported when the client is created, not when this module is.
+
+SimTelemetryBackend reads the same values from a sim_vars.WorldState.
+"""
+
+import logging
+import time
+
+import sim_clock
+import sim_vars
+
+logger = logging.getLogger(__name__)
+
+TOKEN_URL = "https://login.arduino.cc/oauth/token"
+API_HOST = "https://api2.arduino.cc/iot"
+AUDIENCE = "https://api2.arduino.cc/iot"
+
+# Fetch a new token this many seconds before the old one expires
+TOKEN_MARGIN = 30
+
+
+class TelemetryError(Exception):
+    """
+    Raised when no telemetry values can be fetched.
+    """
+
+
+class IotTelemetryClient():
+    """
+    Reads a thing's properties from the Arduino IoT Cloud.
+    """
+
+    def __init__(self, thing_id, property_ids, client_id, client_secret,
+                 token_url=TOKEN_URL, host=API_HOST, audience=AUDIENCE, ttl=10.0, timeout=5.0, clock=None):
+        """
+        :param thing_id: the IoT Cloud thing id
+        :param property_ids: a dict of value name to property id
+        :param client_id: the OAuth client id
+        :param client_secret: the OAuth client secret
+        :param ttl: seconds of simulated time that fetched values are reused for
+        :param timeout: the HTTP timeout in seconds
+        :param clock: the simulation clock used for the TTL, defaults to the shared sim_clock clock
+        """
+        self.thing_id = thing_id
+        self.property_names = {pid: name for name, pid in property_ids.items()}
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.token_url = token_url
+        self.host = host.rstrip("/")
+        self.audience = audience
+        self.ttl = ttl
+        self.timeout = timeout
+        self.clock = clock
+
+        self.values = {}
+        self.fetched_at = None
+
+        import requests
+        from oauthlib.oauth2 import BackendApplicationClient, OAuth2Error
+        from requests_oauthlib import OAuth2Session
+
+        # A rejected or expired credential fails like any other request
+        self._request_errors = (requests.RequestException, ValueError, OAuth2Error)
+        self.session = OAuth2Session(client=BackendApplicationClient(client_id=client_id))
+
+    def fetch(self):
+        """
+        Returns a dict of value name to last value. Values are served from the
+        cache while it is fresh; if a request fails the last good values are
+        returned instead.
+        """
+        now = self.clock.now() if self.clock is not None else sim_clock.now()
+        if self.fetched_at is not None and now - self.fetched_at < self.ttl:
+            return self.values
+
+        try:
+            self.values = dict(self.values, **self._fetch_properties())
+            self.fetched_at = now
+        except self._request_errors as e:
+            logger.warning("Telemetry fetch failed: %s", e)
+            if not self.values:
+                raise TelemetryError(str(e))
+
+        return self.values
+
+    def _fetch_properties(self):
+        self._ensure_token()
+        url = "{}/v2/things/{}/properties".format(self.host, self.thing_id)
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+
+        values = {}
+        for prop in response.json():
+            name = self.property_names.get(prop.get("id"))
+            if name is not None and prop.get("last_value") is not None:
+                values[name] = prop["last_value"]
+        return values
+
+    def _ensure_token(self):
+        token = self.session.token
+        if token and token.get("expires_at", 0) - TOKEN_MARGIN > time.time():
+            return
+
+        self.session.fetch_token(
+            token_url=self.token_url,
+            client_id=self.client_id,
+            client_secret=self.client_secret,
+            audience=self.audience,
+            timeout=self.timeout
+        )
+
+
+class SimTelemetryBackend():
+    """
+    Serves the power readings from a WorldState instead of the IoT Cloud.
+    """
+
+    def __init__(self, world=None):
+        """
+        :param world: the WorldState to read, defaults to the sim_vars globals
+        """
+        self.world = world if world is not None else sim_vars.GLOBAL_WORLD
+
+    def fetch(self):
+        world = self.world
+        return {
+            'batt_voltage': world.batt_voltage,
+            'load_current': world.load_current,
+            'charge_current': world.charge_current,
+        }
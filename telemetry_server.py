@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Arduino IoT Cloud, for offline runs and benchmarks.
+
+Serves the OAuth client credentials token endpoint and the thing property
+endpoints used by telemetry.IotTelemetryClient.
+"""
+
+import argparse
+import json
+import os
+import re
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+PROPERTIES_PATH = re.compile(r"^/iot/v2/things/([^/]+)/properties(?:/([^/]+))?$")
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # Send each response in one segment so keep-alive clients are not held up
+    # by delayed ACKs
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        if self.path != "/oauth/token":
+            return self._send(404, {"error": "not found"})
+
+        token = secrets.token_hex(16)
+        self.server.tokens[token] = time.time() + self.server.token_lifetime
+        self.server.token_requests += 1
+        self._send(200, {"access_token": token, "token_type": "bearer", "expires_in": self.server.token_lifetime})
+
+    def do_GET(self):
+        match = PROPERTIES_PATH.match(self.path)
+        if not match:
+            return self._send(404, {"error": "not found"})
+
+        token = self.headers.get("Authorization", "")[len("Bearer "):]
+        if self.server.tokens.get(token, 0) < time.time():
+            return self._send(401, {"error": "invalid token"})
+
+        thing_id, property_id = match.groups()
+        self.server.property_requests += 1
+        properties = [{"id": pid, "thing_id": thing_id, "last_value": value}
+                      for pid, value in self.server.properties.items()]
+        if property_id is None:
+            return self._send(200, properties)
+
+        for prop in properties:
+            if prop["id"] == property_id:
+                return self._send(200, prop)
+        self._send(404, {"error": "not found"})
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    The stand-in server. properties maps property id to its last value.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, properties, address=("127.0.0.1", 0), token_lifetime=300):
+        super().__init__(address, StandInHandler)
+        self.properties = dict(properties)
+        self.token_lifetime = token_lifetime
+        self.tokens = {}
+        self.token_requests = 0
+        self.property_requests = 0
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address[:2])
+
+    def client_kwargs(self):
+        """
+        Keyword arguments pointing an IotTelemetryClient at this server.
+        """
+        return {"token_url": self.url + "/oauth/token", "host": self.url + "/iot"}
+
+
+def start(properties, address=("127.0.0.1", 0), token_lifetime=300):
+    """
+    Starts a stand-in server on a background thread and returns it.
+    """
+    # oauthlib refuses plain http token endpoints unless told otherwise
+    os.environ.setdefault("OAUTHLIB_INSECURE_TRANSPORT", "1")
+
+    server = StandInServer(properties, address, token_lifetime)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the Arduino IoT Cloud.")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--property", nargs=2, action="append", default=[], metavar=("ID", "VALUE"),
+                        help="a property id and its last value")
+    args = parser.parse_args(argv)
+
+    properties = {pid: float(value) for pid, value in args.property}
+    server = StandInServer(properties, ("127.0.0.1", args.port))
+    print("Serving on {}".format(server.url))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import asyncio
+import json
+import math
+
+import pytest
+
+import sim_clock
+import sim_recorder
+from housepet_gadget import AsyncMindstormsGadget
+from lego_directive import LegoDirective
+from sim_vars import WorldState
+
+
+@pytest.mark.parametrize("payload, moves", [
+    ({"type": "command", "command": "circle"}, True),
+    ({"type": "command", "command": "square"}, True),
+    ({"type": "command", "command": "sentry"}, False),
+    ({"type": "command", "command": "patrol"}, True),
+    ({"type": "move", "direction": "left", "duration": 2, "speed": 50}, True),
+    ({"type": "move", "direction": "forward", "duration": 2, "speed": 50}, True),
+    ({"type": "move", "direction": "stop", "duration": 0, "speed": 0}, False),
+    ({"type": "follow"}, True),
+    ({"type": "stopfollow"}, False),
+])
+def test_directives_do_not_block_the_running_loop(payload, moves):
+    loop = sim_clock.new_event_loop(fast=True)
+    errors = []
+    loop.set_exception_handler(lambda loop, context: errors.append(context))
+
+    async def run():
+        recorder = sim_recorder.EventRecorder(level=sim_recorder.OFF)
+        gadget = AsyncMindstormsGadget(world=WorldState(), telemetry='sim', seed=1, recorder=recorder)
+        gadget.send_custom_event = lambda namespace, name, payload: None
+        await gadget.start()
+        gadget.on_custom_mindstorms_gadget_control(LegoDirective(json.dumps(payload).encode()))
+        await asyncio.sleep(30)
+        pose = gadget.drive.pose
+        await gadget.stop()
+        return pose
+
+    try:
+        pose = loop.run_until_complete(run())
+    finally:
+        loop.close()
+    assert not errors
+    # A fast loop's time moves on a little between the two motor commands
+    assert (math.hypot(pose[0], pose[1]) > 0.01) == moves
+
+
+def test_directives_run_in_turn():
+    loop = sim_clock.new_event_loop(fast=True)
+
+    async def run():
+        recorder = sim_recorder.EventRecorder(level=sim_recorder.OFF)
+        gadget = AsyncMindstormsGadget(world=WorldState(), telemetry='sim', recorder=recorder)
+        gadget.send_custom_event = lambda namespace, name, payload: None
+        await gadget.start()
+        gadget.dispatch_directives([b'{"type": "command", "command": "square"}',
+                                    b'{"type": "move", "direction": "stop", "duration": 0, "speed": 0}'])
+        await asyncio.sleep(1)
+        turning = gadget.drive.is_running
+        await asyncio.sleep(20)
+        stopped = not gadget.drive.is_running
+        await gadget.stop()
+        return turning, stopped
+
+    try:
+        assert loop.run_until_complete(run()) == (True, True)
+    finally:
+        loop.close()
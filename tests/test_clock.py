@@ -0,0 +1,38 @@
+import threading
+import time
+
+import sim_clock
+import sim_recorder
+from housepet_gadget import MindstormsGadget
+from sim_vars import WorldState
+
+
+def test_stop_wakes_a_real_time_wait():
+    clock = sim_clock.SimClock()
+    event = sim_clock.ClockEvent()
+    raised = []
+
+    def waiter():
+        try:
+            clock.wait(event)
+        except sim_clock.ClockStopped:
+            raised.append(True)
+    thread = threading.Thread(target=waiter, daemon=True)
+    thread.start()
+    time.sleep(0.1)
+    clock.stop()
+    thread.join(5)
+    assert raised == [True]
+
+
+def test_light_mode_follows_the_battery_crossing_low():
+    clock = sim_clock.SimClock(fast=True, seed=3)
+    recorder = sim_recorder.EventRecorder(level=sim_recorder.OFF, clock=clock)
+    gadget = MindstormsGadget(clock=clock, world=WorldState(), telemetry='sim', recorder=recorder)
+    clock.run_until(20)
+    gadget._read_power({'batt_voltage': 3.5})
+    clock.run_until(21)
+    assert gadget.light.mode == 'REF-RAW'
+    gadget._read_power({'batt_voltage': 3.9})
+    clock.run_until(22)
+    assert gadget.light.mode == 'COL-COLOR'
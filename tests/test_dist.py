@@ -0,0 +1,105 @@
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+import sim_batch
+import sim_dist
+
+
+def _episodes(count, duration=5):
+    return [{"seed": i, "duration": duration, "directives": [[1, {"type": "command", "command": "patrol"}]]}
+            for i in range(count)]
+
+
+def _ask(coordinator, name, want=0, results=(), errors=()):
+    return coordinator.handle(name, {'worker': name, 'want': want, 'results': list(results),
+                                     'errors': list(errors)})
+
+
+def _tasks(reply):
+    return [index for index, episode in reply['tasks']]
+
+
+def _without_wall_time(row):
+    return {key: value for key, value in row.items() if key != 'wall_time'}
+
+
+def test_results_match_run_episode():
+    episodes = _episodes(6)
+    coordinator = sim_dist.run_local(episodes, workers=2, batch=2)
+    columns = coordinator.columns()
+    assert columns['episode'] == list(range(len(episodes)))
+    for index, episode in enumerate(episodes):
+        row = {name: column[index] for name, column in columns.items() if name != 'episode'}
+        assert _without_wall_time(row) == _without_wall_time(sim_batch.run_episode(episode))
+
+
+def _take_and_hang(address, ready):
+    sock = socket.create_connection(address)
+    sock.sendall(sim_dist.encode_frame({'worker': 'doomed', 'want': 2, 'results': [], 'errors': []}))
+    sim_dist.read_frame(sock.makefile('rb'))
+    ready.set()
+    time.sleep(60)
+
+
+def test_killed_workers_episodes_are_retried():
+    coordinator = sim_dist.Coordinator(_episodes(4)).start()
+    try:
+        ready = multiprocessing.Event()
+        doomed = multiprocessing.Process(target=_take_and_hang, args=(coordinator.address, ready), daemon=True)
+        doomed.start()
+        assert ready.wait(10)
+        os.kill(doomed.pid, signal.SIGKILL)
+        doomed.join()
+        deadline = time.monotonic() + 10
+        while coordinator.stats()['workers'] and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        assert sim_dist.run_worker(coordinator.address, batch=2, name='survivor') == 4
+        assert coordinator.wait(timeout=10)
+    finally:
+        coordinator.close()
+    stats = coordinator.stats()
+    assert stats['finished'] == 4 and stats['retries'] == 2 and stats['failed'] == 0
+
+
+def test_silent_worker_loses_its_lease_and_late_results_count_once():
+    coordinator = sim_dist.Coordinator(_episodes(3), lease=0.1).start()
+    try:
+        assert _tasks(_ask(coordinator, 'silent', want=2)) == [0, 1]
+        assert _tasks(_ask(coordinator, 'busy', want=1)) == [2]
+        time.sleep(0.2)
+        # The silent worker's lease has run out, so its episodes go to the front
+        reply = _ask(coordinator, 'busy', want=2, results=[[2, {'seed': 2}]])
+        assert _tasks(reply) == [0, 1]
+        assert coordinator.retries == 2
+
+        _ask(coordinator, 'busy', results=[[0, {'seed': 0}], [1, {'seed': 1}]])
+        assert coordinator.finished()
+        # The silent worker was still running them after all
+        assert _ask(coordinator, 'silent', results=[[0, {'seed': 0}], [1, {'seed': 1}]])['op'] == 'done'
+    finally:
+        coordinator.close()
+    assert coordinator.duplicates == 2
+    assert sorted(coordinator.results) == [0, 1, 2]
+
+
+def test_idle_worker_steals_the_back_half_of_the_busiest_batch():
+    coordinator = sim_dist.Coordinator(_episodes(4)).start()
+    try:
+        assert _tasks(_ask(coordinator, 'slow', want=4)) == [0, 1, 2, 3]
+        assert _tasks(_ask(coordinator, 'idle', want=4)) == [2, 3]
+        assert coordinator.steals == 2
+        # The victim is told to drop them with its next reply
+        reply = _ask(coordinator, 'slow', results=[[0, {'seed': 0}]])
+        assert reply['cancel'] == [2, 3] and _tasks(reply) == []
+        # It had already started one of them, so that result comes twice
+        _ask(coordinator, 'slow', results=[[1, {'seed': 1}], [2, {'seed': 2}]])
+        _ask(coordinator, 'idle', results=[[2, {'seed': 2}], [3, {'seed': 3}]])
+        assert coordinator.finished()
+    finally:
+        coordinator.close()
+    assert coordinator.duplicates == 1
+    assert coordinator.stats()['steals'] == 2
@@ -0,0 +1,53 @@
+import sim_clock
+from alexa_events import EventQueue
+
+
+class FlakyTransport():
+    """
+    Fails the first failures sends, then records the batches and when they came.
+    """
+
+    def __init__(self, clock, failures):
+        self.clock = clock
+        self.failures = failures
+        self.attempts = []
+        self.batches = []
+
+    def send(self, events):
+        self.attempts.append(self.clock.now())
+        if len(self.attempts) <= self.failures:
+            raise OSError("link down")
+        self.batches.append([(event['name'], event['payload']) for event in events])
+
+
+def test_failed_batch_is_retried_in_order_with_backoff():
+    clock = sim_clock.SimClock(fast=True)
+    transport = FlakyTransport(clock, failures=3)
+    queue = EventQueue(transport, clock=clock, retry_delay=0.5)
+    queue.put('ns', 'Speech', 1)
+    queue.put('ns', 'Power', 2)
+    queue.put('ns', 'Speech', 3)
+    queue.start()
+    clock.run_until(0.1)
+    # A newer Power reading queued while the batch is out replaces it in place
+    queue.put('ns', 'Power', 4)
+    queue.put('ns', 'Speech', 5)
+    clock.run_until(10)
+
+    assert transport.attempts == [0.0, 0.5, 1.5, 3.5]
+    assert transport.batches == [[('Speech', 1), ('Power', 4), ('Speech', 3), ('Speech', 5)]]
+    stats = queue.stats()
+    assert stats['sent'] == 4 and stats['failed'] == 11 and stats['pending'] == 0
+
+
+def test_backoff_resets_after_a_send():
+    clock = sim_clock.SimClock(fast=True)
+    transport = FlakyTransport(clock, failures=1)
+    queue = EventQueue(transport, clock=clock, retry_delay=0.5)
+    queue.put('ns', 'Speech', 1)
+    queue.start()
+    clock.run_until(1)
+    transport.failures = 3
+    queue.put('ns', 'Speech', 2)
+    clock.run_until(5)
+    assert transport.attempts == [0.0, 0.5, 1.0, 1.5]
@@ -0,0 +1,77 @@
+import math
+
+import sim_clock
+import sim_recorder
+from ev3dev2.motor import AXLE_TRACK, WHEEL_DIAMETER, OUTPUT_C, OUTPUT_D, MoveSteering, MoveTank, SpeedPercent
+from sim_vars import WorldState
+
+
+def _drive():
+    clock = sim_clock.SimClock(fast=True)
+    recorder = sim_recorder.EventRecorder(level=sim_recorder.OFF, clock=clock)
+    return MoveTank(OUTPUT_D, OUTPUT_C, world=WorldState(), clock=clock, recorder=recorder), clock
+
+
+def _metres(drive, percent, seconds):
+    counts = percent / 100 * drive.left_motor.max_speed * seconds
+    return counts * math.pi * WHEEL_DIAMETER / drive.left_motor.count_per_rot
+
+
+def test_off_between_ticks_integrates_the_rest_of_the_tick():
+    drive, clock = _drive()
+    drive.on(SpeedPercent(50), SpeedPercent(50))
+    clock.run_until(0.105)
+    drive.off()
+    clock.run_until(1.0)
+    x, y, theta = drive.pose
+    assert math.isclose(x, _metres(drive, 50, 0.105), rel_tol=1e-9)
+    assert y == 0.0 and theta == 0.0
+
+
+def test_new_command_between_ticks_keeps_the_old_speed_until_it_lands():
+    drive, clock = _drive()
+    drive.on(SpeedPercent(50), SpeedPercent(50))
+    clock.run_until(0.105)
+    drive.on(SpeedPercent(100), SpeedPercent(100))
+    clock.run_until(0.2)
+    drive.off()
+    x, _, _ = drive.pose
+    assert math.isclose(x, _metres(drive, 50, 0.105) + _metres(drive, 100, 0.095), rel_tol=1e-9)
+
+
+def test_spin_between_ticks_turns_exactly():
+    drive, clock = _drive()
+    drive.on(SpeedPercent(-20), SpeedPercent(20))
+    clock.run_until(0.0137)
+    drive.off()
+    _, _, theta = drive.pose
+    assert math.isclose(theta, 2 * _metres(drive, 20, 0.0137) / AXLE_TRACK, rel_tol=1e-9)
+
+
+def _steering(drive):
+    return MoveSteering(drive.left_motor, drive.right_motor, world=drive.world, clock=drive.clock)
+
+
+def test_stopping_one_drive_stops_a_drive_sharing_its_motors():
+    drive, clock = _drive()
+    steering = _steering(drive)
+    steering.on(0, SpeedPercent(50))
+    clock.run_until(0.5)
+    drive.off()
+    assert not steering.is_running
+    clock.run_until(1.0)
+    x, _, _ = steering.pose
+    assert math.isclose(x, _metres(drive, 50, 0.5), rel_tol=1e-9)
+
+
+def test_drives_sharing_motors_move_the_pose_once():
+    drive, clock = _drive()
+    steering = _steering(drive)
+    steering.on(0, SpeedPercent(50))
+    clock.run_until(0.25)
+    drive.pose
+    clock.run_until(0.5)
+    steering.pose
+    drive.off()
+    assert drive.pose == steering.pose
+    assert math.isclose(drive.pose[0], _metres(drive, 50, 0.5), rel_tol=1e-9)
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from sim_power import BatteryModel, fast_forward
+
+
+def _stepwise(model, load_ma, charge_ma, dt, soc):
+    """
+    fast_forward one entry at a time.
+    """
+    scale = dt / 3600.0 / model.capacity_mah
+    is_on = soc > 0
+    socs, on = [], []
+    for load, charge in zip(load_ma, charge_ma):
+        on.append(is_on)
+        if is_on:
+            soc = min(1.0, soc + (charge - load) * scale)
+            if soc <= 0.0:
+                soc = 0.0
+                is_on = False
+        else:
+            soc += charge * scale
+            if soc >= model.restart_soc:
+                is_on = True
+        socs.append(soc)
+    return np.array(socs), np.array(on)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_fast_forward_matches_stepping(seed):
+    rng = np.random.default_rng(seed)
+    model = BatteryModel(capacity_mah=5.0)
+    n = 20000
+    load = rng.uniform(0, 400, n)
+    # Days and nights, so the pet runs empty, restarts and charges to full
+    charge = np.where(np.arange(n) // 2000 % 2 == 0, rng.uniform(0, 900, n), 0.0)
+    socs, on = fast_forward(model, load, charge, 1.0, soc=0.6)
+    expected_socs, expected_on = _stepwise(model, load, charge, 1.0, 0.6)
+
+    assert (~on).any() and (socs == 1.0).any()
+    assert np.array_equal(on, expected_on)
+    assert np.allclose(socs, expected_socs, atol=1e-9)
+
+
+def test_fast_forward_starting_empty_waits_for_restart():
+    model = BatteryModel(capacity_mah=1.0, restart_soc=0.5)
+    # 360 mA for 1 s charges a 1 mAh battery by a tenth
+    socs, on = fast_forward(model, np.full(8, 100.0), np.full(8, 360.0), 1.0, soc=0.0)
+    assert not on[:5].any() and on[5:].all()
+    assert np.isclose(socs[4], 0.5)
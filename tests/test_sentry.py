@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+import sim_clock
+from ev3dev2.sensor.lego import ProximityStream
+from sim_sentry import SentryDetector, synthetic
+from sim_vars import WorldState
+
+
+def test_proximity_changes_kept_are_bounded_without_reads():
+    clock = sim_clock.SimClock(fast=True)
+    world = WorldState()
+    stream = ProximityStream(world, clock, rate=1000.0, max_block=100)
+    history = []
+    for i in range(20000):
+        # Bursts of changes at one instant, then a step of half a sample
+        if i % 4 == 0:
+            clock.run_until(clock.now() + 0.0005)
+        world.ir_proximity = i % 97
+        history.append((clock.now(), i % 97))
+        assert len(stream._changes) <= 2 * stream.max_block + 4
+
+    clock.run_until(clock.now() + 0.0005)
+    samples = stream.read()
+    assert len(samples) == stream.max_block and stream.dropped
+    times = stream._next - np.arange(len(samples), 0, -1) / stream.rate
+    change_times = np.array([t for t, value in history])
+    values = np.array([value for t, value in history], dtype=np.float64)
+    assert np.array_equal(samples, values[np.searchsorted(change_times, times, side='right') - 1])
+
+
+@pytest.mark.parametrize("block", [1, 37, 250, 3000])
+def test_sentry_events_do_not_depend_on_the_block_size(block):
+    rate = 1000.0
+    traces = synthetic(3, 6000, rate, seed=4, visits=2.0)
+    # Intrusions too: one robot's scene changes for good half way through
+    traces[1, 3000:] -= 40
+
+    whole = SentryDetector(3, rate).process(traces)
+    detector = SentryDetector(3, rate)
+    blocks = []
+    for start in range(0, traces.shape[1], block):
+        blocks.extend(detector.process(traces[:, start:start + block]))
+
+    assert {name for _, _, name, _ in whole} == {'Proximity', 'Sentry'}
+    assert [(round(t, 9), robot, name) for t, robot, name, _ in blocks] == \
+        [(round(t, 9), robot, name) for t, robot, name, _ in whole]
+    for (_, _, _, payload), (_, _, _, expected) in zip(blocks, whole):
+        assert payload == pytest.approx(expected, abs=0.11)
@@ -0,0 +1,29 @@
+import pytest
+from oauthlib.oauth2 import InvalidClientError
+
+import sim_clock
+from telemetry import IotTelemetryClient, TelemetryError
+
+
+def _client(clock):
+    client = IotTelemetryClient("thing", {"batt_voltage": "p1"}, "id", "secret", ttl=10.0, clock=clock)
+
+    def reject(**kwargs):
+        raise InvalidClientError()
+    client.session.fetch_token = reject
+    return client
+
+
+def test_rejected_credential_keeps_the_cached_values():
+    clock = sim_clock.SimClock(fast=True)
+    client = _client(clock)
+    client.values = {"batt_voltage": 3.9}
+    client.fetched_at = 0.0
+    clock.run_until(20)
+    assert client.fetch() == {"batt_voltage": 3.9}
+
+
+def test_rejected_credential_without_values_raises_telemetry_error():
+    client = _client(sim_clock.SimClock(fast=True))
+    with pytest.raises(TelemetryError):
+        client.fetch()
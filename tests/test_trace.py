@@ -0,0 +1,122 @@
+import asyncio
+import random
+
+import numpy as np
+import pytest
+
+import sim_clock
+import sim_recorder
+from housepet_gadget import AsyncMindstormsGadget, MindstormsGadget
+from lego_directive import LegoDirective
+from sim_trace import SENSOR, TracePlayer, TraceReader, TraceTelemetryBackend, TraceWriter
+from sim_vars import WorldState
+
+
+DIRECTIVES = [
+    b'{"type": "command", "command": "patrol"}',
+    b'{"type": "command", "command": "sentry"}',
+    b'{"type": "command", "command": "square"}',
+    b'{"type": "follow"}',
+    b'{"type": "stopfollow"}',
+    b'{"type": "move", "direction": "forward", "duration": 2, "speed": 50}',
+    b'{"type": "move", "direction": "stop", "duration": 0, "speed": 0}',
+]
+
+
+def _session(seed, inputs=60):
+    """
+    A session of (time, sensor field or None for a directive, value) inputs,
+    many of them landing together.
+    """
+    rng = random.Random(seed)
+    t = 0.0
+    session = []
+    for _ in range(inputs):
+        t += rng.choice([0, 0, 0, 0.5, 1, 2.37, 5])
+        kind = rng.random()
+        if kind < 0.3:
+            session.append((t, None, rng.choice(DIRECTIVES)))
+        elif kind < 0.6:
+            session.append((t, 'touch_bump', True))
+        elif kind < 0.8:
+            session.append((t, 'ir_beacon_heading', rng.randint(-4, 4)))
+        else:
+            session.append((t, 'ambient_light_intensity', rng.randint(0, 50)))
+    return session
+
+
+def _gadget(**kwargs):
+    clock = sim_clock.SimClock(fast=True, seed=3)
+    recorder = sim_recorder.EventRecorder(level=sim_recorder.OFF, clock=clock)
+    return MindstormsGadget(clock=clock, world=WorldState(), telemetry='sim', recorder=recorder, **kwargs)
+
+
+@pytest.mark.parametrize("seed", [16, 20, 21])
+def test_replay_reproduces_the_recorded_session(tmp_path, seed):
+    path = str(tmp_path / "session.trace")
+    gadget = _gadget(trace=path)
+    for t, name, value in _session(seed):
+        # Blocking directives can run past the next input
+        if t > gadget.clock.now():
+            gadget.clock.run_until(t)
+        if name is None:
+            gadget.on_custom_mindstorms_gadget_control(LegoDirective(value))
+        else:
+            setattr(gadget.world, name, value)
+    end = gadget.clock.now() + 20
+    gadget.clock.run_until(end)
+    recorded = gadget.drive.pose
+    gadget.trace.close()
+    gadget.clock.stop()
+
+    replayed = _gadget(trace=False)
+    with TraceReader(path) as reader:
+        TracePlayer(reader).play(replayed, until=end)
+    pose = replayed.drive.pose
+    replayed.clock.stop()
+
+    assert pose == recorded
+
+
+def test_values_that_are_not_numbers_are_skipped(tmp_path):
+    path = str(tmp_path / "values.trace")
+    clock = sim_clock.SimClock(fast=True)
+    with TraceWriter(path, clock=clock) as writer:
+        writer.sensor('ir_beacon_heading', None)
+        writer.sensor('ir_beacon_heading', 'left')
+        writer.sensor('ir_beacon_heading', np.int64(3))
+        writer.sensor('touch_bump', True)
+    assert writer.skipped == 2
+    with TraceReader(path) as reader:
+        records = [value for t, kind, value in reader if kind == SENSOR]
+    assert records == [('ir_beacon_heading', 3.0), ('touch_bump', True)]
+
+
+def test_stopping_the_gadget_closes_the_trace_backend(tmp_path):
+    path = str(tmp_path / "power.trace")
+    clock = sim_clock.SimClock(fast=True)
+    with TraceWriter(path, clock=clock) as writer:
+        writer.power({'batt_voltage': 3.9})
+        writer.power({'batt_voltage': 3.8})
+    backends = []
+
+    def backend(world):
+        backends.append(TraceTelemetryBackend(path))
+        return backends[-1]
+
+    async def run():
+        recorder = sim_recorder.EventRecorder(level=sim_recorder.OFF)
+        gadget = AsyncMindstormsGadget(world=WorldState(), telemetry=backend, recorder=recorder)
+        gadget.send_custom_event = lambda namespace, name, payload: None
+        await gadget.start()
+        await asyncio.sleep(3)
+        await gadget.stop()
+
+    loop = sim_clock.new_event_loop(fast=True)
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
+    assert len(backends) == 1
+    assert backends[0].reader._map.closed
+    assert backends[0].fetch() == {'batt_voltage': 3.9}